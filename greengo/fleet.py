@@ -0,0 +1,208 @@
+from __future__ import print_function
+
+import os
+import re
+import sys
+import csv
+import glob
+import logging
+import threading
+from time import time
+from multiprocessing.pool import ThreadPool
+
+from greengo import greengo
+
+log = logging.getLogger('greengo')
+yaml = greengo.lazy_import('yaml')
+
+# Commands that can run across a fleet of groups, in the order they apply
+FLEET_COMMANDS = ['create', 'resume', 'update', 'deploy']
+
+_names_lock = threading.Lock()
+
+
+# Run create, resume, update and/or deploy for many groups at once.
+# groups is a directory with group definition files, or a glob of them.
+# With params, groups is a template group definition instead: it is expanded
+# into one group per row of the params table, see expand_template().
+# Each group keeps its state in its own '<name>-GG-Config' directory, as with --bulk,
+# or with state_backend='sqlite', all of them in the state_db database.
+# The groups share the AWS clients, and so their connection pools, of
+# max_pool_connections each, by default enough for all the threads.
+# Prints a summary of duration and outcome per group; exits with 1 if any group failed.
+def fleet(groups, commands='deploy', workers=greengo.MAX_WORKERS, group_workers=1,
+          params=None, state_backend='json', state_db=None, max_pool_connections=None):
+    commands = [commands] if isinstance(commands, str) else list(commands)
+    unknown = [c for c in commands if c not in FLEET_COMMANDS]
+    if unknown:
+        raise ValueError("Unknown fleet commands {0}. Allowed: {1}".format(
+            unknown, FLEET_COMMANDS))
+
+    if params:
+        instances = expand_template(groups, params)
+    else:
+        instances = ((f, None) for f in find_groups(groups))
+
+    # All the groups run in the same region: they share the clients, and so the
+    # connection pools, instead of each making its own.
+    clients = greengo.Clients(max_pool_connections=max_pool_connections or max(
+        workers * group_workers, greengo.MAX_POOL_CONNECTIONS))
+    names = set()
+
+    def run(instance):
+        config_file, group = instance
+        return _run_group(config_file, group, commands, clients, group_workers, names,
+                          state_backend=state_backend, state_db=state_db)
+
+    log.info("Running {0} for the groups of '{1}'".format(', '.join(commands), groups))
+    results = _run_bounded(run, instances, workers)
+    if not results:
+        log.error("No group definitions found in '{0}'".format(groups))
+        sys.exit(1)
+
+    print(summary(results))
+    if any(r['failed'] for r in results):
+        sys.exit(1)
+
+
+# Expand the template group definition for every row of the params table,
+# a CSV file with a header or a YAML list of mappings. '{name}' in the template
+# is replaced by the 'name' column of the row; '{index}' by the row number,
+# unless the table has its own 'index'. Lazy: yields (label, expanded group)
+# one row at a time, and a group definition is only parsed when the group runs,
+# so a large fleet never has all the definitions in memory.
+def expand_template(template_file, params_file):
+    with open(template_file, 'r') as f:
+        template = f.read()
+
+    for index, row in enumerate(_read_params(params_file)):
+        row.setdefault('index', index)
+        yield ('{0}[{1}]'.format(template_file, index),
+               _ExpandedGroup(template, row))
+
+
+def _read_params(params_file):
+    with open(params_file, 'r') as f:
+        if params_file.endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield row
+        else:
+            for row in yaml.safe_load(f) or []:
+                yield row
+
+
+# A template with its row of parameters; rendered only when the group runs
+class _ExpandedGroup(object):
+    VARIABLE = re.compile(r'\{(\w+)\}')
+
+    def __init__(self, template, params):
+        self.template = template
+        self.params = params
+
+    def render(self):
+        text = self.VARIABLE.sub(
+            lambda m: str(self.params[m.group(1)]) if m.group(1) in self.params else m.group(0),
+            self.template)
+        return yaml.safe_load(text)
+
+
+# Like ThreadPool.map, but takes the items from the iterable only as workers
+# become free, instead of queueing all of them upfront. fn must not raise.
+def _run_bounded(fn, items, workers):
+    results = []
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    def call(i, item):
+        try:
+            results.append((i, fn(item)))
+        finally:
+            slots.release()
+
+    pool = ThreadPool(workers)
+    try:
+        for i, item in enumerate(items):
+            slots.acquire()
+            pool.apply_async(call, (i, item))
+    finally:
+        pool.close()
+        pool.join()
+    return [r for i, r in sorted(results, key=lambda x: x[0])]
+
+
+# Group definition files: all YAML files of a directory, or the files matching a glob
+def find_groups(groups):
+    if os.path.isdir(groups):
+        return sorted(
+            glob.glob(os.path.join(groups, '*.yaml')) + glob.glob(os.path.join(groups, '*.yml')))
+    return sorted(glob.glob(groups))
+
+
+# Run the commands for one group. Returns the group result for the summary.
+def _run_group(config_file, group, commands, clients, workers, names,
+               state_backend='json', state_db=None):
+    result = dict(group=config_file, file=config_file, failed=False, outcome='OK')
+    started = time()
+    gg = None
+    try:
+        gg = greengo.GroupCommands(
+            config_file=config_file, bulk=True, workers=workers, clients=clients,
+            group=group.render() if group else None,
+            state_backend=state_backend, state_db=state_db)
+        result['group'] = gg.name
+
+        # Groups with the same name would share the state directory
+        with _names_lock:
+            if gg.name in names:
+                raise ValueError("Duplicate group name '{0}'".format(gg.name))
+            names.add(gg.name)
+
+        for command in commands:
+            if getattr(gg, command)() is False:
+                result['outcome'] = "{0} skipped".format(command)
+
+        if 'deploy' in commands:
+            status = gg.state.get('Deployment', {}).get('Status', {})
+            result['outcome'] = status.get('DeploymentStatus', 'Unknown')
+            result['failed'] = result['outcome'] != 'Success'
+
+    # GroupCommands exits on a missing definition file
+    except (Exception, SystemExit) as e:
+        log.error("Group '{0}' failed: {1}".format(config_file, e))
+        result['failed'] = True
+        result['outcome'] = 'FAILED: {0}'.format(e)
+
+    finally:
+        # The group is done: write its state snapshot, close the state store
+        if gg:
+            gg._state_store.compact()
+            gg._state_store.close()
+
+    result['seconds'] = time() - started
+    return result
+
+
+# Table of per-group duration and outcome
+def summary(results):
+    rows = [('GROUP', 'FILE', 'SECONDS', 'OUTCOME')]
+    rows += [(r['group'], r['file'], '{0:.1f}'.format(r['seconds']), r['outcome'])
+             for r in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+
+    lines = ['{0:<{w[0]}}  {1:<{w[1]}}  {2:>{w[2]}}  {3}'.format(*row, w=widths)
+             for row in rows]
+    failed = len([r for r in results if r['failed']])
+    lines.append("{0} groups, {1} succeeded, {2} failed".format(
+        len(results), len(results) - failed, failed))
+    return '\n'.join(lines)
+
+
+def main():
+    import fire
+    try:
+        fire.Fire(fleet)
+    finally:
+        greengo.log_api_stats()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,52 @@
 import os
 import errno
-import fire
 import json
-import yaml
-import shutil
+import atexit
+import random
+import importlib
 import urllib
-from time import sleep
+import hashlib
+import threading
+import functools
+import contextlib
+from time import sleep, time
+from multiprocessing.pool import ThreadPool
 import logging
-from boto3 import session
-from botocore.exceptions import ClientError
+
+from greengo import keys
+from greengo import packaging
+from greengo import upload
+from greengo import validate
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+try:
+    from urllib.request import urlopen
+except ImportError:  # Python 2
+    from urllib2 import urlopen
+
+
+# A module imported on the first use of one of its attributes. Importing boto3,
+# botocore and yaml takes longer than most greengo commands spend on their own
+# work, and e.g. `greengo --help` needs none of them.
+class lazy_import(object):
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+yaml = lazy_import('yaml')
+session = lazy_import('boto3.session')
+exceptions = lazy_import('botocore.exceptions')
 
 # Set up Logging
 logging.basicConfig(
@@ -21,17 +59,133 @@ log.setLevel(logging.DEBUG)
 DEFINITION_FILE = 'greengo.yaml'
 MAGIC_DIR = '.gg'
 STATE_FILE = os.path.join(MAGIC_DIR, 'gg_state.json')
+STATE_DB = os.path.join(MAGIC_DIR, 'gg_state.db')  # Shared by all the groups
+STATE_BACKENDS = ['json', 'sqlite']
+ENDPOINT_CACHE_FILE = 'iot_endpoint.json'  # In the state directory
 ROOT_CA_URL = "https://www.amazontrust.com/repository/AmazonRootCA1.pem"
 
 DEPLOY_TIMEOUT = 90  # Timeout, seconds
+DEPLOY_POLL_INTERVAL = 0.5  # First deployment status check delay, doubles up to the max
+DEPLOY_POLL_MAX_INTERVAL = 5
+READY_TIMEOUT = 30  # Max seconds to wait for AWS to catch up with a change
+ROLE_READY_TIMEOUT = 60  # Max seconds to wait for a new IAM role to become usable by Lambda
+ROLE_NOT_READY_ERROR = "The role defined for the function cannot be assumed by Lambda"
+MAX_WORKERS = 8  # Max number of provisioning steps running at once
+REGISTRATION_TIMEOUT = 1800  # Max seconds to wait for a bulk thing registration task
+REGISTRATION_DONE = ('Completed', 'Failed', 'Cancelled')  # Final statuses of the task
+SHARED_POLICY_PREFIX = 'greengo-policy-'  # Name of a shared policy, before its document hash
+MAX_POOL_CONNECTIONS = 10  # HTTP connections kept open per AWS client
+API_RETRIES = 5  # Attempts of an AWS call failing with a transient error
+RETRY_DELAY = 1  # Seconds before the first retry, doubles after each attempt
+
+# Calls per second allowed to each API operation, by service, a bit below the
+# AWS account limits. Halved each time AWS throttles a call, then slowly
+# raised back as calls succeed. 'service.operation' keys override the service.
+API_RATES = {
+    'greengrass': 10,
+    'iot': 10,
+    'lambda': 10,
+    'iam': 5,
+    's3': 50,
+}
+API_MIN_RATE = 0.5
+
+# AWS error codes of a call throttled by the service
+THROTTLING_ERRORS = (
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+)
+# AWS error codes worth retrying: the same call may succeed a bit later
+RETRYABLE_ERRORS = THROTTLING_ERRORS + (
+    'ServiceUnavailableException',
+    'InternalFailureException',
+    'RequestTimeout',
+)
+# botocore exceptions of a call failing on the network, worth retrying too.
+# botocore's own retries are off, see Clients.
+NETWORK_ERRORS = ('ConnectionError', 'ReadTimeoutError', 'ConnectionClosedError')
+# Of those, the ones failing before the request is sent: no connection was made
+UNSENT_ERRORS = ('ConnectionError',)
+# Operations making something new on every call, e.g. a certificate. A call
+# failing with a timeout or an internal error may have succeeded all the same,
+# and a retry would make a second one: they are only retried when throttled,
+# as AWS turns down a throttled call before doing anything, or when the
+# request was never sent.
+NON_IDEMPOTENT_PREFIXES = ('create_', 'publish_', 'start_')
+
+# Error codes of the AWS APIs for something that doesn't exist
+NOT_FOUND_ERRORS = ('IdNotFoundException', 'ResourceNotFoundException', 'NotFoundException', '404')
+
+# Greengrass definitions in the group state: the name used in the API calls,
+# and the key of the list of items in the definition
+DEFINITION_APIS = {
+    'CoreDefinition': ('core', 'Cores'),
+    'DeviceDefinition': ('device', 'Devices'),
+    'Resources': ('resource', 'Resources'),
+    'FunctionDefinition': ('function', 'Functions'),
+    'Connectors': ('connector', 'Connectors'),
+    'Subscriptions': ('subscription', 'Subscriptions'),
+    'Loggers': ('logger', 'Loggers'),
+}
+
+# Paginated list calls of status --drift: service, operation, key of the items,
+# page token argument and response key, and the largest page size of the call
+LIST_APIS = {
+    'groups': ('greengrass', 'list_groups', 'Groups', 'NextToken', 'NextToken',
+               {'MaxResults': '100'}),
+    'things': ('iot', 'list_things', 'things', 'nextToken', 'nextToken', {'maxResults': 250}),
+    'certificates': ('iot', 'list_certificates', 'certificates', 'marker', 'nextMarker',
+                     {'pageSize': 250}),
+    'policies': ('iot', 'list_policies', 'policies', 'marker', 'nextMarker', {'pageSize': 250}),
+    'functions': ('lambda', 'list_functions', 'Functions', 'Marker', 'NextMarker',
+                  {'MaxItems': 50}),
+}
+# and the definitions, by their key in the state
+LIST_APIS.update(
+    (key, ('greengrass', 'list_{0}_definitions'.format(kind), 'Definitions',
+           'NextToken', 'NextToken', {'MaxResults': '100'}))
+    for key, (kind, _) in DEFINITION_APIS.items())
+
+THING_PARTS = ('keys', 'thing', 'policy')  # State of a core or device, made in this order
+
+# The definition made last by each step of create, see resume
+CREATE_STEP_DEFINITIONS = {
+    'cores': 'CoreDefinition',
+    'devices': 'DeviceDefinition',
+    'resources': 'Resources',
+    'lambdas': 'FunctionDefinition',
+    'connectors': 'Connectors',
+    'subscriptions': 'Subscriptions',
+    'loggers': 'Loggers',
+}
+
+JOURNAL_MAX_RECORDS = 1000  # Compact the state journal when it grows this long
+
+# Steps running on the thread pool share the state file
+_state_lock = threading.RLock()
+# State files with changes in the journal only, not in the snapshot yet
+_dirty_state_files = set()
+# State stores holding something open, e.g. a database connection
+_open_state_stores = set()
 
 class GroupCommands(object):
-    def __init__(self, config_file=DEFINITION_FILE, bulk=False):
-        global STATE_FILE, DEFINITION_FILE, MAGIC_DIR
+    # config_file: group definition file. group: already parsed group
+    # definition, used instead of the file, see greengo.fleet.
+    # state_backend: 'json' keeps the group state in a file of the group,
+    # 'sqlite' in the state_db database, together with the other groups.
+    def __init__(self, config_file=DEFINITION_FILE, bulk=False, workers=MAX_WORKERS,
+                 clients=None, group=None, state_backend='json', state_db=None):
+        self._workers = workers
+        if state_backend not in STATE_BACKENDS:
+            log.error("Unknown state backend '{0}'. Allowed: {1}".format(
+                state_backend, STATE_BACKENDS))
+            exit(-1)
 
         # Get the current session data from AWS' Boto3
-        s = session.Session()
-        self._region = s.region_name
+        clients = clients or Clients(max_pool_connections=max(workers, MAX_POOL_CONNECTIONS))
+        self._region = clients.region_name
         if not self._region:
             log.error("AWS credentials and region must be setup. "
                       "Refer AWS docs at https://goo.gl/JDi5ie")
@@ -39,21 +193,20 @@ class GroupCommands(object):
 
         log.info("AWS credentials found for region '{}'".format(self._region))
 
-        # Set up a way to talk to each of the used AWS services
-        self._gg = s.client("greengrass")
-        self._iot = s.client("iot")
-        self._lambda = s.client("lambda")
-        self._iam = s.client("iam")
-        self._iot_endpoint = self._iot.describe_endpoint(endpointType='iot:Data-ATS')['endpointAddress']
+        # The clients to talk to each of the used AWS services are created on first use
+        self._clients = clients
 
-        DEFINITION_FILE = config_file
+        self._definition_file = config_file
 
         # Get the configuration file
         try:
-            with open(DEFINITION_FILE, 'r') as f:
-                self.group = yaml.safe_load(f)
+            if group is not None:
+                self.group = group
+            else:
+                with open(self._definition_file, 'r') as f:
+                    self.group = yaml.safe_load(f)
         except IOError:
-            log.error("Group definition file "+DEFINITION_FILE+" not found. "
+            log.error("Group definition file "+self._definition_file+" not found. "
                       "Create file, and define the group definition first. "
                       "See https://github.com/greengo for details.")
             exit(-1)
@@ -61,60 +214,215 @@ class GroupCommands(object):
         self.name = self.group['Group']['name']
         self._LAMBDA_ROLE_NAME = "{0}_Lambda_Role".format(self.name)
 
+        self._magic_dir = MAGIC_DIR
+        self._state_file = STATE_FILE
         # If we are doing bulk deployment, create a new folder to save all of the relevant information about that group
         if bulk:
             log.info("Bulk Creation Enabled")
-            MAGIC_DIR = self.name + "-GG-Config"
-            STATE_FILE = os.path.join(MAGIC_DIR, 'gg_state.json')
-
-        _mkdir(MAGIC_DIR)
-        self.state = _load_state()
+            self._magic_dir = self.name + "-GG-Config"
+            self._state_file = os.path.join(self._magic_dir, 'gg_state.json')
+
+        self._state_db = state_db or STATE_DB
+
+        _mkdir(self._magic_dir)
+        self._state_store = self._open_state_store(state_backend)
+
+        # Shared policies created or found by this command, by name
+        self._policies = {}
+        self._policies_lock = threading.Lock()
+        # Lambdas created by an interrupted create, to reuse on resume, by name
+        self._created_lambdas = {}
+        self.state = self._state_store.load()
+
+    def _open_state_store(self, backend):
+        if backend == 'sqlite':
+            from greengo.sqlite_state import StateDB
+            _mkdir(os.path.dirname(self._state_db) or '.')
+            return StateDB(self._state_db, self.name)
+        return StateFile(self._state_file)
+
+    @property
+    def _gg(self):
+        return self._clients.get('greengrass')
+
+    @property
+    def _iot(self):
+        return self._clients.get('iot')
+
+    @property
+    def _lambda(self):
+        return self._clients.get('lambda')
+
+    @property
+    def _iam(self):
+        return self._clients.get('iam')
+
+    @property
+    def _iot_endpoint(self):
+        return self._clients.iot_endpoint(cache_dir=self._magic_dir)
+
+    # Save the group state to the state file. keys: the top-level keys of the
+    # state changed since the last save, only those are written.
+    def _update_state(self, *keys):
+        self._state_store.save(self.state, keys)
+
+    # Change the keys of the group state, then save them. Steps running on the
+    # thread pool share the state: it is only changed, and serialized, under _state_lock.
+    # The store takes the lock again to serialize the keys, and may write them out of it.
+    @contextlib.contextmanager
+    def _state_change(self, *keys):
+        with _state_lock:
+            yield
+        self._update_state(*keys)
 
     # Create a new GreenGrass Group
     def create(self):
         if self.state:
             log.error("Previously created group exists. Remove before creating!")
             return False
+        if self.validate() is False:
+            return False
 
         log.info("[BEGIN] creating group {0}".format(self.group['Group']['name']))
 
-        # TODO: create_lambda handles self.state directly.
-        #       _create_cores leaves it to a caller. Refactor?
-
         # 1. Create group
         # TODO: create group at the end, with "initial version"?
         group = rinse(self._gg.create_group(Name=self.group['Group']['name']))
-        self.state['Group'] = group
-        _update_state(self.state)
-        # Must update state on every step, else how can I clean?
-        # Or on exception?
+        # Every step done is checkpointed in the state, for resume
+        with self._state_change('Group', 'Checkpoints'):
+            self.state['Group'] = group
+            self.state['Checkpoints'] = ['group']
 
-        # 2. Create core a) thing b) attach to group
-        self._create_cores()
+        # 2. Create cores, devices, resources, lambdas, connectors, subscriptions and loggers
+        self._create()
 
-        # 5. Create devices
-        self._create_devices(update_group_version=False)
+        log.info("[END] creating group {0}".format(self.group['Group']['name']))
 
-        # 3. Create Resources - policies for local and ML resource access.
-        self.create_resources()
+    # Continue a create which failed or was interrupted. The steps done are
+    # skipped. A step which was under way is checked against AWS: it is done if
+    # its definition exists, else it runs again, reusing the lambdas it created.
+    def resume(self):
+        if 'Checkpoints' not in self.state:
+            log.error("No group creation to resume. Use create.")
+            return False
+        if 'group_version' in self.state['Checkpoints']:
+            log.info("Group {0} is created, nothing to resume".format(self.name))
+            return True
+        if self.validate() is False:
+            return False
 
-        # 4. Create Lambda functions and function definitions
-        #    Lambda may have dependencies on resources.
-        #    TODO: refactor to take dependencies into account
-        self.create_lambdas(update_group_version=False)
+        log.info("[BEGIN] resuming creation of group {0}, done: {1}".format(
+            self.name, ', '.join(self.state['Checkpoints'])))
+        self._gg.get_group(GroupId=self.state['Group']['Id'])  # Fails if it's gone
 
-        self.create_connectors(update_group_version=False)
+        for name in sorted(CREATE_STEP_DEFINITIONS):
+            if name not in self.state['Checkpoints']:
+                self._verify_step(name)
+        self._create()
 
-        # 6. Create subscriptions
-        self.create_subscriptions(update_group_version=False)
+        log.info("[END] resuming creation of group {0}".format(self.name))
 
-        # 7. Create logger definitions
-        self.create_loggers()  # TODO: I'll also need group-version update to change it later...
+    # Run the steps of create not done yet, and then create the group version.
+    # Steps which don't depend on each other run concurrently, a step starts
+    # once all the steps it depends on are done.
+    def _create(self):
+        done = set(self.state['Checkpoints'])
+        _run_dag([(name, self._checkpointed(name, fn), [d for d in deps if d not in done])
+                  for name, fn, deps in self._create_steps() if name not in done],
+                 workers=self._workers)
 
         # LAST. Add all the constituent parts to the Greengrass Group
-        self.create_group_version()
+        if 'group_version' not in done:
+            self.create_group_version()
+            self._checkpoint('group_version')
+
+    def _create_steps(self):
+        return [
+            ('cores', self._create_cores, []),
+            ('devices', functools.partial(self._create_devices, update_group_version=False), []),
+            # Resources - policies for local and ML resource access.
+            ('resources', self.create_resources, []),
+            # Lambda may have dependencies on resources.
+            ('lambdas', functools.partial(self.create_lambdas, update_group_version=False),
+             ['resources']),
+            ('connectors', functools.partial(self.create_connectors, update_group_version=False),
+             []),
+            # Subscriptions refer to ARNs of lambdas, devices and connectors.
+            ('subscriptions',
+             functools.partial(self.create_subscriptions, update_group_version=False),
+             ['lambdas', 'devices', 'connectors']),
+            # TODO: I'll also need group-version update to change loggers later...
+            ('loggers', self.create_loggers, []),
+        ]
+
+    # The step, recording itself in the checkpoints once it's done
+    def _checkpointed(self, name, fn):
+        def step():
+            fn()
+            self._checkpoint(name)
+        return step
+
+    def _checkpoint(self, name):
+        with self._state_change('Checkpoints'):
+            self.state['Checkpoints'] = self.state['Checkpoints'] + [name]
+        self._state_store.sync()
+
+    # Check a step which was under way against AWS. If it got as far as its
+    # definition, it is done, and its state is brought up to date. Else it runs
+    # again: the lambdas and things it created are reused.
+    def _verify_step(self, name):
+        key = CREATE_STEP_DEFINITIONS[name]
+        if key in self.state:
+            if self._verify_definition(key):
+                log.info("Step '{0}' is done: definition '{1}' exists".format(
+                    name, self.state[key]['Id']))
+                self._update_state(key)
+                self._checkpoint(name)
+                return
+            log.info("Step '{0}' to redo: definition '{1}' not found".format(
+                name, self.state[key]['Id']))
+            self.state.pop(key)
+
+        if name == 'lambdas':
+            self._verify_lambdas()
+        # The things in the state are kept, the step skips them when redone
+        self._update_state(key, name.capitalize())
+
+    # Whether the definition in the state exists. Refreshes its state, which
+    # may have been left without the latest version details.
+    def _verify_definition(self, key):
+        kind, _ = DEFINITION_APIS[key]
+        definition_id = kind.capitalize() + 'DefinitionId'
+        definition = self.state[key]
+        try:
+            definition.update(rinse(getattr(self._gg, 'get_{0}_definition'.format(kind))(
+                **{definition_id: definition['Id']})))
+        except exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in NOT_FOUND_ERRORS:
+                raise
+            return False
 
-        log.info("[END] creating group {0}".format(self.group['Group']['name']))
+        if 'LatestVersionDetails' not in definition:
+            details = getattr(self._gg, 'get_{0}_definition_version'.format(kind))(
+                **{definition_id: definition['Id'],
+                   kind.capitalize() + 'DefinitionVersionId': definition['LatestVersion']})
+            definition['LatestVersionDetails'] = rinse(details)
+        return True
+
+    # The lambdas in the state which exist, for _create_lambda to reuse
+    def _verify_lambdas(self):
+        for lr in self.state.get('Lambdas', []):
+            if lr.get('already_defined'):
+                continue
+            try:
+                self._lambda.get_function_configuration(
+                    FunctionName=lr['FunctionName'], Qualifier=lr['Version'])
+            except exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in NOT_FOUND_ERRORS:
+                    raise
+                continue
+            log.info("Lambda function '{0}' exists, reusing it".format(lr['FunctionName']))
+            self._created_lambdas[lr['FunctionName']] = lr
 
     # Create the file containing the root certificate
     def create_root_key(self):
@@ -124,8 +432,10 @@ class GroupCommands(object):
                 ROOT_CA_URL,
                 self.group['certs']['keypath'] + "/root.ca.pem")
 
-    # Deploy lambda function and any other data to each of the GreenGrass Cores
-    def deploy(self):
+    # Deploy lambda function and any other data to each of the GreenGrass Cores.
+    # Waits for the deployment to finish, up to timeout seconds;
+    # with no_wait, returns the deployment id right away.
+    def deploy(self, no_wait=False, timeout=DEPLOY_TIMEOUT):
         if not self.state:
             log.info("There is nothing to deploy. Do create first.")
             return
@@ -138,37 +448,55 @@ class GroupCommands(object):
             GroupId=self.state['Group']['Id'],
             GroupVersionId=self.state['Group']['Version']['Version'],
             DeploymentType="NewDeployment")
-        self.state['Deployment'] = rinse(deployment)
-        _update_state(self.state)
+        with self._state_change('Deployment'):
+            self.state['Deployment'] = rinse(deployment)
+            self.state['Deployment']['StartedAt'] = time()
+
+        if no_wait:
+            log.info("Deployment '{0}' started. Check it with 'greengo wait_deployment'".format(
+                deployment['DeploymentId']))
+            return deployment['DeploymentId']
+
+        self.wait_deployment(timeout)
+
+    # Wait for the last deployment to finish, up to timeout seconds.
+    # Time to each status change goes to the state as Deployment.Transitions.
+    def wait_deployment(self, timeout=DEPLOY_TIMEOUT):
+        if not self.state.get('Deployment'):
+            log.info("There is no deployment to wait for. Do deploy first.")
+            return
 
-        # This loop will display the status of the current deployment to the terminal
-        for i in range(DEPLOY_TIMEOUT // 2):
-            sleep(2)
-            # every two seconds check what the deployment status is
+        deployment = self.state['Deployment']
+        transitions = deployment.setdefault('Transitions', [])
+        started = deployment.get('StartedAt', time())
 
+        def finished():
             deployment_status = self._gg.get_deployment_status(
                 GroupId=self.state['Group']['Id'],
                 DeploymentId=deployment['DeploymentId'])
 
             status = deployment_status.get('DeploymentStatus')
+            if not transitions or transitions[-1]['Status'] != status:
+                log.debug("--- deploying... status: {0}".format(status))
+                transitions.append({'Status': status, 'Seconds': round(time() - started, 3)})
+                deployment['Status'] = rinse(deployment_status)
+                self._update_state('Deployment')
 
-            log.debug("--- deploying... status: {0}".format(status))
             # Known status values: ['Building | InProgress | Success | Failure']
-            if status == 'Success':
-                log.info("--- SUCCESS!")
-                self.state['Deployment']['Status'] = rinse(deployment_status)
-                _update_state(self.state)
-                return
-            elif status == 'Failure':
-                log.error("--- ERROR! {0}".format(deployment_status['ErrorMessage']))
-                self.state['Deployment']['Status'] = rinse(deployment_status)
-                _update_state(self.state)
-                return
-        # If the deployment is not complete by the deploy timeout, then quit. Something probably went wrong.
-        log.warning(
-            "--- Gave up waiting for deployment. Please check the status later. "
-            "Make sure GreenGrass Core is running, connected to network, "
-            "and the certificates match.")
+            return status in ('Success', 'Failure')
+
+        # Poll often at first so fast deployments return fast,
+        # then back off to the cap for the slow ones
+        if not _wait_for(finished, timeout, DEPLOY_POLL_INTERVAL, DEPLOY_POLL_MAX_INTERVAL):
+            # If the deployment is not complete by the deploy timeout, then quit. Something probably went wrong.
+            log.warning(
+                "--- Gave up waiting for deployment. Please check the status later. "
+                "Make sure GreenGrass Core is running, connected to network, "
+                "and the certificates match.")
+        elif deployment['Status']['DeploymentStatus'] == 'Success':
+            log.info("--- SUCCESS!")
+        else:
+            log.error("--- ERROR! {0}".format(deployment['Status'].get('ErrorMessage')))
 
     # Create a version of a group that has already been created
     def create_group_version(self):
@@ -193,8 +521,8 @@ class GroupCommands(object):
 
         group_ver = self._gg.create_group_version(**args)
 
-        self.state['Group']['Version'] = rinse(group_ver)
-        _update_state(self.state)
+        with self._state_change('Group'):
+            self.state['Group']['Version'] = rinse(group_ver)
 
     # Remove all of the components that we created through Greengo
     def remove(self):
@@ -204,20 +532,19 @@ class GroupCommands(object):
 
         log.info("[BEGIN] removing group {0}".format(self.group['Group']['name']))
 
-        # 1. Remove all of the subscriptions
-        self.remove_subscriptions()
-
-        # 2. Remove all of the cores and the associated devices and certs
-        self._remove_cores()
-
-        # 3. Remove all devices definitions and associated certificates
-        self._remove_devices()
-
-        # 4. Remove all of the lambdas
-        self.remove_lambdas()
-
-        # 5. Remove all of the other resources that were being used (AI/ML related specifically)
-        self.remove_resources()
+        _run_dag([
+            # 1. Remove all of the subscriptions
+            ('subscriptions', self.remove_subscriptions, []),
+            # 2. Remove all of the cores and the associated devices and certs
+            ('cores', self._remove_cores, []),
+            # 3. Remove all devices definitions and associated certificates,
+            #    once no subscription refers to them
+            ('devices', self._remove_devices, ['subscriptions']),
+            # 4. Remove all of the lambdas, also after the subscriptions
+            ('lambdas', self.remove_lambdas, ['subscriptions']),
+            # 5. Remove all of the other resources that were being used (AI/ML related specifically)
+            ('resources', self.remove_resources, ['lambdas']),
+        ], workers=self._workers)
 
         # 6. Reset all of the deployments - otherwise GreenGrass won't let us delete the group
         log.info("Reseting deployments forcefully, if they exist")
@@ -228,7 +555,7 @@ class GroupCommands(object):
         self._gg.delete_group(GroupId=self.state['Group']['Id'])
 
         # 8. Now that've removed the GreenGrass group, it is safe to delete the state file describing the current state of the group
-        os.remove(STATE_FILE)
+        self._state_store.remove()
 
         log.info("[END] removing group {0}".format(self.group['Group']['name']))
 
@@ -238,18 +565,56 @@ class GroupCommands(object):
             log.info("Creating default lambda role '{0}'".format(self._LAMBDA_ROLE_NAME))
             try:
                 role = self._create_default_lambda_role()
-            except ClientError as e:
+            except exceptions.ClientError as e:
                 if e.response['Error']['Code'] == 'EntityAlreadyExists':
                     role = self._iam.get_role(RoleName=self._LAMBDA_ROLE_NAME)
                     log.warning("Role {0} already exists, reusing.".format(self._LAMBDA_ROLE_NAME))
                 else:
                     raise e
 
-            self.state['LambdaRole'] = rinse(role)
-            _update_state(self.state)
+            with self._state_change('LambdaRole'):
+                self.state['LambdaRole'] = rinse(role)
         # once a default lambda role has been created with access to the Lambda, return the ARN
         return self.state['LambdaRole']['Role']['Arn']
 
+    # Check the group definition offline: schema, subscriptions, resource ids
+    # and the like. create, update and plan do it before any AWS call.
+    def validate(self):
+        errors = validate.validate(self.group)
+        for e in errors:
+            log.error(e)
+        if errors:
+            log.error("Group definition '{0}' has {1} error(s).".format(
+                self._definition_file, len(errors)))
+            return False
+        log.info("Group definition '{0}' is valid.".format(self._definition_file))
+
+    # Move the group state to another state backend, 'json' or 'sqlite'.
+    # The state is removed from the current backend once written to the new one.
+    def migrate_state(self, to):
+        if to not in STATE_BACKENDS:
+            log.error("Unknown state backend '{0}'. Allowed: {1}".format(to, STATE_BACKENDS))
+            return False
+        if not self.state:
+            log.error("No group state to migrate.")
+            return False
+
+        target = self._open_state_store(to)
+        if type(target) is type(self._state_store):
+            log.error("Group state is already in the '{0}' backend.".format(to))
+            return False
+        if target.exists():
+            log.error("Group '{0}' already has a state in the '{1}' backend. "
+                      "Remove it before migrating.".format(self.name, to))
+            return False
+
+        target.save(self.state)
+        target.compact()
+        self._state_store.remove()
+        self._state_store.close()
+        self._state_store = target
+        log.info("Group state migrated to the '{0}' backend.".format(to))
+
     # Update the current code for the Lambda only if a Lambda already exists
     def update_lambda(self, lambda_name):
         if not (self.state and self.state.get('Lambdas')):
@@ -267,23 +632,65 @@ class GroupCommands(object):
             log.error("No definition for lambda function '{0}'.".format(lambda_name))
             return
 
+        if self._update_lambda_code(l, lr):
+            log.info("Lambdas function {0} updated OK!".format(lambda_name))
+
+    # Update the code of all the lambdas with a changed package at once, then
+    # make one new function definition version and group version with them
+    def update_lambdas(self):
+        if not (self.state and self.state.get('Lambdas')):
+            log.info("No lambdas created. Create first...")
+            return
+
+        updated = self._update_lambda_codes(
+            [l['name'] for l in self.group['Lambdas'] if 'handler' in l])
+        if not updated:
+            log.info("No lambda function code changed. Moving on...")
+            return
+
+        functions = dict((f['Id'], f) for f in self._deployed_definition('FunctionDefinition'))
+        self._create_definition_version('FunctionDefinition', [
+            dict(functions[l['name']], FunctionConfiguration=l['greengrassConfig'])
+            for l in self.group['Lambdas'] if l['name'] in functions])
+        self.create_group_version()
+        log.info("Lambda functions {0} updated OK!".format(', '.join(updated)))
+
+    # Update the code of the named lambdas in parallel.
+    # Returns the names of the lambdas actually updated.
+    def _update_lambda_codes(self, names):
+        if not names:
+            return []
+        deployed = dict((lr['FunctionName'], lr) for lr in self.state['Lambdas'])
+        lambdas = [l for l in self.group['Lambdas'] if l['name'] in names and l['name'] in deployed]
+        updated = _pmap(lambda l: self._update_lambda_code(l, deployed[l['name']]),
+                        lambdas, self._workers)
+        return [l['name'] for l, changed in zip(lambdas, updated) if changed]
+
+    # Publish the lambda package as a new version of the function, if it changed,
+    # and move the alias to it. Updates the function entry lr of the group state.
+    def _update_lambda_code(self, l, lr):
         log.info("Updating lambda function code for '{0}'".format(lr['FunctionName']))
 
-        # Zip the directory - Maybe we should consider using S3
-        zf = shutil.make_archive(
-            os.path.join(MAGIC_DIR, l['name']), 'zip', l['package'])
+        # Zip the directory
+        zf, changed = self._build_package(l)
         log.debug("Lambda deployment Zipped to '{0}'".format(zf))
 
+        # Nothing to do if the function already runs this very code
+        if not changed and packaging.code_sha256(zf) == lr.get('CodeSha256'):
+            log.info("Lambda function '{0}' code is unchanged. Moving on...".format(
+                lr['FunctionName']))
+            return False
+
         # Update the Lambda Function Code, get the new version number
-        with open(zf, 'rb') as f:
+        with self._function_code(zf) as code:
             lr_updated = self._lambda.update_function_code(
                 FunctionName=l['name'],
-                ZipFile=f.read(),
-                Publish=True
+                Publish=True,
+                **code
             )
 
-        lr.update(rinse(lr_updated))
-        _update_state(self.state)
+        with self._state_change('Lambdas'):
+            lr.update(rinse(lr_updated))
         log.info("Lambda function '{0}' updated".format(lr['FunctionName']))
 
         log.info("Updating alias '{0}'...".format(l.get('alias', 'default')))
@@ -299,8 +706,7 @@ class GroupCommands(object):
             alias['FunctionVersion'], alias['AliasArn']))
         # TODO: save alias? If so, where? If the alias name changed in group,
         # then LambdaDefinitions should also be updated.
-
-        log.info("Lambdas function {0} updated OK!".format(lambda_name))
+        return True
 
     # Create a lambda or link lambda to the new GreenGrass Group is already exists
     def create_lambdas(self, update_group_version=True):
@@ -314,86 +720,24 @@ class GroupCommands(object):
         #     return
 
         functions = []
-        self.state['Lambdas'] = []
-        _update_state(self.state)
+        with self._state_change('Lambdas'):
+            self.state['Lambdas'] = []
 
-        # For every lambda function that needs to be added
-        for l in self.group['Lambdas']:
-
-            log.info("Creating Lambda function '{0}'".format(l['name']))
-
-            role_arn = l['role'] if 'role' in l else self._default_lambda_role_arn()
-            log.info("Assuming role '{0}'".format(role_arn))
-            # Check if the lambda is already created (by looking at the config file)
-            already_defined = not ('handler' in l)
+        # Create the default role upfront, once for all the lambdas
+        if any('role' not in l for l in self.group['Lambdas']):
+            self._default_lambda_role_arn()
 
-            # if it is not defined then make a zip and create a lambda function with that code
-            # TODO: should we be using S3 instead of a zip upload?
-            if not already_defined:
-                zf = shutil.make_archive(
-                    os.path.join(MAGIC_DIR, l['name']), 'zip', l['package'])
-                log.debug("Lambda deployment Zipped to '{0}'".format(zf))
-
-                for retry in range(3):
-                    try:
-                        with open(zf, 'rb') as f:
-                            lr = self._lambda.create_function(
-                                FunctionName=l['name'],
-                                Runtime='python2.7', # need to eventually change the default to python3 eventually since python 2.7 support ends soon
-                                Role=role_arn,
-                                Handler=l['handler'],
-                                Code=dict(ZipFile=f.read()),
-                                Environment=dict(Variables=l.get('environment', {})),
-                                Publish=True
-                            )
-                            # Break from retry cycle if lambda is created
-                            break
-                    except ClientError as e:  # Catch the right exception
-                        if "The role defined for the function cannot be assumed by Lambda" in str(e):
-                            # Function creation immediately after role creation fails with
-                            # "The role defined for the function cannot be assumed by Lambda."
-                            # See StackOverflow https://goo.gl/eTfqsS
-                            log.warning("We hit AWS bug: the role is not yet propagated."
-                                        "Taking 10 sec nap")
-                            sleep(10)
-                            continue
-                        else:
-                            raise(e)
-
-                lr['ZipPath'] = zf
-            # if the lambda function is already defined get the current state and set already_defined to True
-            else:
-                lr = self._lambda.get_function_configuration(
-                    FunctionName=l['name'],
-                    Qualifier=l['alias']
-                )
-                lr['already_defined'] = True
-            self.state['Lambdas'].append(rinse(lr))
-            _update_state(self.state)
-            log.info("Lambda function '{0}' created".format(lr['FunctionName']))
+        # The first lambda waits for the role to become usable, if needed;
+        # then the others are created in parallel, in the order of the list.
+        lambdas = self.group['Lambdas']
+        functions.append(self._create_lambda(lambdas[0]))
+        functions += _pmap(self._create_lambda, lambdas[1:], self._workers)
 
-            # Auto-created alias uses the version of just published function
-            if not already_defined:
-                alias = self._lambda.create_alias(
-                    FunctionName=lr['FunctionName'],
-                    Name=l.get('alias', 'default'),
-                    FunctionVersion=lr['Version'],
-                    Description='Created by greengo'
-                )
-            else:
-                alias = self._lambda.get_alias(
-                FunctionName=lr['FunctionName'],
-                Name=l.get('alias', 'default')
-                )
-            log.info("Lambda alias created. FunctionVersion:'{0}', Arn:'{1}'".format(
-                alias['FunctionVersion'], alias['AliasArn']))
-
-            # append the new lambda function to the list of functions that will be saved later
-            functions.append({
-                'Id': l['name'],
-                'FunctionArn': alias['AliasArn'],
-                'FunctionConfiguration': l['greengrassConfig']
-            })
+        # Each lambda went to the state as soon as it was created; keep them
+        # in the order of the definition file
+        order = dict((l['name'], i) for i, l in enumerate(lambdas))
+        with self._state_change('Lambdas'):
+            self.state['Lambdas'].sort(key=lambda lr: order.get(lr['FunctionName'], len(order)))
 
         log.debug("Function definition list ready:\n{0}".format(pretty(functions)))
 
@@ -404,15 +748,15 @@ class GroupCommands(object):
             Name=self.name + '_func_def_1',
             InitialVersion={'Functions': functions}
         )
-        self.state['FunctionDefinition'] = rinse(fd)
-        _update_state(self.state)
+        with self._state_change('FunctionDefinition'):
+            self.state['FunctionDefinition'] = rinse(fd)
 
         fd_ver = self._gg.get_function_definition_version(
             FunctionDefinitionId=self.state['FunctionDefinition']['Id'],
             FunctionDefinitionVersionId=self.state['FunctionDefinition']['LatestVersion'])
 
-        self.state['FunctionDefinition']['LatestVersionDetails'] = rinse(fd_ver)
-        _update_state(self.state)
+        with self._state_change('FunctionDefinition'):
+            self.state['FunctionDefinition']['LatestVersionDetails'] = rinse(fd_ver)
 
         # if we need to update the group version, then do it by creating a new group version
         if update_group_version:
@@ -421,6 +765,144 @@ class GroupCommands(object):
 
         log.info("Lambdas and function definition created OK!")
 
+    # Create a lambda function and its alias, or link an already existing one
+    def _create_lambda(self, l):
+        log.info("Creating Lambda function '{0}'".format(l['name']))
+
+        role_arn = l['role'] if 'role' in l else self._default_lambda_role_arn()
+        log.info("Assuming role '{0}'".format(role_arn))
+        # Check if the lambda is already created (by looking at the config file)
+        already_defined = not ('handler' in l)
+
+        reused = l['name'] in self._created_lambdas
+
+        # Created by an interrupted create, see resume
+        if reused:
+            lr = self._created_lambdas[l['name']]
+        # if it is not defined then make a zip and create a lambda function with that code
+        elif not already_defined:
+            zf, _ = self._build_package(l)
+            log.debug("Lambda deployment Zipped to '{0}'".format(zf))
+
+            with self._function_code(zf) as code:
+                lr = self._create_function(
+                    FunctionName=l['name'],
+                    Runtime=packaging.RUNTIME, # need to eventually change the default to python3 eventually since python 2.7 support ends soon
+                    Role=role_arn,
+                    Handler=l['handler'],
+                    Code=code,
+                    Environment=dict(Variables=l.get('environment', {})),
+                    Publish=True
+                )
+
+            lr['ZipPath'] = zf
+        # if the lambda function is already defined get the current state and set already_defined to True
+        else:
+            lr = self._lambda.get_function_configuration(
+                FunctionName=l['name'],
+                Qualifier=l['alias']
+            )
+            lr['already_defined'] = True
+        with self._state_change('Lambdas'):
+            self.state['Lambdas'].append(rinse(lr))
+        log.info("Lambda function '{0}' created".format(lr['FunctionName']))
+
+        alias = None
+        if already_defined or reused:
+            try:
+                alias = self._lambda.get_alias(
+                    FunctionName=lr['FunctionName'],
+                    Name=l.get('alias', 'default')
+                )
+            except exceptions.ClientError as e:
+                # A reused function may have stopped short of its alias
+                if not reused or e.response['Error']['Code'] not in NOT_FOUND_ERRORS:
+                    raise
+
+        # Auto-created alias uses the version of just published function
+        if alias is None:
+            alias = self._lambda.create_alias(
+                FunctionName=lr['FunctionName'],
+                Name=l.get('alias', 'default'),
+                FunctionVersion=lr['Version'],
+                Description='Created by greengo'
+            )
+        log.info("Lambda alias created. FunctionVersion:'{0}', Arn:'{1}'".format(
+            alias['FunctionVersion'], alias['AliasArn']))
+
+        # Return the function entry for the function definition
+        return {
+            'Id': l['name'],
+            'FunctionArn': alias['AliasArn'],
+            'FunctionConfiguration': l['greengrassConfig']
+        }
+
+    # Zip the lambda package, with the zip options of the lambda definition,
+    # and the dependencies from the requirements.txt of the package, if any
+    def _build_package(self, l):
+        requirements = self._requirements_file(l)
+        return packaging.build_package(
+            l['name'], l['package'], self._magic_dir,
+            level=l.get('compression_level', packaging.COMPRESSION_LEVEL),
+            exclude=l.get('exclude', packaging.EXCLUDE),
+            dependencies_dir=packaging.build_dependencies(
+                requirements, runtime=packaging.RUNTIME,
+                platform=l.get('platform', packaging.PLATFORM)) if requirements else None)
+
+    # Check if the lambda package changed since it was built, or differs from the deployed code
+    def _package_changed(self, l, code_sha256):
+        requirements = self._requirements_file(l)
+        return packaging.is_changed(
+            l['name'], l['package'], self._magic_dir, code_sha256,
+            exclude=l.get('exclude', packaging.EXCLUDE),
+            dependencies_dir=packaging.dependencies_dir(
+                requirements, runtime=packaging.RUNTIME,
+                platform=l.get('platform', packaging.PLATFORM)) if requirements else None)
+
+    def _requirements_file(self, l):
+        path = os.path.join(l['package'], l.get('requirements', 'requirements.txt'))
+        return path if os.path.isfile(path) else None
+
+    # The code of a lambda function, for create_function or update_function_code:
+    # the zip itself, mapped in memory, or with LambdaCode defined for the group, its S3 copy
+    @contextlib.contextmanager
+    def _function_code(self, zf):
+        code = self.group.get('LambdaCode')
+        if not code:
+            with packaging.open_package(zf) as data:
+                yield dict(ZipFile=data)
+            return
+
+        key = upload.upload_package(
+            self._clients.get('s3'), zf, code['S3Bucket'], code.get('S3Prefix', ''),
+            workers=self._workers)
+        yield dict(S3Bucket=code['S3Bucket'], S3Key=key)
+
+    # Create a lambda function. Function creation right after role creation
+    # fails with "The role defined for the function cannot be assumed by Lambda"
+    # until the role propagates in IAM, see StackOverflow https://goo.gl/eTfqsS.
+    # Retry shortly, with jitter, until it does.
+    def _create_function(self, **kwargs):
+        created = {}
+
+        def create():
+            try:
+                created['function'] = self._lambda.create_function(**kwargs)
+                return True
+            except exceptions.ClientError as e:
+                if ROLE_NOT_READY_ERROR not in str(e):
+                    raise
+                log.debug("--- role '{0}' is not propagated yet, retrying...".format(
+                    kwargs['Role']))
+                created['error'] = e
+                return False
+
+        if not _wait_for(create, ROLE_READY_TIMEOUT, delay=0.5, max_delay=2, jitter=True):
+            log.error("Role '{0}' still can't be assumed by Lambda after {1} sec".format(
+                kwargs['Role'], ROLE_READY_TIMEOUT))
+            raise created['error']
+        return created['function']
+
     # Remove Lambda Functions
     def remove_lambdas(self):
         if not (self.state and self.state.get('Lambdas')):
@@ -435,30 +917,35 @@ class GroupCommands(object):
             # First, delete the function definition so that it is no longer associated with the greengrass group
             self._gg.delete_function_definition(
                 FunctionDefinitionId=self.state['FunctionDefinition']['Id'])
-            self.state.pop('FunctionDefinition')
-            _update_state(self.state)
+            with self._state_change('FunctionDefinition'):
+                self.state.pop('FunctionDefinition')
 
         # Delete the IAM role that is associated with the Lambda Function
         log.info("Deleting default lambda role '{0}'".format(self._LAMBDA_ROLE_NAME))
         self._remove_default_lambda_role()
-        self.state.pop('LambdaRole')
-        _update_state(self.state)
+        with self._state_change('LambdaRole'):
+            self.state.pop('LambdaRole')
 
         # If the lambda function was not previously defined when the group was created, then delete the lambda function
         # otherwise leave it alone
         for l in self.state['Lambdas']:
-            already_defined = ('already_defined' in l)
+            self._delete_function(l)
 
-            if not already_defined:
-                log.info("Deleting Lambda function '{0}'".format(l['FunctionName']))
-                self._lambda.delete_function(FunctionName=l['FunctionName'])
-                os.remove(l['ZipPath'])
-
-        self.state.pop('Lambdas')
-        _update_state(self.state)
+        with self._state_change('Lambdas'):
+            self.state.pop('Lambdas')
 
         log.info("Lambdas and function definition deleted OK!")
 
+    # Delete the lambda function, unless it was defined before the group was created
+    def _delete_function(self, l):
+        already_defined = ('already_defined' in l)
+
+        if not already_defined:
+            log.info("Deleting Lambda function '{0}'".format(l['FunctionName']))
+            self._lambda.delete_function(FunctionName=l['FunctionName'])
+            packaging.remove_package(
+                l['FunctionName'], os.path.dirname(l['ZipPath']))
+
     # Create a subscription so that the cores/cloud/resources/other knows which messages it should be listening for
     def create_subscriptions(self, update_group_version=True):
         if not self.group.get('Subscriptions'):
@@ -472,16 +959,7 @@ class GroupCommands(object):
 
         # Create a list of all of the subscriptions that need to be created
         log.debug("Preparing subscription list...")
-        subs = []
-        for i, s in enumerate(self.group['Subscriptions']):
-            log.debug("Subscription '{0}' - '{1}': {2}->{3}'".format(
-                i, s['Subject'], s['Source'], s['Target']))
-            subs.append({
-                'Id': str(i),
-                'Source': self._resolve_subscription_destination(s['Source']),
-                'Target': self._resolve_subscription_destination(s['Target']),
-                'Subject': s['Subject']
-            })
+        subs = self._subscription_list()
         log.debug("Subscription list is ready:\n{0}".format(pretty(subs)))
 
         # Create a subscription definition with the lsit of the subscriptions generated above
@@ -491,16 +969,16 @@ class GroupCommands(object):
             InitialVersion={'Subscriptions': subs}
         )
 
-        self.state['Subscriptions'] = rinse(sub_def)
-        _update_state(self.state)
+        with self._state_change('Subscriptions'):
+            self.state['Subscriptions'] = rinse(sub_def)
 
         # Get the subscription definition version so that we can save it in the state file
         sub_def_ver = self._gg.get_subscription_definition_version(
             SubscriptionDefinitionId=self.state['Subscriptions']['Id'],
             SubscriptionDefinitionVersionId=self.state['Subscriptions']['LatestVersion'])
 
-        self.state['Subscriptions']['LatestVersionDetails'] = rinse(sub_def_ver)
-        _update_state(self.state)
+        with self._state_change('Subscriptions'):
+            self.state['Subscriptions']['LatestVersionDetails'] = rinse(sub_def_ver)
 
         # if we need to update the group version, do that
         if update_group_version:
@@ -509,6 +987,21 @@ class GroupCommands(object):
 
         log.info("Subscription definition created OK!")
 
+    # Subscriptions of the definition file, with sources and targets resolved to ARNs
+    def _subscription_list(self):
+        arns = self._destination_arns()
+        subs = []
+        for i, s in enumerate(self.group['Subscriptions']):
+            log.debug("Subscription '{0}' - '{1}': {2}->{3}'".format(
+                i, s['Subject'], s['Source'], s['Target']))
+            subs.append({
+                'Id': str(i),
+                'Source': self._resolve_subscription_destination(s['Source'], arns),
+                'Target': self._resolve_subscription_destination(s['Target'], arns),
+                'Subject': s['Subject']
+            })
+        return subs
+
     # Remove all of the subscriptions
     def remove_subscriptions(self):
         if not (self.state and self.state.get('Subscriptions')):
@@ -522,54 +1015,38 @@ class GroupCommands(object):
             SubscriptionDefinitionId=self.state['Subscriptions']['Id'])
 
         # Remove subscriptions from the state file
-        self.state.pop('Subscriptions')
-        _update_state(self.state)
+        with self._state_change('Subscriptions'):
+            self.state.pop('Subscriptions')
         log.info("Subscription definition deleted OK!")
 
-    # Modify the subscription services from the config file to official AWS names
-    def _resolve_subscription_destination(self, d):
+    # Modify the subscription services from the config file to official AWS names.
+    # arns: see _destination_arns()
+    def _resolve_subscription_destination(self, d, arns):
         p = [x.strip() for x in d.split('::')]
-        if p[0] == 'cloud':
+        if len(p) == 1 and p[0] in ('cloud', 'GGShadowService'):
             return p[0]
-        elif p[0] == 'Lambda':
-            return self._lookup_lambda_qualified_arn(p[1])
-        elif p[0] == 'Device':
-            return self._lookup_device_arn(p[1])
-        elif p[0] == 'GGShadowService':
-            return p[0]
-        elif p[0] == 'Connector':
-            return self._lookup_connector_arn(p[1])
-        else:
-            raise ValueError(
-                "Error parsing subscription destination '{0}'. Allowed values: "
-                "'Lambda::', 'Device::', 'Connector::', 'GGShadowService', or 'cloud'.".format(d))
-
-    # Get the Lambda ARN
-    def _lookup_lambda_qualified_arn(self, name):
-        details = self.state['FunctionDefinition']['LatestVersionDetails']
-        for l in details['Definition']['Functions']:
-            if l['Id'] == name:
-                return l['FunctionArn']
-        log.error("Lambda '{0}' not found".format(name))
-        return None
-
-    # Get the Device ARN
-    def _lookup_device_arn(self, name):
-        details = self.state['DeviceDefinition']['LatestVersionDetails']
-        for l in details['Definition']['Devices']:
-            if l['Id'] == name:
-                return l['ThingArn']
-        log.error("Device '{0}' not found".format(name))
-        return None
-
-    # Get the Connector ARN
-    def _lookup_connector_arn(self, name):
-        details = self.state['Connectors']['LatestVersionDetails']
-        for l in details['Definition']['Connectors']:
-            if l['Id'] == name:
-                return l['ConnectorArn']
-        log.error("Connector '{0}' not found".format(name))
-        return None
+        if len(p) == 2 and p[0] in arns:
+            arn = arns[p[0]].get(p[1])
+            if arn is None:
+                raise ValueError(
+                    "Subscription destination '{0}': {1} '{2}' not found in the group. "
+                    "Known: {3}".format(d, p[0], p[1], ', '.join(sorted(arns[p[0]])) or 'none'))
+            return arn
+        raise ValueError(
+            "Error parsing subscription destination '{0}'. Allowed values: "
+            "'Lambda::', 'Device::', 'Connector::', 'GGShadowService', or 'cloud'.".format(d))
+
+    # ARNs of the lambdas, devices and connectors of the group, by the kind and
+    # name used in subscriptions: {'Lambda': {name: ARN}, ...}
+    def _destination_arns(self):
+        return {
+            'Lambda': dict((f['Id'], f['FunctionArn'])
+                           for f in self._deployed_definition('FunctionDefinition')),
+            'Device': dict((d['Id'], d['ThingArn'])
+                           for d in self._deployed_definition('DeviceDefinition')),
+            'Connector': dict((c['Id'], c['ConnectorArn'])
+                              for c in self._deployed_definition('Connectors')),
+        }
 
     # Create Resources (specifically those like AI/ML things)
     def create_resources(self):
@@ -584,14 +1061,7 @@ class GroupCommands(object):
 
 
         log.debug("Preparing Resources ...")
-        res = []
-        # Create the list of resources similar to the subscriptions list
-        for r in self.group['Resources']:
-            # Convert from a simplified form
-            resource = dict(Name=r.pop('Name'), Id=r.pop('Id'))
-            resource['ResourceDataContainer'] = r
-            res.append(resource)
-
+        res = self._resource_list()
         log.debug("Resources list is ready:\n{0}".format(pretty(res)))
 
         # Create the resource definition
@@ -602,19 +1072,30 @@ class GroupCommands(object):
             InitialVersion={'Resources': res}
         )
 
-        self.state['Resources'] = rinse(res_def)
-        _update_state(self.state)
+        with self._state_change('Resources'):
+            self.state['Resources'] = rinse(res_def)
 
         # Get the Resource Definition Version
         res_def_ver = self._gg.get_resource_definition_version(
             ResourceDefinitionId=self.state['Resources']['Id'],
             ResourceDefinitionVersionId=self.state['Resources']['LatestVersion'])
 
-        self.state['Resources']['LatestVersionDetails'] = rinse(res_def_ver)
-        _update_state(self.state)
+        with self._state_change('Resources'):
+            self.state['Resources']['LatestVersionDetails'] = rinse(res_def_ver)
 
         log.info("Resources definition created OK!")
 
+    # Create the list of resources similar to the subscriptions list
+    def _resource_list(self):
+        res = []
+        for r in self.group['Resources']:
+            # Convert from a simplified form
+            resource = dict(Name=r['Name'], Id=r['Id'])
+            resource['ResourceDataContainer'] = dict(
+                (k, v) for k, v in r.items() if k not in ('Name', 'Id'))
+            res.append(resource)
+        return res
+
     # Remove all of the current resources
     def remove_resources(self):
         if not (self.state and self.state.get('Resources')):
@@ -628,8 +1109,8 @@ class GroupCommands(object):
         self._gg.delete_resource_definition(
             ResourceDefinitionId=self.state['Resources']['Id'])
 
-        self.state.pop('Resources')
-        _update_state(self.state)
+        with self._state_change('Resources'):
+            self.state.pop('Resources')
         log.info("Resources definition deleted OK!")
 
     # Create loggers to gather data
@@ -658,16 +1139,16 @@ class GroupCommands(object):
             InitialVersion={'Loggers': loggers}
         )
 
-        self.state['Loggers'] = rinse(res_def)
-        _update_state(self.state)
+        with self._state_change('Loggers'):
+            self.state['Loggers'] = rinse(res_def)
 
         # Get the logger definition so that we can save needed data in the state file
         log_def_ver = self._gg.get_logger_definition_version(
             LoggerDefinitionId=self.state['Loggers']['Id'],
             LoggerDefinitionVersionId=self.state['Loggers']['LatestVersion'])
 
-        self.state['Loggers']['LatestVersionDetails'] = rinse(log_def_ver)
-        _update_state(self.state)
+        with self._state_change('Loggers'):
+            self.state['Loggers']['LatestVersionDetails'] = rinse(log_def_ver)
 
         log.info("Loggers definition created OK!")
 
@@ -683,8 +1164,8 @@ class GroupCommands(object):
         self._gg.delete_logger_definition(
             LoggerDefinitionId=self.state['Loggers']['Id'])
 
-        self.state.pop('Loggers')
-        _update_state(self.state)
+        with self._state_change('Loggers'):
+            self.state.pop('Loggers')
         log.info("Loggers definition deleted OK!")
 
     # TODO: REFACTOR.
@@ -707,15 +1188,15 @@ class GroupCommands(object):
             InitialVersion={'Connectors': connectors}
         )
 
-        self.state['Connectors'] = rinse(d)
-        _update_state(self.state)
+        with self._state_change('Connectors'):
+            self.state['Connectors'] = rinse(d)
 
         d_ver = self._gg.get_connector_definition_version(
             ConnectorDefinitionId=self.state['Connectors']['Id'],
             ConnectorDefinitionVersionId=self.state['Connectors']['LatestVersion'])
 
-        self.state['Connectors']['LatestVersionDetails'] = rinse(d_ver)
-        _update_state(self.state)
+        with self._state_change('Connectors'):
+            self.state['Connectors']['LatestVersionDetails'] = rinse(d_ver)
 
         if update_group_version:
             log.info("Updating group version with new Connectors...")
@@ -735,74 +1216,384 @@ class GroupCommands(object):
         self._gg.delete_connector_definition(
             ConnectorDefinitionId=self.state['Connectors']['Id'])
 
-        self.state.pop('Connectors')
-        _update_state(self.state)
+        with self._state_change('Connectors'):
+            self.state.pop('Connectors')
         log.info("Connectors definition deleted OK!")
 
-    # Update everything by removing all of the subscriptions, lambdas and resources and then re-adding them to the GreenGrass Group
+    # Bring the group in line with the definition file. Only the components
+    # which differ from the group state are created, updated or removed.
     def update(self):
-        self.remove_subscriptions()
-        self.remove_lambdas()
-        self.remove_resources()
-        # self.remove_devices()
-        self.create_resources()
-        self.create_lambdas()
-        self.create_subscriptions()
+        if not self.state:
+            log.info("There is nothing to update. Do create first.")
+            return
+        if self.validate() is False:
+            return False
+
+        changes = self._plan()
+        if not changes:
+            log.info("Group is up to date with '{0}'. Nothing to update.".format(
+                self._definition_file))
+            return
+        _log_plan(changes, self._definition_file)
+
+        creates = {
+            'Resources': self.create_resources,
+            'Connectors': functools.partial(self.create_connectors, update_group_version=False),
+            'Subscriptions': functools.partial(
+                self.create_subscriptions, update_group_version=False),
+            'Loggers': self.create_loggers,
+        }
+        removes = {
+            'Resources': self.remove_resources,
+            'Connectors': self.remove_connectors,
+            'Subscriptions': self.remove_subscriptions,
+            'Loggers': self.remove_loggers,
+        }
+        # Items are resolved only when needed: subscriptions refer to
+        # lambdas and connectors that may have just been created.
+        items = {
+            'Resources': self._resource_list,
+            'Connectors': lambda: self.group['Connectors'],
+            'Subscriptions': self._subscription_list,
+            'Loggers': lambda: self.group['Loggers'],
+        }
+
+        # Subscriptions go after lambdas and connectors they refer to
+        for component in ['Resources', 'Lambdas', 'Connectors', 'Subscriptions', 'Loggers']:
+            component_changes = [c for c in changes if c[0] == component]
+            if not component_changes:
+                continue
+
+            action = component_changes[0][1]
+            if component == 'Lambdas':
+                self._update_lambdas(component_changes)
+            elif action == 'create':
+                creates[component]()
+            elif action == 'remove':
+                removes[component]()
+            else:
+                self._create_definition_version(component, items[component]())
 
         self.create_group_version()
 
         log.info('Updated on Greengrass! Execute "greengo deploy" to apply')
 
-    # Create and generate associated structures for non-core Devices
-    # that will connect to the core.
-    def _create_devices(self, update_group_version=True):
-        # TODO: Refactor-handle state internally, make callable individually
-        #       Maybe reflet dependency tree in self.group/greensgo.yaml and travel it
-        self.state['Devices'] = []
-        devices = []
-        initial_version = {'Devices': []}
+    # Show what "greengo update" would change, without changing anything
+    def plan(self):
+        if not self.state:
+            log.info("There is nothing to update. Do create first.")
+            return
+        if self.validate() is False:
+            return False
 
-        for device_description in self.group['Devices']:
-            try:
-                # Create the IOT thing and get the certificates
-                name = device_description['name']
-                log.info("Creating a thing for core {0}".format(name))
-                keys_cert = rinse(self._iot.create_keys_and_certificate(setAsActive=True))
-                device_thing = rinse(self._iot.create_thing(thingName=name))
-
-                # Attach the previously created Certificate to the created Thing
-                self._iot.attach_thing_principal(
-                    thingName=name, principal=keys_cert['certificateArn'])
-                policy = self._create_and_attach_thing_policy(
-                    thing_name=name,
-                    policy_doc=self._create_device_policy(),
-                    thing_cert_arn=keys_cert['certificateArn']
-                )
+        changes = self._plan()
+        if not changes:
+            log.info("Group is up to date with '{0}'. Nothing to update.".format(
+                self._definition_file))
+            return
+        _log_plan(changes, self._definition_file)
+
+    # Show what the group state holds. With drift, also check the state against
+    # AWS, with a few paginated list calls run concurrently, instead of a call
+    # per part of the group. Returns False if anything has drifted.
+    def status(self, drift=False):
+        if not self.state.get('Group'):
+            log.info("Group {0} is not created".format(self.name))
+            return
+        log.info("Group {0}, Id {1}".format(self.name, self.state['Group']['Id']))
+        checkpoints = self.state.get('Checkpoints')
+        if checkpoints and 'group_version' not in checkpoints:
+            log.info("--- creation incomplete, done: {0}. Run resume.".format(
+                ', '.join(checkpoints)))
+        log.info("--- {0}".format(', '.join("{0}: {1}".format(key, len(self.state.get(key, [])))
+                                          for key in ['Cores', 'Devices', 'Lambdas'])))
+        deployment = self.state.get('Deployment')
+        if deployment:
+            log.info("--- deployment {0}: {1}".format(
+                deployment['DeploymentId'],
+                deployment.get('Status', {}).get('DeploymentStatus', 'Unknown')))
+        if not drift:
+            return
 
-                # Add all of the relevant data to the devices list for the state update
-                devices.append({
-                    'name': name,
-                    'thing': device_thing,
-                    'keys': keys_cert,
-                    'policy': policy
-                })
+        problems = self._drift()
+        if not problems:
+            log.info("No drift: the group state matches AWS")
+            return True
+        log.info("Drift of the group state from AWS:")
+        for component, problem, name in problems:
+            log.info("--- {0} '{1}': {2}".format(component, name, problem))
+        return False
+
+    # Match the group state against what AWS lists.
+    # Returns the differences as (component, problem, name).
+    def _drift(self):
+        things = self.state.get('Cores', []) + self.state.get('Devices', [])
+        definitions = [key for key in sorted(DEFINITION_APIS) if self.state.get(key)]
+        names = ['groups'] + definitions
+        if things:
+            names += ['things', 'certificates', 'policies']
+        if self.state.get('Lambdas'):
+            names += ['functions']
+        lists = dict(zip(names, _pmap(self._list_all, names, self._workers)))
+
+        drift = []
+        groups = dict((g['Id'], g) for g in lists['groups'])
+        group = self.state['Group']
+        if group['Id'] not in groups:
+            drift.append(('Group', 'missing', group['Id']))
+        elif 'Version' in group and groups[group['Id']].get('LatestVersion') != \
+                group['Version']['Version']:
+            drift.append(('Group', 'version changed', group['Id']))
+
+        for key in definitions:
+            deployed = dict((d['Id'], d) for d in lists[key])
+            definition = self.state[key]
+            if definition['Id'] not in deployed:
+                drift.append((key, 'missing', definition['Id']))
+            elif deployed[definition['Id']].get('LatestVersion') != definition['LatestVersion']:
+                drift.append((key, 'version changed', definition['Id']))
+
+        if things:
+            thing_names = set(t['thingName'] for t in lists['things'])
+            statuses = dict((c['certificateId'], c['status']) for c in lists['certificates'])
+            policies = set(p['policyName'] for p in lists['policies'])
+            for t in things:
+                if 'thing' in t and t['thing']['thingName'] not in thing_names:
+                    drift.append(('Thing', 'missing', t['thing']['thingName']))
+                if 'keys' not in t:
+                    continue
+                cert_id = t['keys']['certificateId']
+                if cert_id not in statuses:
+                    drift.append(('Certificate', 'missing', cert_id))
+                elif statuses[cert_id] != 'ACTIVE':
+                    drift.append(('Certificate', statuses[cert_id], cert_id))
+            # Things may share policies
+            for name in sorted(set(t['policy']['policyName'] for t in things if 'policy' in t)):
+                if name not in policies:
+                    drift.append(('Policy', 'missing', name))
+
+        if self.state.get('Lambdas'):
+            functions = set(f['FunctionName'] for f in lists['functions'])
+            for lr in self.state['Lambdas']:
+                if lr['FunctionName'] not in functions:
+                    drift.append(('Lambda', 'missing', lr['FunctionName']))
+        return drift
+
+    # All the items of a paginated list call, see LIST_APIS
+    def _list_all(self, name):
+        service, operation, items_key, token_arg, token_key, page = LIST_APIS[name]
+        call = getattr(self._clients.get(service), operation)
+        items = []
+        kwargs = dict(page)
+        while True:
+            response = call(**kwargs)
+            items += response.get(items_key, [])
+            if not response.get(token_key):
+                return items
+            kwargs[token_arg] = response[token_key]
+
+    # Diff the definition file against the group state.
+    # Returns the list of changes as (component, action, name).
+    def _plan(self):
+        changes = []
+        changes += self._plan_definition(
+            'Resources', self.group.get('Resources') and self._resource_list())
+        changes += self._plan_lambdas()
+        changes += self._plan_definition('Connectors', self.group.get('Connectors'))
+        subscription_changes = self._plan_definition(
+            'Subscriptions', self.group.get('Subscriptions') and self._subscription_spec(),
+            deployed=self._deployed_subscription_spec())
+        # The subscriptions are the same by name, but a lambda they refer to
+        # gets a new ARN: they need resolving again
+        if not subscription_changes and self.state.get('Subscriptions') and \
+                self._lambda_arns_change(changes):
+            subscription_changes = [('Subscriptions', 'update', None)]
+        changes += subscription_changes
+        changes += self._plan_definition('Loggers', self.group.get('Loggers'))
+        return changes
+
+    # Whether the lambda changes give a lambda the subscriptions refer to another ARN
+    def _lambda_arns_change(self, changes):
+        names = set('Lambda::' + n for c, a, n in changes
+                    if c == 'Lambdas' and a in ('add', 'replace', 'delete'))
+        return any(source in names or target in names
+                   for source, _, target in self._subscription_spec())
+
+    def _plan_definition(self, key, desired, deployed=None):
+        if not desired:
+            return [(key, 'remove', None)] if self.state.get(key) else []
+        if not self.state.get(key):
+            return [(key, 'create', None)]
+        if deployed is None:
+            deployed = self._deployed_definition(key)
+        return [(key, 'update', None)] if desired != deployed else []
+
+    def _plan_lambdas(self):
+        if not self.group.get('Lambdas'):
+            return [('Lambdas', 'remove', None)] if self.state.get('Lambdas') else []
+        if not self.state.get('FunctionDefinition'):
+            return [('Lambdas', 'create', None)]
 
-                # Save the details pertaining to the certificate linked with the thing ARN
-                initial_version['Devices'].append({
-                    'Id': name,
-                    'CertificateArn': keys_cert['certificateArn'],
-                    'SyncShadow': device_description['SyncShadow'],
-                    'ThingArn': device_thing['thingArn']
-                })
+        deployed = dict((f['Id'], f) for f in self._deployed_definition('FunctionDefinition'))
+        functions = dict((lr['FunctionName'], lr) for lr in self.state.get('Lambdas', []))
+        changes = []
+        for l in self.group['Lambdas']:
+            name = l['name']
+            f = deployed.get(name)
+            if not (f and name in functions):
+                changes.append(('Lambdas', 'add', name))
+            elif not f['FunctionArn'].endswith(':' + l.get('alias', 'default')):
+                changes.append(('Lambdas', 'replace', name))
+            else:
+                if f['FunctionConfiguration'] != l['greengrassConfig']:
+                    changes.append(('Lambdas', 'update-config', name))
+                if 'handler' in l and self._package_changed(
+                        l, functions[name].get('CodeSha256')):
+                    changes.append(('Lambdas', 'update-code', name))
+
+        names = set(l['name'] for l in self.group['Lambdas'])
+        for name in sorted(set(deployed) | set(functions)):
+            if name not in names:
+                changes.append(('Lambdas', 'delete', name))
+        return changes
+
+    # Apply the changes to Lambdas planned by _plan_lambdas()
+    def _update_lambdas(self, changes):
+        actions = dict((action, [n for c, a, n in changes if a == action])
+                       for action in ['create', 'remove', 'add', 'replace', 'delete',
+                                      'update-config', 'update-code'])
+        if actions['create']:
+            self.create_lambdas(update_group_version=False)
+            return
+        if actions['remove']:
+            self.remove_lambdas()
+            return
 
-                # Save the certificates in the appropriate location
-                _save_keys(device_description['key_path'], name, keys_cert)
+        deployed = dict((f['Id'], f) for f in self._deployed_definition('FunctionDefinition'))
+        for name in actions['delete']:
+            lr = next((lr for lr in self.state['Lambdas'] if lr['FunctionName'] == name), None)
+            if lr:
+                self._delete_function(lr)
+                with self._state_change('Lambdas'):
+                    self.state['Lambdas'].remove(lr)
 
-            except Exception as e:
-                log.error("Error creating device {0}: {1}".format(name, str(e)))
-                # Continue with other devices if any
-        self.state['Devices'] = devices
-        _update_state(self.state)
+        self._update_lambda_codes(actions['update-code'])
+
+        created = {}
+        for l in self.group['Lambdas']:
+            if l['name'] in actions['add']:
+                created[l['name']] = self._create_lambda(l)
+            elif l['name'] in actions['replace']:
+                created[l['name']] = self._replace_lambda_alias(l, deployed[l['name']])
+
+        if created or actions['delete'] or actions['update-config']:
+            functions = [created.get(l['name']) or dict(
+                deployed[l['name']], FunctionConfiguration=l['greengrassConfig'])
+                for l in self.group['Lambdas']]
+            self._create_definition_version('FunctionDefinition', functions)
+
+    # Point the group to another alias of the lambda function, made or moved to
+    # the version of the function in the state, instead of making the function
+    # anew. The old alias goes away, unless the function was defined before the
+    # group. f: the function entry of the deployed function definition.
+    # Returns the new function entry.
+    def _replace_lambda_alias(self, l, f):
+        lr = next(lr for lr in self.state['Lambdas'] if lr['FunctionName'] == l['name'])
+        name = l.get('alias', 'default')
+        log.info("Moving lambda function '{0}' to alias '{1}'".format(l['name'], name))
+
+        if lr.get('already_defined'):
+            alias = self._lambda.get_alias(FunctionName=l['name'], Name=name)
+        else:
+            try:
+                alias = self._lambda.create_alias(
+                    FunctionName=l['name'],
+                    Name=name,
+                    FunctionVersion=lr['Version'],
+                    Description='Created by greengo'
+                )
+            except exceptions.ClientError as e:
+                if e.response['Error']['Code'] != 'ResourceConflictException':
+                    raise
+                alias = self._lambda.update_alias(
+                    FunctionName=l['name'], Name=name, FunctionVersion=lr['Version'])
+            self._lambda.delete_alias(
+                FunctionName=l['name'], Name=f['FunctionArn'].rsplit(':', 1)[-1])
+
+        log.info("Lambda alias ready. FunctionVersion:'{0}', Arn:'{1}'".format(
+            alias['FunctionVersion'], alias['AliasArn']))
+        return {
+            'Id': l['name'],
+            'FunctionArn': alias['AliasArn'],
+            'FunctionConfiguration': l['greengrassConfig']
+        }
+
+    # Items of the latest version of a Greengrass definition in the group state
+    def _deployed_definition(self, key):
+        kind, items = DEFINITION_APIS[key]
+        details = self.state.get(key, {}).get('LatestVersionDetails', {})
+        return details.get('Definition', {}).get(items, [])
+
+    # Create a new version of an existing Greengrass definition
+    def _create_definition_version(self, key, items):
+        kind, items_key = DEFINITION_APIS[key]
+        definition_id = kind.capitalize() + 'DefinitionId'
+        definition = self.state[key]
+        log.info("Creating new version of {0} definition '{1}'".format(kind, definition['Name']))
+
+        version = rinse(getattr(self._gg, 'create_{0}_definition_version'.format(kind))(
+            **{definition_id: definition['Id'], items_key: items}))
+        definition['LatestVersion'] = version['Version']
+        definition['LatestVersionArn'] = version['Arn']
+        self._update_state(key)
+
+        details = getattr(self._gg, 'get_{0}_definition_version'.format(kind))(
+            **{definition_id: definition['Id'],
+               kind.capitalize() + 'DefinitionVersionId': version['Version']})
+        definition['LatestVersionDetails'] = rinse(details)
+        self._update_state(key)
+
+    # Subscriptions of the definition file, as (source, subject, target)
+    def _subscription_spec(self):
+        return [(_normalize_destination(s['Source']), s['Subject'],
+                 _normalize_destination(s['Target']))
+                for s in self.group['Subscriptions']]
+
+    # Subscriptions in the group state, as (source, subject, target)
+    # with ARNs mapped back to the names used in the definition file
+    def _deployed_subscription_spec(self):
+        names = {}
+        for kind, arns in self._destination_arns().items():
+            for name, arn in arns.items():
+                names[arn] = '{0}::{1}'.format(kind, name)
+        return [(names.get(s['Source'], s['Source']), s['Subject'],
+                 names.get(s['Target'], s['Target']))
+                for s in self._deployed_definition('Subscriptions')]
+
+    # Create and generate associated structures for non-core Devices
+    # that will connect to the core.
+    def _create_devices(self, update_group_version=True):
+        # TODO: Refactor-handle state internally, make callable individually
+        #       Maybe reflet dependency tree in self.group/greensgo.yaml and travel it
+        # Devices already in the state were made by an interrupted create, see resume
+        with self._state_change('Devices'):
+            self.state['Devices'] = self.state.get('Devices') or []
+
+        # Provision devices concurrently, or all at once with bulk registration.
+        # A device failing fails the step, once the others are done.
+        if self.group.get('BulkRegistration'):
+            new = [d for d in self.group['Devices'] if not self._thing_state('Devices', d['name'])]
+            if new:
+                self._register_devices(new)
+        else:
+            csrs = self._create_csrs(self._things_to_key('Devices', self.group['Devices']))
+            _pmap(lambda d: self._create_device(d, csrs.get(d['name'])),
+                  self.group['Devices'], self._workers)
+        devices = self._provisioned_things('device', 'Devices', self.group['Devices'])
+
+        # The device definition is in the order of the definition file, deterministic
+        initial_version = {'Devices': [
+            _thing_definition(d, device) for d, device in zip(self.group['Devices'], devices)]}
         log.debug("Creating Device definition with InitialVersion={0}".format(
             initial_version))
 
@@ -812,8 +1603,8 @@ class GroupCommands(object):
             InitialVersion=initial_version
         ))
 
-        self.state['DeviceDefinition'] = device_def
-        _update_state(self.state)
+        with self._state_change('DeviceDefinition'):
+            self.state['DeviceDefinition'] = device_def
         log.info("Created Device definition Arn:{0} Id:{1}".format(
             device_def['Arn'], device_def['Id']))
 
@@ -822,12 +1613,8 @@ class GroupCommands(object):
             DeviceDefinitionId=self.state['DeviceDefinition']['Id'],
             DeviceDefinitionVersionId=self.state['DeviceDefinition']['LatestVersion'])
 
-        self.state['DeviceDefinition']['LatestVersionDetails'] = rinse(device_ver)
-        _update_state(self.state)
-
-        self.state['Devices'] = devices
-
-        _update_state(self.state)
+        with self._state_change('DeviceDefinition'):
+            self.state['DeviceDefinition']['LatestVersionDetails'] = rinse(device_ver)
 
         # Create a new group version if needed
         if update_group_version:
@@ -835,108 +1622,264 @@ class GroupCommands(object):
             self.create_group_version()
         log.info("Devices and definition created OK!")
 
+    # Create the thing, certificate and policy for a single device.
+    # csr: of the device key, generated locally, see _create_csrs.
+    # Errors are logged, see _provisioned_things.
+    def _create_device(self, device_description, csr=None):
+        try:
+            self._provision_thing('Devices', device_description, csr, self._create_device_policy)
+        except Exception as e:
+            log.error("Error creating device {0}: {1}".format(
+                device_description.get('name'), str(e)))
+            # Continue with other devices if any
+
+    # Create the certificate, thing and policy of a core or a device, carrying on
+    # from what an interrupted create left in the state. Each of them goes to the
+    # state, under key, 'Cores' or 'Devices', as soon as it's made, so resume
+    # never makes it twice. policy_doc: makes the policy document.
+    # Returns the state of the thing.
+    def _provision_thing(self, key, description, csr, policy_doc):
+        name = description['name']
+        with self._state_change(key):
+            thing = self._thing_state(key, name)
+            if thing is None:
+                thing = {'name': name}
+                self.state[key].append(thing)
+        if all(part in thing for part in THING_PARTS):
+            log.info("Thing {0} exists, reusing it".format(name))
+            return thing
+
+        if 'keys' not in thing:
+            log.info("Creating a thing for {0} {1}".format(key[:-1].lower(), name))
+            keys_cert = self._create_keys_and_certificate(csr)
+            with self._state_change(key):
+                thing['keys'] = keys_cert
+        # Save the certificates in the appropriate location
+        _save_keys(description['key_path'], name, thing['keys'])
+
+        if 'thing' not in thing:
+            iot_thing = rinse(self._iot.create_thing(thingName=name))
+            with self._state_change(key):
+                thing['thing'] = iot_thing
+
+        if 'policy' not in thing:
+            # Attach the previously created Certificate to the created Thing
+            self._iot.attach_thing_principal(
+                thingName=name, principal=thing['keys']['certificateArn'])
+            policy = self._create_and_attach_thing_policy(
+                thing_name=name,
+                policy_doc=policy_doc(),
+                thing_cert_arn=thing['keys']['certificateArn']
+            )
+            with self._state_change(key):
+                thing['policy'] = policy
+        return thing
+
+    # The state of the core or device thing of that name, None if there is none
+    def _thing_state(self, key, name):
+        return next((t for t in self.state.get(key) or [] if t['name'] == name), None)
+
+    # The things without keys yet, to generate keys for
+    def _things_to_key(self, key, things):
+        return [t for t in things if 'keys' not in (self._thing_state(key, t['name']) or {})]
+
+    # Once the things of a step are provisioned, put their state in the order of
+    # the definition file and return it. Fails the step if any thing is missing
+    # a part, for resume to make it.
+    def _provisioned_things(self, kind, key, descriptions):
+        order = dict((d['name'], i) for i, d in enumerate(descriptions))
+        with self._state_change(key):
+            self.state[key].sort(key=lambda t: order.get(t['name'], len(order)))
+        things = [self._thing_state(key, d['name']) for d in descriptions]
+        failed = [d['name'] for d, t in zip(descriptions, things)
+                  if not (t and all(part in t for part in THING_PARTS))]
+        if failed:
+            raise Exception("Failed to create {0}s {1}".format(kind, ', '.join(failed)))
+        return things
+
+    # Type of the thing keys to generate locally, certs.key_type; None to
+    # have AWS IoT generate them
+    def _key_type(self):
+        return (self.group.get('certs') or {}).get('key_type')
+
+    # With a key type set, generate the keys of the things, cores or devices,
+    # into their key_path, and return their CSRs by thing name. Else return none.
+    def _create_csrs(self, things):
+        if not self._key_type() or not things:
+            return {}
+        log.info("Generating {0} keys for {1} things".format(self._key_type(), len(things)))
+        csrs = keys.create_csrs([(t['key_path'], t['name']) for t in things], self._key_type())
+        return dict((t['name'], csr) for t, csr in zip(things, csrs))
+
+    # Create an active certificate for a thing. With the CSR of a key generated
+    # locally, the private key never leaves the machine. Else AWS IoT generates
+    # the keys and returns them along with the certificate.
+    def _create_keys_and_certificate(self, csr=None):
+        if csr is None:
+            return rinse(self._iot.create_keys_and_certificate(setAsActive=True))
+        return rinse(self._iot.create_certificate_from_csr(
+            certificateSigningRequest=csr, setAsActive=True))
+
+    # Register the devices with a single IoT bulk registration task, instead of
+    # the 4+ calls a device takes with _create_device. The keys are generated
+    # here, only the CSRs are sent. The devices share one policy.
+    # Each registered device goes to the state, as _create_device does.
+    def _register_devices(self, descriptions):
+        bulk = self.group['BulkRegistration']
+        if self.group.get('SharedPolicies'):
+            policy = self._shared_policy(self._create_device_policy())
+        else:
+            policy = self._create_policy(
+                "{0}-device-policy".format(self.name), self._create_device_policy())
+
+        log.info("Generating keys for {0} devices".format(len(descriptions)))
+        csrs = keys.create_csrs([(d['key_path'], d['name']) for d in descriptions],
+                                self._key_type() or keys.KEY_TYPE)
+        input_key = "{0}{1}-devices-{2}.json".format(
+            bulk.get('S3Prefix', ''), self.name, int(time()))
+        self._clients.get('s3').put_object(
+            Bucket=bulk['S3Bucket'], Key=input_key,
+            Body='\n'.join(json.dumps({'ThingName': d['name'], 'CSR': csr})
+                           for d, csr in zip(descriptions, csrs)).encode('utf-8'))
+
+        task_id = self._iot.start_thing_registration_task(
+            templateBody=json.dumps(self._registration_template(policy['policyName'])),
+            inputFileBucket=bulk['S3Bucket'],
+            inputFileKey=input_key,
+            roleArn=bulk['RoleArn'])['taskId']
+        log.info("Started registration task '{0}' for s3://{1}/{2}".format(
+            task_id, bulk['S3Bucket'], input_key))
+
+        task = {}
+
+        def done():
+            task.update(self._iot.describe_thing_registration_task(taskId=task_id))
+            return task['status'] in REGISTRATION_DONE
+
+        if not _wait_for(done, timeout=REGISTRATION_TIMEOUT, delay=1, max_delay=10):
+            raise Exception("Registration task '{0}' is not done in {1} seconds".format(
+                task_id, REGISTRATION_TIMEOUT))
+        log.info("Registration task '{0}' {1}: {2} registered, {3} failed".format(
+            task_id, task['status'], task.get('successCount'), task.get('failureCount')))
+
+        for line in self._registration_report(task_id, 'ERRORS'):
+            log.error("Error registering device: {0}".format(line))
+
+        registered = {}
+        for line in self._registration_report(task_id, 'RESULTS'):
+            arns = line['response']['ResourceArns']
+            registered[arns['thing'].split('/')[-1]] = (arns, line['response']['CertificatePem'])
+
+        for d in descriptions:
+            if d['name'] not in registered:
+                continue  # The error is logged above, the step fails
+            arns, pem = registered[d['name']]
+            keys_cert = {
+                'certificateArn': arns['certificate'],
+                'certificateId': arns['certificate'].split('/')[-1],
+                'certificatePem': pem,
+            }
+            _save_keys(d['key_path'], d['name'], keys_cert)
+            with self._state_change('Devices'):
+                self.state['Devices'].append({
+                    'name': d['name'],
+                    'thing': {'thingName': d['name'], 'thingArn': arns['thing']},
+                    'keys': keys_cert,
+                    'policy': policy
+                })
+
+    # Provisioning template of a bulk registration: a thing, its certificate
+    # from the CSR, and the policy attached to the certificate.
+    def _registration_template(self, policy_name):
+        return {
+            'Parameters': {
+                'ThingName': {'Type': 'String'},
+                'CSR': {'Type': 'String'},
+            },
+            'Resources': {
+                'thing': {
+                    'Type': 'AWS::IoT::Thing',
+                    'Properties': {'ThingName': {'Ref': 'ThingName'}},
+                },
+                'certificate': {
+                    'Type': 'AWS::IoT::Certificate',
+                    'Properties': {'CertificateSigningRequest': {'Ref': 'CSR'}, 'Status': 'ACTIVE'},
+                },
+                'policy': {
+                    'Type': 'AWS::IoT::Policy',
+                    'Properties': {'PolicyName': policy_name},
+                },
+            },
+        }
+
+    # Lines of the RESULTS or ERRORS report of a registration task, read as
+    # they are downloaded. A report can be split in several files.
+    def _registration_report(self, task_id, report_type):
+        kwargs = {}
+        while True:
+            page = self._iot.list_thing_registration_task_reports(
+                taskId=task_id, reportType=report_type, **kwargs)
+            for link in page.get('resourceLinks', []):
+                f = urlopen(link)
+                try:
+                    for line in f:
+                        if line.strip():
+                            yield json.loads(line.decode('utf-8'))
+                finally:
+                    f.close()
+            if not page.get('nextToken'):
+                return
+            kwargs['nextToken'] = page['nextToken']
+
     def _create_cores(self):
         # TODO: Refactor-handle state internally, make callable individually
         #       Maybe reflet dependency tree in self.group/greensgo.yaml and travel it
-        self.state['Cores'] = []
-        _update_state(self.state)
-        cores = []
-        initial_version = {'Cores': []}
+        # Cores already in the state were made by an interrupted create, see resume
+        with self._state_change('Cores'):
+            self.state['Cores'] = self.state.get('Cores') or []
+        csrs = self._create_csrs(self._things_to_key('Cores', self.group['Cores']))
 
         for core in self.group['Cores']:
+            name = core['name']
             try:
                 # Create the core and get the certificates
-                name = core['name']
-                log.info("Creating a thing for core {0}".format(name))
-                keys_cert = rinse(self._iot.create_keys_and_certificate(setAsActive=True))
-                core_thing = rinse(self._iot.create_thing(thingName=name))
-
-                # Attach the previously created Certificate to the created Thing
-                self._iot.attach_thing_principal(
-                    thingName=name, principal=keys_cert['certificateArn'])
-                policy = self._create_and_attach_thing_policy(
-                    thing_name=name,
-                    policy_doc=self._create_core_policy(),
-                    thing_cert_arn=keys_cert['certificateArn']
-                )
-
-                # Append to list of the cores
                 # There should only be 1...
-                cores.append({
-                    'name': name,
-                    'thing': core_thing,
-                    'keys': keys_cert,
-                    'policy': policy
-                })
-
-                # Add the code to the initial_version list
-                # Again, there should only be 1...
-                initial_version['Cores'].append({
-                    'Id': name,
-                    'CertificateArn': keys_cert['certificateArn'],
-                    'SyncShadow': core['SyncShadow'],
-                    'ThingArn': core_thing['thingArn']
-                })
-
-                # Save the certificates and the config file used to run the core
-                _save_keys(core['key_path'], name, keys_cert)
+                core_thing = self._provision_thing(
+                    'Cores', core, csrs.get(name), self._create_core_policy)
 
-                self._create_ggc_config_file(core['config_path'], "config.json", core_thing)
+                # Save the config file used to run the core
+                self._create_ggc_config_file(core['config_path'], "config.json",
+                                             core_thing['thing'])
 
             except Exception as e:
                 log.error("Error creating core {0}: {1}".format(name, str(e)))
                 # Continue with other cores if any
 
-            log.debug("Creating Core definition with InitialVersion={0}".format(
-                initial_version))
+        # A group without its core is no use: fail the step, for resume to redo
+        cores = self._provisioned_things('core', 'Cores', self.group['Cores'])
 
-            # Create the core definition
-            core_def = rinse(self._gg.create_core_definition(
-                Name="{0}_core_def".format(self.group['Group']['name']),
-                InitialVersion=initial_version
-            ))
-
-            log.info("Created Core definition Arn:{0} Id:{1}".format(
-                core_def['Arn'], core_def['Id']))
+        # Again, there should only be 1...
+        initial_version = {'Cores': [
+            _thing_definition(c, core) for c, core in zip(self.group['Cores'], cores)]}
+        log.debug("Creating Core definition with InitialVersion={0}".format(
+            initial_version))
 
-        self.state['Cores'] = cores
+        # Create the core definition
+        core_def = rinse(self._gg.create_core_definition(
+            Name="{0}_core_def".format(self.group['Group']['name']),
+            InitialVersion=initial_version
+        ))
 
-        self.state['CoreDefinition'] = core_def
+        log.info("Created Core definition Arn:{0} Id:{1}".format(
+            core_def['Arn'], core_def['Id']))
 
-        _update_state(self.state)
+        with self._state_change('CoreDefinition'):
+            self.state['CoreDefinition'] = core_def
 
     # Remove all of the devices and detach associated structures
     def _remove_devices(self):
-        # TODO: protect with try/catch ClientError
-        # for every device
-        for device in self.state['Devices']:
-            thing_name = device['thing']['thingName']
-            cert_id = device['keys']['certificateId']
-            log.info("Removing device thing '{0}'' from device '{1}'".format(
-                device['name'], thing_name))
-
-            log.debug("--- detaching policy: '{0}'".format(device['policy']['policyName']))
-            self._iot.detach_principal_policy(
-                policyName=device['policy']['policyName'], principal=device['keys']['certificateArn'])
-
-            log.debug("--- deleting policy: '{0}'".format(device['policy']['policyName']))
-            self._iot.delete_policy(policyName=device['policy']['policyName'])
-
-            log.debug("--- deactivating certificate: '{0}'".format(device['keys']['certificateId']))
-            self._iot.update_certificate(
-                certificateId=cert_id, newStatus='INACTIVE')
-
-            log.debug(
-                "--- detaching certificate '{0}' from thing '{1}'".format(cert_id, thing_name))
-            self._iot.detach_thing_principal(
-                thingName=thing_name, principal=device['keys']['certificateArn'])
-            sleep(1)
-
-            log.debug("--- deleting certificate: '{0}'".format(device['keys']['certificateId']))
-            self._iot.delete_certificate(certificateId=device['keys']['certificateId'])
-
-            log.debug("--- deleting thing: '{0}'".format(device['thing']['thingName']))
-            self._iot.delete_thing(thingName=device['thing']['thingName'])
+        # Devices are independent, take them down concurrently
+        self._remove_things('device', self.state['Devices'])
 
         device_def = self.state['DeviceDefinition']
         log.info("Removing device definition '{0}'".format(device_def['Name']))
@@ -944,55 +1887,99 @@ class GroupCommands(object):
 
     # Remove the core for the GreenGrass Group
     def _remove_cores(self):
-        # TODO: protect with try/catch ClientError
-        for core in self.state['Cores']:
-            thing_name = core['thing']['thingName']
-            cert_id = core['keys']['certificateId']
-            log.info("Removing core thing '{0}'' from core '{1}'".format(
-                core['name'], thing_name))
-
-            log.debug("--- detaching policy: '{0}'".format(core['policy']['policyName']))
-            self._iot.detach_principal_policy(
-                policyName=core['policy']['policyName'], principal=core['keys']['certificateArn'])
+        self._remove_things('core', self.state['Cores'])
 
-            log.debug("--- deleting policy: '{0}'".format(core['policy']['policyName']))
-            self._iot.delete_policy(policyName=core['policy']['policyName'])
+        core_def = self.state['CoreDefinition']
+        log.info("Removing core definition '{0}'".format(core_def['Name']))
+        self._gg.delete_core_definition(CoreDefinitionId=core_def['Id'])
 
-            log.debug("--- deactivating certificate: '{0}'".format(core['keys']['certificateId']))
-            self._iot.update_certificate(
-                certificateId=cert_id, newStatus='INACTIVE')
+    # Remove things of devices or cores, along with their policies and certificates.
+    # Every thing goes through the teardown on its own, so the stages of
+    # different things overlap. Policies, which things may share, are deleted
+    # once the things are gone; shared ones only once no certificate, of any
+    # group, is attached to them. Failures are logged; the first one is raised
+    # once all the things are processed.
+    def _remove_things(self, kind, things):
+        errors = []
 
+        def remove(thing):
+            try:
+                self._remove_thing(kind, thing)
+            except exceptions.ClientError as e:
+                log.error("Error removing {0} '{1}': {2}".format(kind, thing['name'], e))
+                errors.append(e)
+
+        _pmap(remove, things, self._workers)
+        if errors:
+            raise errors[0]
+
+        policies = dict((t['policy']['policyName'], t['policy']) for t in things if 'policy' in t)
+        _pmap(self._delete_policy, [policies[name] for name in sorted(policies)],
+              self._workers)
+
+    def _delete_policy(self, policy):
+        name = policy['policyName']
+        if policy.get('shared'):
+            # The attached certificates are the reference count of a shared policy
+            if self._iot.list_targets_for_policy(policyName=name, pageSize=1)['targets']:
+                log.debug("--- keeping policy '{0}', still in use".format(name))
+                return
+        log.debug("--- deleting policy: '{0}'".format(name))
+        try:
+            self._iot.delete_policy(policyName=name)
+        except exceptions.ClientError as e:
+            # Attached meanwhile by another group, or deleted by it
+            if not policy.get('shared') or e.response['Error']['Code'] not in (
+                    'DeleteConflictException', 'ResourceNotFoundException'):
+                raise
+            log.debug("--- keeping policy '{0}': {1}".format(name, e))
+
+    # An interrupted create may have left the thing with only some of its parts,
+    # made in the order of THING_PARTS: only those are removed.
+    def _remove_thing(self, kind, thing):
+        if 'keys' not in thing:
+            return
+        thing_name = thing['thing']['thingName'] if 'thing' in thing else thing['name']
+        cert_id = thing['keys']['certificateId']
+        cert_arn = thing['keys']['certificateArn']
+        log.info("Removing {0} thing '{1}'' from {0} '{2}'".format(
+            kind, thing['name'], thing_name))
+
+        if 'policy' in thing:
+            log.debug("--- detaching policy: '{0}'".format(thing['policy']['policyName']))
+            self._iot.detach_principal_policy(
+                policyName=thing['policy']['policyName'], principal=cert_arn)
+
+        log.debug("--- deactivating certificate: '{0}'".format(cert_id))
+        self._iot.update_certificate(certificateId=cert_id, newStatus='INACTIVE')
+
+        if 'thing' in thing:
             log.debug(
                 "--- detaching certificate '{0}' from thing '{1}'".format(cert_id, thing_name))
-            self._iot.detach_thing_principal(
-                thingName=thing_name, principal=core['keys']['certificateArn'])
-            sleep(1)
+            self._iot.detach_thing_principal(thingName=thing_name, principal=cert_arn)
 
-            log.debug("--- deleting certificate: '{0}'".format(core['keys']['certificateId']))
-            self._iot.delete_certificate(certificateId=core['keys']['certificateId'])
+            # Detaching is eventually consistent: the certificate can't be deleted
+            # while it is still seen attached to the thing.
+            if not _wait_for(
+                    lambda: not self._iot.list_principal_things(principal=cert_arn)['things']):
+                log.warning("Certificate '{0}' is still attached to '{1}', deleting anyway".format(
+                    cert_id, thing_name))
 
-            log.debug("--- deleting thing: '{0}'".format(core['thing']['thingName']))
-            self._iot.delete_thing(thingName=core['thing']['thingName'])
+        log.debug("--- deleting certificate: '{0}'".format(cert_id))
+        self._iot.delete_certificate(certificateId=cert_id)
 
-        core_def = self.state['CoreDefinition']
-        log.info("Removing core definition '{0}'".format(core_def['Name']))
-        self._gg.delete_core_definition(CoreDefinitionId=core_def['Id'])
+        if 'thing' in thing:
+            log.debug("--- deleting thing: '{0}'".format(thing_name))
+            self._iot.delete_thing(thingName=thing_name)
 
-    # Create the IOT policy and attach it to the thing
+    # Create the IOT policy and attach it to the thing. With SharedPolicies
+    # set, things with the same policy document share one policy.
     def _create_and_attach_thing_policy(self, thing_name, policy_doc, thing_cert_arn):
-        try:
-            policy_name = "{0}-policy".format(thing_name)
-            policy = rinse(self._iot.create_policy(
-                policyName=policy_name,
-                policyDocument=policy_doc)
-            )
-        except ClientError as ce:
-            if ce.response['Error']['Code'] == 'EntityAlreadyExists':
-                log.warning(
-                    "Policy '{0}' exists. Using existing Policy".format(policy_name))
-            else:
-                log.error("Unexpected Error: {0}".format(ce))
-                raise
+        if self.group.get('SharedPolicies'):
+            policy = self._shared_policy(policy_doc)
+        else:
+            policy = self._create_policy("{0}-policy".format(thing_name), policy_doc)
+        policy_name = policy['policyName']
 
         self._iot.attach_principal_policy(
             policyName=policy_name,
@@ -1003,6 +1990,38 @@ class GroupCommands(object):
 
         return policy
 
+    # Create the IOT policy, or use the existing one of the same name
+    def _create_policy(self, policy_name, policy_doc):
+        try:
+            return rinse(self._iot.create_policy(
+                policyName=policy_name,
+                policyDocument=policy_doc)
+            )
+        except exceptions.ClientError as ce:
+            if ce.response['Error']['Code'] in ('EntityAlreadyExists',
+                                                'ResourceAlreadyExistsException'):
+                log.warning(
+                    "Policy '{0}' exists. Using existing Policy".format(policy_name))
+                return rinse(self._iot.get_policy(policyName=policy_name))
+            log.error("Unexpected Error: {0}".format(ce))
+            raise
+
+    # The policy for a policy document, named after the hash of the document,
+    # so that all the things of all the groups with the same document use it.
+    # It is created, or looked up, once per command.
+    def _shared_policy(self, policy_doc):
+        policy_name = SHARED_POLICY_PREFIX + _digest(
+            json.dumps(json.loads(policy_doc), sort_keys=True))
+        with self._policies_lock:
+            if policy_name not in self._policies:
+                policy = self._create_policy(policy_name, policy_doc)
+                self._policies[policy_name] = {
+                    'policyName': policy['policyName'],
+                    'policyArn': policy['policyArn'],
+                    'shared': True
+                }
+        return self._policies[policy_name]
+
     # Create the device policy json
     def _create_device_policy(self):
         # TODO: redo as template and read from definition file
@@ -1163,22 +2182,28 @@ def rinse(boto_response):
         boto_response.pop('ResponseMetadata')
     return boto_response
 
+# Log the changes planned for update
+def _log_plan(changes, definition_file):
+    log.info("Changes to apply from '{0}':".format(definition_file))
+    for component, action, name in changes:
+        log.info("--- {0}: {1}{2}".format(
+            component, action, " '{0}'".format(name) if name else ''))
+
+# Strip spaces around '::' in a subscription source or target
+def _normalize_destination(d):
+    return '::'.join(x.strip() for x in d.split('::'))
+
 # Make the yaml pretty
 def pretty(d):
     """Pretty object as YAML."""
     return yaml.safe_dump(d, default_flow_style=False)
 
-# Update the state by removing the old state file and re-writing it
-def _update_state(group_state):
-    if not group_state:
-        os.remove(STATE_FILE)
-        log.debug("State is empty, removed state file '{0}'".format(STATE_FILE))
-        return
+def _digest(data):
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
 
-    with open(STATE_FILE, 'w') as f:
-        json.dump(group_state, f, indent=2,
-                  separators=(',', ': '), sort_keys=True, default=str)
-        log.debug("Updated group state in state file '{0}'".format(STATE_FILE))
+# Serialize a part of the state
+def _dumps(value, **kwargs):
+    return json.dumps(value, sort_keys=True, default=str, **kwargs)
 
 # Class that holds the state
 class State(dict):
@@ -1187,18 +2212,482 @@ class State(dict):
         v = self[k] = type(self)()
         return v
 
-# Check if the state exists by checking if the STATE_FILE exists in the directory
-def _state_exists():
-    return os.path.exists(STATE_FILE)
+# AWS clients for a region, created on first use and then reused. boto3
+# clients are thread safe, so everyone using the same Clients shares them,
+# e.g. all the groups of a fleet. Each client keeps a pool of up to
+# max_pool_connections HTTP connections: make it at least the number of threads
+# calling the client at once.
+# All the calls go through call(): it keeps each API operation within its rate,
+# see API_RATES, and retries the calls failing with a transient error.
+class Clients(object):
+
+    def __init__(self, aws_session=None, max_pool_connections=MAX_POOL_CONNECTIONS,
+                 stats=None):
+        self._session = aws_session or session.Session()
+        self.region_name = self._session.region_name
+        from botocore.config import Config
+        # call() is the only retry layer, network errors included: botocore
+        # retrying throttled calls on its own would hide them from the rate
+        # limits and the stats
+        self._config = Config(max_pool_connections=max_pool_connections,
+                              retries={'max_attempts': 0})
+        self._clients = {}
+        self._rate_limits = {}
+        self._iot_endpoint = None
+        self.stats = stats or api_stats
+        # Creating clients from a session is not thread safe
+        self._lock = threading.RLock()
+
+    def get(self, name):
+        with self._lock:
+            if name not in self._clients:
+                log.debug("Creating '{0}' client".format(name))
+                self._clients[name] = _Client(
+                    self, name, self._session.client(name, config=self._config))
+            return self._clients[name]
+
+    # Call the operation of the service, waiting for its rate limit first.
+    # Calls failing with a transient error, or on the network, are retried with
+    # exponential backoff; those making something new only when throttled or
+    # never sent, see NON_IDEMPOTENT_PREFIXES.
+    def call(self, service, operation, fn, *args, **kwargs):
+        api = '{0}.{1}'.format(service, operation)
+        limit = self._rate_limit(service, api)
+        idempotent = not operation.startswith(NON_IDEMPOTENT_PREFIXES)
+        network_errors = tuple(getattr(exceptions, name) for name in NETWORK_ERRORS)
+        delay = RETRY_DELAY
+        for attempt in range(API_RETRIES):
+            limit.acquire()
+            started = time()
+            try:
+                result = fn(*args, **kwargs)
+            except exceptions.ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                throttled = code in THROTTLING_ERRORS
+                self.stats.record(api, time() - started, throttled=throttled, failed=True)
+                if throttled:
+                    limit.throttled()
+                retryable = code in (RETRYABLE_ERRORS if idempotent else THROTTLING_ERRORS)
+                if not retryable or attempt == API_RETRIES - 1:
+                    raise
+                log.warning("{0}, retrying in {1} sec...".format(e, delay))
+                sleep(delay)
+                delay *= 2
+            except network_errors as e:
+                self.stats.record(api, time() - started, failed=True)
+                retryable = idempotent or isinstance(
+                    e, tuple(getattr(exceptions, name) for name in UNSENT_ERRORS))
+                if not retryable or attempt == API_RETRIES - 1:
+                    raise
+                log.warning("{0}, retrying in {1} sec...".format(e, delay))
+                sleep(delay)
+                delay *= 2
+            else:
+                self.stats.record(api, time() - started)
+                limit.succeeded()
+                return result
+
+    def _rate_limit(self, service, api):
+        with self._lock:
+            if api not in self._rate_limits:
+                self._rate_limits[api] = _RateLimit(
+                    API_RATES.get(api, API_RATES.get(service, API_MIN_RATE)))
+            return self._rate_limits[api]
+
+    # The IoT data endpoint of the account. It does not change, so it is looked up
+    # once and kept in cache_dir/ENDPOINT_CACHE_FILE, per region.
+    def iot_endpoint(self, cache_dir=None):
+        with self._lock:
+            if self._iot_endpoint is not None:
+                return self._iot_endpoint
+
+            cache_file = os.path.join(cache_dir, ENDPOINT_CACHE_FILE) if cache_dir else None
+            endpoints = {}
+            if cache_file and os.path.exists(cache_file):
+                try:
+                    with open(cache_file, 'r') as f:
+                        endpoints = json.load(f)
+                except ValueError:
+                    log.warning("Ignoring broken endpoint cache '{0}'".format(cache_file))
+
+            self._iot_endpoint = endpoints.get(self.region_name)
+            if self._iot_endpoint is None:
+                self._iot_endpoint = self.get('iot').describe_endpoint(
+                    endpointType='iot:Data-ATS')['endpointAddress']
+                if cache_file:
+                    endpoints[self.region_name] = self._iot_endpoint
+                    with open(cache_file, 'w') as f:
+                        json.dump(endpoints, f, indent=2, sort_keys=True)
+            return self._iot_endpoint
+
+# A boto3 client making its API calls through Clients.call()
+class _Client(object):
+    # Not API operations
+    PLAIN_ATTRIBUTES = ['meta', 'exceptions', 'get_paginator', 'get_waiter', 'can_paginate']
+
+    def __init__(self, clients, service, client):
+        self.__dict__.update(_clients=clients, _service=service, _client=client)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name in self.PLAIN_ATTRIBUTES or not callable(attr):
+            return attr
+        return _Call(self._clients, self._service, name, attr)
+
+    def __setattr__(self, name, value):
+        setattr(self._client, name, value)
+
+
+# An API operation of a _Client; other attributes are those of the boto3 method
+class _Call(object):
+
+    def __init__(self, clients, service, operation, fn):
+        self._clients = clients
+        self._service = service
+        self._operation = operation
+        self._fn = fn
+
+    def __call__(self, *args, **kwargs):
+        return self._clients.call(self._service, self._operation, self._fn, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._fn, name)
+
+
+# Calls per second to an API operation, as a token bucket allowing a burst
+# of a second worth of calls. The rate is halved each time AWS throttles a
+# call, and grows back by a tenth of the nominal rate with each call that succeeds.
+class _RateLimit(object):
+
+    def __init__(self, rate):
+        self.max_rate = self.rate = float(rate)
+        self._tokens = self.rate
+        self._last = time()
+        self._lock = threading.Lock()
+
+    # Take a token, waiting for it if there is none left
+    def acquire(self):
+        with self._lock:
+            now = time()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            # Tokens below zero are taken by the calls already waiting
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(API_MIN_RATE, self.rate / 2)
+            self._tokens = min(self._tokens, 0)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+# Number of calls, throttled and failed calls, and time spent per API operation
+class ApiStats(object):
+
+    def __init__(self):
+        self._apis = {}
+        self._lock = threading.Lock()
+
+    def record(self, api, seconds, throttled=False, failed=False):
+        with self._lock:
+            stats = self._apis.setdefault(api, dict(calls=0, throttled=0, failed=0, seconds=0))
+            stats['calls'] += 1
+            stats['throttled'] += int(throttled)
+            stats['failed'] += int(failed)
+            stats['seconds'] += seconds
+
+    def get(self, api):
+        with self._lock:
+            return dict(self._apis.get(api, {}))
+
+    # Table of the calls per API operation, busiest first
+    def summary(self):
+        with self._lock:
+            apis = sorted(self._apis.items(), key=lambda a: (-a[1]['seconds'], a[0]))
+            if not apis:
+                return None
+            width = max(len('API'), max(len(api) for api, _ in apis))
+            lines = ['{0:<{w}}  {1:>6}  {2:>9}  {3:>6}  {4:>8}  {5:>8}'.format(
+                'API', 'CALLS', 'THROTTLED', 'FAILED', 'SECONDS', 'AVG MS', w=width)]
+            for api, s in apis:
+                lines.append('{0:<{w}}  {1:>6}  {2:>9}  {3:>6}  {4:>8.2f}  {5:>8.1f}'.format(
+                    api, s['calls'], s['throttled'], s['failed'], s['seconds'],
+                    1000.0 * s['seconds'] / s['calls'], w=width))
+            return '\n'.join(lines)
+
+
+# The AWS calls made by this process
+api_stats = ApiStats()
+
+
+def log_api_stats():
+    table = api_stats.summary()
+    if table:
+        log.info("AWS API calls:\n{0}".format(table))
+
+
+# Where and how the group state is kept, the base of the backends. A backend
+# implements exists(), load(), returning the state or an empty dict if there
+# is none, save(state, keys=None) and remove(). save() writes the top-level
+# keys of the state changed since the last save, all of them if keys is None,
+# see _changes(). The store is open until close(), see _close_state_stores.
+class StateStore(object):
+
+    def __init__(self):
+        self._state = None
+        self._saved = set()  # Top-level keys, as last saved or loaded
+        self._snapshots = 0  # Taken so far, see _snapshot()
+        _open_state_stores.add(self)
+
+    # Make the changes saved so far durable, at the end of a step
+    def sync(self):
+        pass
+
+    # Make the saved state complete and durable at the end of a command
+    def compact(self):
+        pass
+
+    # Release what the backend holds open, once the command is done with the state
+    def close(self):
+        _open_state_stores.discard(self)
+
+    # Remember the state as saved
+    def _loaded(self, state):
+        self._state = state
+        self._saved = set(state)
+
+    # The changed keys still in the state as [(key, JSON value)], and the keys
+    # removed from it. Only the changed keys are serialized.
+    def _changes(self, state, keys=None):
+        self._state = state
+        keys = set(state) | self._saved if keys is None else set(keys)
+        changed = [(k, _dumps(state[k])) for k in sorted(keys) if k in state]
+        removed = sorted(k for k in keys if k not in state and k in self._saved)
+        self._saved = (self._saved | set(k for k, _ in changed)) - set(removed)
+        return changed, removed
+
+    # The changes of _changes(), taken under _state_lock, for a backend to write
+    # them outside of it, with their number: of two snapshots written in the
+    # wrong order, the later one has the higher number.
+    def _snapshot(self, state, keys=None):
+        with _state_lock:
+            self._snapshots += 1
+            changed, removed = self._changes(state, keys)
+            return self._snapshots, changed, removed
+
+# The group state on disk: a JSON snapshot, and a journal of changes made since.
+# Saving the state appends the top-level keys changed since the last save to the
+# journal; the snapshot is only rewritten when the journal is compacted, at the
+# end of the command or when the journal grows too long. The snapshot is replaced
+# atomically, and replaying the journal is idempotent, so a crash at any point
+# leaves a state that loads. The journal is flushed to disk once per step, see
+# sync(), rather than on every save.
+class StateFile(StateStore):
+
+    def __init__(self, path):
+        super(StateFile, self).__init__()
+        self.path = path
+        self.journal_path = path + '.journal'
+        self._records = 0  # Records in the journal
+        self._unsynced = False  # Records in the journal not flushed to disk yet
+        # Flushing the journal doesn't hold up the other groups using _state_lock
+        self._sync_lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.path) or os.path.exists(self.journal_path)
+
+    # Read the snapshot and replay the journal over it
+    def load(self):
+        if not self.exists():
+            log.debug("Group state file {0} not found, assume new group.".format(self.path))
+            return {}
+
+        log.debug("Loading group state from {0}".format(self.path))
+        state = State()
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                state.update(json.load(f))
+
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last record got cut by a crash: it never happened
+                        log.warning("Ignoring incomplete record in {0}".format(self.journal_path))
+                        break
+                    if record.get('deleted'):
+                        state.pop(record['key'], None)
+                    else:
+                        state[record['key']] = record['value']
+
+        self._loaded(state)
+        if os.path.exists(self.journal_path):
+            self.compact()
+        return state
+
+    # Append the changed keys to the journal
+    def save(self, state, keys=None):
+        with _state_lock:
+            if not state:
+                self.remove()
+                return
 
-# Load the state from the STATE_FILE by reading it into a state object
-def _load_state():
-    if not _state_exists():
-        log.debug("Group state file {0} not found, assume new group.".format(STATE_FILE))
-        return {}
-    log.debug("Loading group state from {0}".format(STATE_FILE))
-    with open(STATE_FILE, 'r') as f:
-        return State(json.load(f))
+            changed, removed = self._changes(state, keys)
+            records = ['{{"key": {0}, "value": {1}}}\n'.format(json.dumps(k), data)
+                       for k, data in changed]
+            records += [json.dumps({'key': k, 'deleted': True}) + '\n' for k in removed]
+            if not records:
+                return
+
+            with open(self.journal_path, 'a') as f:
+                f.write(''.join(records))
+            self._records += len(records)
+            self._unsynced = True
+            _dirty_state_files.add(self)
+            log.debug("Updated group state in state file '{0}'".format(self.journal_path))
+
+            if self._records >= JOURNAL_MAX_RECORDS:
+                self.compact()
+
+    # Flush the journal to disk, once for all the records appended since the last time
+    def sync(self):
+        with self._sync_lock:
+            with _state_lock:
+                if not self._unsynced:
+                    return
+                self._unsynced = False
+                f = open(self.journal_path, 'a')
+            try:
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+
+    # Write the whole state to the snapshot, then drop the journal
+    def compact(self):
+        with _state_lock:
+            _dirty_state_files.discard(self)
+            if not self._state:
+                return
+
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(_dumps(self._state, indent=2, separators=(',', ': ')))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.path)
+
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            self._records = 0
+            self._unsynced = False
+            log.debug("Compacted group state to state file '{0}'".format(self.path))
+
+    def remove(self):
+        with _state_lock:
+            _dirty_state_files.discard(self)
+            for path in [self.path, self.journal_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+            self._state = None
+            self._saved = set()
+            self._records = 0
+            self._unsynced = False
+            log.debug("State is empty, removed state file '{0}'".format(self.path))
+
+# Compact the state files still having a journal, and close the state
+# stores still open, e.g. on exit
+def _close_state_stores():
+    for state_file in list(_dirty_state_files):
+        state_file.compact()
+    for store in list(_open_state_stores):
+        store.close()
+
+# Run the steps given as (name, function, [names of steps it depends on]).
+# Each step runs on a thread pool as soon as all of its dependencies are done.
+# On failure, no new steps are started; the first error is re-raised
+# once the steps already running are finished.
+def _run_dag(steps, workers=MAX_WORKERS):
+    pending = dict((name, (fn, set(deps))) for name, fn, deps in steps)
+    for name, (fn, deps) in pending.items():
+        unknown = deps - set(pending)
+        if unknown:
+            raise ValueError("Step '{0}' depends on unknown steps {1}".format(
+                name, sorted(unknown)))
+
+    results = queue.Queue()
+
+    def call(name, fn):
+        try:
+            fn()
+            results.put((name, None))
+        except Exception as e:
+            results.put((name, e))
+
+    done = set()
+    running = 0
+    error = None
+    pool = ThreadPool(max(1, min(workers, len(pending))))
+    try:
+        while running or (pending and error is None):
+            if error is None:
+                ready = sorted(n for n, (fn, deps) in pending.items() if deps <= done)
+                if not (ready or running):
+                    raise ValueError("Circular dependency between steps {0}".format(
+                        sorted(pending)))
+                for name in ready:
+                    fn, _ = pending.pop(name)
+                    log.debug("Starting step '{0}'".format(name))
+                    pool.apply_async(call, (name, fn))
+                    running += 1
+
+            name, e = results.get()
+            running -= 1
+            if e is None:
+                log.debug("Step '{0}' done".format(name))
+                done.add(name)
+            else:
+                log.error("Step '{0}' failed: {1}".format(name, e))
+                error = error or e
+    finally:
+        pool.close()
+        pool.join()
+
+    if error is not None:
+        raise error
+
+# Apply the function to every item on a thread pool, return results in order
+def _pmap(fn, items, workers=MAX_WORKERS):
+    items = list(items)
+    if not items:
+        return []
+    pool = ThreadPool(max(1, min(workers, len(items))))
+    try:
+        return pool.map(fn, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+# Poll until check() returns True, backing off exponentially between attempts.
+# With jitter, each delay is randomly cut by up to a half, so that many
+# pollers don't hit the same API at the same time.
+# Returns False if it's still not True after timeout seconds.
+def _wait_for(check, timeout=READY_TIMEOUT, delay=0.1, max_delay=2, jitter=False):
+    deadline = time() + timeout
+    while not check():
+        remaining = deadline - time()
+        if remaining <= 0:
+            return False
+        sleep(min(delay * random.uniform(0.5, 1) if jitter else delay, remaining))
+        delay = min(delay * 2, max_delay)
+    return True
 
 # Make a new directory given a directory path
 def _mkdir(path):
@@ -1208,6 +2697,15 @@ def _mkdir(path):
         if not (exc.errno == errno.EEXIST and os.path.isdir(path)):
             raise
 
+# Entry of a core or device definition for a thing of the group definition
+def _thing_definition(description, thing):
+    return {
+        'Id': description['name'],
+        'CertificateArn': thing['keys']['certificateArn'],
+        'SyncShadow': description['SyncShadow'],
+        'ThingArn': thing['thing']['thingArn']
+    }
+
 # Save the keys in the appropriate place
 def _save_keys(path, name, keys_cert):
     try:
@@ -1223,12 +2721,16 @@ def _save_keys(path, name, keys_cert):
             pem_file.write(pem)
             log.info("Thing Name: {0} and PEM file: {1}".format(name, certname))
 
+        # Keys generated locally are already there, see greengo.keys
+        if 'keyPair' not in keys_cert:
+            return
+
         with open(public_key_file, "w") as pub_file:
             pub = keys_cert['keyPair']['PublicKey']
             pub_file.write(pub)
             log.info("Thing Name: {0} Public Key File: {1}".format(name, public_key_file))
 
-        with open(private_key_file, "w") as prv_file:
+        with keys.open_private_key(private_key_file) as prv_file:
             prv = keys_cert['keyPair']['PrivateKey']
             prv_file.write(prv)
             log.info("Thing Name: {0} Private Key File: {1}".format(name, private_key_file))
@@ -1241,7 +2743,12 @@ def _save_keys(path, name, keys_cert):
 
 # Call fire to allow us to just call the method names from the command line
 def main():
-    fire.Fire(GroupCommands)
+    atexit.register(_close_state_stores)
+    import fire
+    try:
+        fire.Fire(GroupCommands)
+    finally:
+        log_api_stats()
 
 # Run main()
 if __name__ == '__main__':
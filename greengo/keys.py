@@ -0,0 +1,77 @@
+import os
+import errno
+import logging
+import subprocess
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger('greengo')
+
+KEY_TYPE = 'rsa'
+# `openssl req` options of the key types. Both are accepted by AWS IoT.
+KEY_TYPES = {
+    'rsa': ['-newkey', 'rsa:2048'],
+    'ec': ['-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1'],
+}
+KEYGEN_WORKERS = cpu_count()  # Keys generated at once, by as many openssl processes
+
+
+# Files of the keys of a thing, as written by _save_keys
+def private_key_file(path, name):
+    return os.path.join(path, name + '.private.key')
+
+
+def public_key_file(path, name):
+    return os.path.join(path, name + '.pub')
+
+
+# Open the private key file for writing, readable by the owner only,
+# even if it was there before with other permissions
+def open_private_key(path):
+    f = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w')
+    os.chmod(path, 0o600)
+    return f
+
+
+# Generate a key pair for the thing with openssl, right into the key files
+# under path, and return the certificate signing request for it, PEM.
+# The private key is never read back: only the CSR goes to AWS.
+def create_csr(path, name, key_type=KEY_TYPE):
+    try:
+        os.makedirs(path)
+    except OSError as e:  # Things share the directory, another one may have made it
+        if not (e.errno == errno.EEXIST and os.path.isdir(path)):
+            raise
+    # openssl writes into the file as it is, 0600
+    open_private_key(private_key_file(path, name)).close()
+    p = subprocess.Popen(
+        ['openssl', 'req', '-new', '-nodes', '-pubkey'] + KEY_TYPES[key_type] + [
+            '-keyout', private_key_file(path, name),
+            '-subj', '/CN={0}'.format(name),
+        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode:
+        raise Exception("Error generating the keys of '{0}': {1}".format(
+            name, err.decode('utf-8', 'replace').strip()))
+    out = out.decode('ascii')
+
+    # -pubkey prints the public key before the request
+    split = out.index('-----BEGIN CERTIFICATE REQUEST-----')
+    with open(public_key_file(path, name), 'w') as f:
+        f.write(out[:split])
+    return out[split:]
+
+
+# Create keys and CSRs for many things, [(path, name)]. Key generation is
+# CPU bound: each key is made by its own openssl process, one per core at once.
+# Returns the CSRs in the order of things.
+def create_csrs(things, key_type=KEY_TYPE, workers=KEYGEN_WORKERS):
+    things = list(things)
+    if not things:
+        return []
+    pool = ThreadPool(max(1, min(workers, len(things))))
+    try:
+        return pool.map(lambda t: create_csr(t[0], t[1], key_type), things, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,317 @@
+import os
+import sys
+import copy
+import mmap
+import json
+import platform
+import base64
+import shutil
+import struct
+import fnmatch
+import hashlib
+import zipfile
+import logging
+import tempfile
+import threading
+import contextlib
+import subprocess
+
+log = logging.getLogger('greengo')
+
+MANIFEST_SUFFIX = '.manifest.json'
+CHUNK_SIZE = 1024 * 1024  # Read files by 1Mb chunks when hashing and zipping
+COMPRESSION_LEVEL = 6  # zlib level, 0 to store files uncompressed, 9 for the smallest zip
+# Files and directories left out of the packages: names, or paths in the package
+EXCLUDE = ['*.pyc', '__pycache__', 'tests']
+# Where the requirements of lambda packages are installed, shared by all the groups
+DEPENDENCIES_CACHE = os.path.join(os.path.expanduser('~'), '.greengo', 'dependencies')
+# The lambdas run on the Greengrass core, not here: their requirements are
+# installed for the runtime of the lambdas and the platform of the core
+RUNTIME = 'python2.7'
+PLATFORM = 'manylinux1_x86_64'
+# Timestamp of all the zip entries, so the same files always make the same zip
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# The level zipfile compresses with when not told otherwise, that of zlib
+ZLIB_DEFAULT_LEVEL = 6
+# CPython versions whose zipfile internals _copy_entry works with. On others,
+# the entries of the previous zip are compressed again instead.
+RAW_COPY_VERSIONS = ((3, 6), (3, 13))
+# CPython versions whose zipfile takes the level of a streamed entry from the
+# internal ZipInfo._compresslevel, made public as compress_level in 3.13
+COMPRESS_LEVEL_VERSIONS = ((3, 7), (3, 12))
+# Local file header of a zip entry, see the zip APPNOTE
+LOCAL_FILE_HEADER = struct.Struct('<4s2B4HL2L2H')
+
+_dependencies_locks = {}  # By dependencies directory
+_dependencies_locks_lock = threading.Lock()
+
+
+# Zip the lambda package directory into <target_dir>/<name>.zip, together with
+# the dependencies_dir built by build_dependencies(), if any: package files take
+# precedence over dependencies with the same path. Files matching the exclude
+# patterns are left out. The zip is reproducible: entries are sorted and have a
+# fixed timestamp, so the same files give the same zip.
+# A manifest with path, mtime, size and digest of every file is kept next to
+# the zip. Unchanged package is not re-zipped; when some files changed, only
+# those are compressed again, the rest is copied from the previous zip as is,
+# where it can be, see _can_copy().
+# Returns the zip path, and whether the package content changed since last build.
+def build_package(name, source_dir, target_dir, level=COMPRESSION_LEVEL, exclude=EXCLUDE,
+                  dependencies_dir=None):
+    zip_path = os.path.join(target_dir, name + '.zip')
+    manifest_path = os.path.join(target_dir, name + MANIFEST_SUFFIX)
+    options = dict(level=level, exclude=sorted(exclude))
+
+    manifest = _load_manifest(manifest_path)
+    old_files = manifest.get('files', {})
+    files = _scan([dependencies_dir, source_dir], old_files, exclude)
+    digest = _package_digest(files)
+
+    previous_zip = zip_path if os.path.isfile(zip_path) else None
+    if manifest.get('options') != options:
+        previous_zip = None  # Built differently, can't reuse anything
+    if previous_zip and manifest.get('digest') == digest:
+        log.debug("Lambda package '{0}' unchanged, reusing '{1}'".format(name, zip_path))
+        return zip_path, False
+
+    tmp_path = zip_path + '.tmp'
+    old = zipfile.ZipFile(previous_zip) if previous_zip else None
+    try:
+        with zipfile.ZipFile(tmp_path, 'w') as new:
+            for arcname in sorted(files):
+                if (old and arcname in old.NameToInfo and _can_copy(old.getinfo(arcname)) and
+                        old_files.get(arcname, {}).get('sha256') == files[arcname]['sha256']):
+                    _copy_entry(old, old.getinfo(arcname), new)
+                else:
+                    log.debug("--- compressing '{0}'".format(arcname))
+                    _write_entry(new, files[arcname]['path'], arcname, level)
+    finally:
+        if old:
+            old.close()
+    os.rename(tmp_path, zip_path)
+
+    with open(manifest_path, 'w') as f:
+        json.dump({'digest': digest, 'files': files, 'options': options},
+                  f, indent=2, sort_keys=True)
+
+    log.debug("Lambda package '{0}' zipped to '{1}'".format(name, zip_path))
+    return zip_path, True
+
+
+# Where build_dependencies() installs the requirements: a directory of the
+# cache named after the hash of the requirements, the runtime and the platform
+def dependencies_dir(requirements_file, cache_dir=DEPENDENCIES_CACHE, runtime=RUNTIME,
+                     platform=PLATFORM):
+    h = hashlib.sha256('{0}\n{1}\n'.format(runtime, platform).encode('utf-8'))
+    with open(requirements_file, 'rb') as f:
+        h.update(f.read())
+    return os.path.join(cache_dir, h.hexdigest())
+
+
+# Install the requirements of a lambda package with pip, into its directory in
+# the cache. Lambdas and groups with the same requirements share one build,
+# so it happens once; the zip then only re-archives the package files that changed.
+# pip installs wheels for the runtime and the platform, e.g. 'python2.7' and
+# 'linux_armv7l', whatever Python runs greengo. Different requirements build
+# at the same time. Returns the directory.
+def build_dependencies(requirements_file, cache_dir=DEPENDENCIES_CACHE, runtime=RUNTIME,
+                       platform=PLATFORM):
+    target = dependencies_dir(requirements_file, cache_dir, runtime, platform)
+    with _dependencies_lock(target):
+        if os.path.isdir(target):
+            log.debug("Reusing dependencies of '{0}' from '{1}'".format(requirements_file, target))
+            return target
+
+        log.info("Installing dependencies of '{0}' for {1} on {2}".format(
+            requirements_file, runtime, platform))
+        _mkdir(cache_dir)
+        tmp = tempfile.mkdtemp(dir=cache_dir)
+        try:
+            subprocess.check_call([
+                sys.executable, '-m', 'pip', 'install', '--quiet', '--disable-pip-version-check',
+                '--requirement', requirements_file, '--target', tmp,
+                '--python-version', runtime.replace('python', ''),
+                '--implementation', 'cp',
+                '--platform', platform,
+                '--only-binary=:all:'])
+            # Another greengo might have built it meanwhile: keep theirs
+            if not os.path.isdir(target):
+                os.rename(tmp, target)
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+        return target
+
+
+# Builds of the same dependencies directory go one at a time, others run meanwhile
+def _dependencies_lock(target):
+    with _dependencies_locks_lock:
+        return _dependencies_locks.setdefault(target, threading.Lock())
+
+
+def _mkdir(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+# The built zip mapped in memory, to hand to an API call without reading it all
+@contextlib.contextmanager
+def open_package(zip_path):
+    with open(zip_path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield data
+        finally:
+            data.close()
+
+
+# Check if the package content changed since it was last built. Given the
+# CodeSha256 of the deployed function, also check the built zip against it.
+def is_changed(name, source_dir, target_dir, code_sha256_deployed=None, exclude=EXCLUDE,
+               dependencies_dir=None):
+    zip_path = os.path.join(target_dir, name + '.zip')
+    manifest = _load_manifest(os.path.join(target_dir, name + MANIFEST_SUFFIX))
+    if not (os.path.isfile(zip_path) and manifest):
+        return True
+    if dependencies_dir and not os.path.isdir(dependencies_dir):
+        return True  # Requirements changed, not even built yet
+    files = _scan([dependencies_dir, source_dir], manifest['files'], exclude)
+    if _package_digest(files) != manifest['digest']:
+        return True
+    return bool(code_sha256_deployed) and code_sha256(zip_path) != code_sha256_deployed
+
+
+# Remove the zip and the manifest of a lambda package
+def remove_package(name, target_dir):
+    for path in [os.path.join(target_dir, name + '.zip'),
+                 os.path.join(target_dir, name + MANIFEST_SUFFIX)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# Hash of a zip the way AWS Lambda reports it in CodeSha256
+def code_sha256(zip_path):
+    return base64.b64encode(file_digest(zip_path, raw=True)).decode('ascii')
+
+
+# SHA-256 of a file, read by chunks: hex digest, or raw bytes
+def file_digest(path, raw=False):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.digest() if raw else h.hexdigest()
+
+
+def _load_manifest(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+# Collect path, mtime, size and digest of each file in the source directories;
+# files of a later directory override those of an earlier one. Files with the
+# same path, mtime and size as in the old manifest are not re-read.
+def _scan(source_dirs, old_files, exclude=EXCLUDE):
+    files = {}
+    for source_dir in source_dirs:
+        if not source_dir:
+            continue
+        for root, dirs, names in os.walk(source_dir):
+            dirs[:] = sorted(
+                d for d in dirs if not _excluded(_arcname(root, d, source_dir), exclude))
+            for n in sorted(names):
+                path = os.path.join(root, n)
+                arcname = _arcname(root, n, source_dir)
+                if _excluded(arcname, exclude):
+                    continue
+                st = os.stat(path)
+                old = old_files.get(arcname)
+                if (old and old.get('path') == path and
+                        old['mtime'] == st.st_mtime and old['size'] == st.st_size):
+                    digest = old['sha256']
+                else:
+                    digest = file_digest(path)
+                files[arcname] = dict(path=path, mtime=st.st_mtime, size=st.st_size, sha256=digest)
+    return files
+
+
+def _arcname(root, name, source_dir):
+    return os.path.relpath(os.path.join(root, name), source_dir).replace(os.sep, '/')
+
+
+def _excluded(arcname, exclude):
+    name = arcname.rsplit('/', 1)[-1]
+    return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(arcname, p) for p in exclude)
+
+
+def _package_digest(files):
+    h = hashlib.sha256()
+    for arcname in sorted(files):
+        h.update('{0}\0{1}\n'.format(arcname, files[arcname]['sha256']).encode('utf-8'))
+    return h.hexdigest()
+
+
+# Compress a file into the zip, reading it by chunks
+def _write_entry(zf, path, arcname, level):
+    info = zipfile.ZipInfo(arcname, ZIP_DATE_TIME)
+    # Keep the executable bit only, as permissions vary across checkouts
+    executable = os.stat(path).st_mode & 0o111
+    info.external_attr = (0o100755 if executable else 0o100644) << 16
+    info.compress_type = zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED
+    leveled = _set_compress_level(info, level)
+
+    with open(path, 'rb') as src:
+        # Streaming into an entry compresses with the level of the entry
+        if sys.version_info >= (3, 6) and (leveled or level in (0, ZLIB_DEFAULT_LEVEL)):
+            with zf.open(info, 'w') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        else:  # Python 2, and 3.6 with the default level only
+            zf.writestr(info, src.read())
+
+
+# Set the compression level of a zip entry, public on Python 3.13+, behind
+# zipfile internals on COMPRESS_LEVEL_VERSIONS. Returns whether it could.
+def _set_compress_level(info, level):
+    if hasattr(info, 'compress_level'):
+        info.compress_level = level
+        return True
+    if (platform.python_implementation() == 'CPython' and
+            COMPRESS_LEVEL_VERSIONS[0] <= sys.version_info[:2] <= COMPRESS_LEVEL_VERSIONS[1]):
+        info._compresslevel = level
+        return True
+    return False
+
+
+# Whether an entry of the previous zip can be copied as it is: on the Python
+# versions of RAW_COPY_VERSIONS, and if it is not a zip64 entry
+def _can_copy(info):
+    return (platform.python_implementation() == 'CPython' and
+            RAW_COPY_VERSIONS[0] <= sys.version_info[:2] <= RAW_COPY_VERSIONS[1] and
+            max(info.file_size, info.compress_size) < zipfile.ZIP64_LIMIT)
+
+
+# Copy an entry from one zip to another without decompressing and compressing
+# it again. Relies on zipfile internals, see _can_copy().
+def _copy_entry(src, info, dst):
+    src.fp.seek(info.header_offset)
+    header = LOCAL_FILE_HEADER.unpack(src.fp.read(LOCAL_FILE_HEADER.size))
+    src.fp.seek(header[10] + header[11], 1)  # File name and extra field
+    data = src.fp.read(info.compress_size)
+
+    entry = copy.copy(info)
+    entry.flag_bits &= ~0x08  # Sizes and CRC go to the header, no data descriptor
+    entry.extra = b''  # Entries made by _write_entry have no extra field but zip64
+    dst.fp.seek(getattr(dst, 'start_dir', dst.fp.tell()))
+    entry.header_offset = dst.fp.tell()
+    dst.fp.write(entry.FileHeader())
+    dst.fp.write(data)
+    dst.filelist.append(entry)
+    dst.NameToInfo[entry.filename] = entry
+    dst.start_dir = dst.fp.tell()
+    dst._didModify = True
@@ -0,0 +1,149 @@
+import json
+import sqlite3
+import logging
+import threading
+
+from greengo.greengo import StateStore, State
+
+log = logging.getLogger('greengo')
+
+# Components of the state with IoT things, and so certificates
+THING_COMPONENTS = ['Cores', 'Devices']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS state (
+    grp TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (grp, key)
+);
+CREATE TABLE IF NOT EXISTS things (
+    grp TEXT NOT NULL,
+    component TEXT NOT NULL,
+    thing_name TEXT NOT NULL,
+    certificate_id TEXT,
+    PRIMARY KEY (grp, component, thing_name)
+);
+CREATE INDEX IF NOT EXISTS things_by_name ON things (thing_name);
+CREATE INDEX IF NOT EXISTS things_by_certificate ON things (certificate_id);
+'''
+
+
+# The state of many groups in one SQLite database: a row per group and
+# top-level key of the state, and a row per core and device thing, indexed
+# by thing name and certificate id to look them up across the groups.
+# Saving the state writes the changed keys in one transaction, so the
+# database always has a state that loads. The transaction is committed out of
+# the lock on the group state, so the groups of a fleet don't wait on each
+# other's disk writes.
+class StateDB(StateStore):
+
+    def __init__(self, path, group):
+        super(StateDB, self).__init__()
+        self.path = path
+        self.group = group
+        # Steps on the thread pool share the connection, under _lock
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._written = {}  # Number of the snapshot last written, by key
+
+    def exists(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT 1 FROM state WHERE grp = ? LIMIT 1', (self.group,)).fetchone() is not None
+
+    def load(self):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT key, value FROM state WHERE grp = ?', (self.group,)).fetchall()
+        if not rows:
+            log.debug("Group '{0}' not found in '{1}', assume new group.".format(
+                self.group, self.path))
+            return {}
+
+        log.debug("Loading group state from {0}".format(self.path))
+        state = State((k, json.loads(v)) for k, v in rows)
+        self._loaded(state)
+        return state
+
+    def save(self, state, keys=None):
+        if not state:
+            self.remove()
+            return
+
+        self._write(*self._snapshot(state, keys))
+
+    # Write the changes of a snapshot, see StateStore._snapshot()
+    def _write(self, number, changed, removed):
+        with self._lock:
+            # Keys written meanwhile by a later snapshot are newer
+            changed = [(k, data) for k, data in changed if self._written.get(k, 0) < number]
+            removed = [k for k in removed if self._written.get(k, 0) < number]
+            if not (changed or removed):
+                return
+
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO state (grp, key, value) VALUES (?, ?, ?)',
+                    [(self.group, k, data) for k, data in changed])
+                self._db.executemany(
+                    'DELETE FROM state WHERE grp = ? AND key = ?',
+                    [(self.group, k) for k in removed])
+
+                for component, data in changed:
+                    if component in THING_COMPONENTS:
+                        self._index_things(component, json.loads(data) or [])
+                for component in removed:
+                    if component in THING_COMPONENTS:
+                        self._index_things(component, [])
+            self._written.update((k, number) for k in [k for k, _ in changed] + removed)
+            log.debug("Updated group state in '{0}'".format(self.path))
+
+    def remove(self):
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM state WHERE grp = ?', (self.group,))
+                self._db.execute('DELETE FROM things WHERE grp = ?', (self.group,))
+            self._state = None
+            self._saved = set()
+            self._written = {}
+            log.debug("State is empty, removed group '{0}' from '{1}'".format(
+                self.group, self.path))
+
+    def close(self):
+        with self._lock:
+            super(StateDB, self).close()
+            self._db.close()
+
+    # Names of the groups in the database
+    def groups(self):
+        with self._lock:
+            return [r[0] for r in self._db.execute(
+                'SELECT DISTINCT grp FROM state ORDER BY grp')]
+
+    # Things with this name, in any group, as [(group, component, thing name, certificate id)]
+    def find_thing(self, thing_name):
+        return self._find_things('thing_name', thing_name)
+
+    # Things using this certificate, in any group
+    def find_certificate(self, certificate_id):
+        return self._find_things('certificate_id', certificate_id)
+
+    def _find_things(self, column, value):
+        with self._lock:
+            return self._db.execute(
+                'SELECT grp, component, thing_name, certificate_id FROM things '
+                'WHERE {0} = ? ORDER BY grp, component, thing_name'.format(column),
+                (value,)).fetchall()
+
+    # Replace the index rows of one component of the group
+    def _index_things(self, component, things):
+        self._db.execute(
+            'DELETE FROM things WHERE grp = ? AND component = ?', (self.group, component))
+        self._db.executemany(
+            'INSERT OR REPLACE INTO things (grp, component, thing_name, certificate_id) '
+            'VALUES (?, ?, ?, ?)',
+            [(self.group, component, t['thing']['thingName'],
+              t.get('keys', {}).get('certificateId'))
+             for t in things if t.get('thing')])
@@ -0,0 +1,70 @@
+import os
+import logging
+from multiprocessing.pool import ThreadPool
+
+from greengo import packaging
+
+log = logging.getLogger('greengo')
+
+PART_SIZE = 8 * 1024 * 1024  # Bytes per part of a multipart upload, 5Mb at least
+UPLOAD_WORKERS = 4  # Parts uploading at once
+
+
+# Upload a lambda package zip to the S3 bucket, under a key made of the hash
+# of its content: '<prefix><sha256>.zip'. A zip that is already there, e.g.
+# uploaded for another group, is not uploaded again. Zips bigger than
+# part_size are uploaded by parts, in parallel. Returns the key.
+def upload_package(s3, zip_path, bucket, prefix='', part_size=PART_SIZE, workers=UPLOAD_WORKERS):
+    key = '{0}{1}.zip'.format(prefix, packaging.file_digest(zip_path))
+
+    if _exists(s3, bucket, key):
+        log.debug("Lambda package '{0}' already in s3://{1}/{2}".format(zip_path, bucket, key))
+        return key
+
+    size = os.path.getsize(zip_path)
+    log.debug("Uploading lambda package '{0}' to s3://{1}/{2}".format(zip_path, bucket, key))
+    if size <= part_size:
+        with open(zip_path, 'rb') as f:
+            s3.put_object(Bucket=bucket, Key=key, Body=f)
+    else:
+        _upload_parts(s3, zip_path, bucket, key, size, part_size, workers)
+    return key
+
+
+def _exists(s3, bucket, key):
+    from botocore.exceptions import ClientError
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+
+def _upload_parts(s3, zip_path, bucket, key, size, part_size, workers):
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    # Each part reads its own slice of the file: only the parts being uploaded are in memory
+    def upload_part(number):
+        with open(zip_path, 'rb') as f:
+            f.seek((number - 1) * part_size)
+            body = f.read(part_size)
+        part = s3.upload_part(
+            Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=body)
+        log.debug("--- uploaded part {0} of '{1}'".format(number, key))
+        return {'PartNumber': number, 'ETag': part['ETag']}
+
+    numbers = range(1, (size + part_size - 1) // part_size + 1)
+    pool = ThreadPool(max(1, min(workers, len(numbers))))
+    try:
+        parts = pool.map(upload_part, numbers, chunksize=1)
+        s3.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+    except Exception:
+        # Don't leave the uploaded parts behind, S3 charges for them
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    finally:
+        pool.close()
+        pool.join()
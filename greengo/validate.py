@@ -0,0 +1,225 @@
+STRING = (str, type(u''))
+
+# Subscription sources and targets other than 'Lambda::', 'Device::' and 'Connector::'
+SUBSCRIPTION_SERVICES = ['cloud', 'GGShadowService']
+
+
+# Schema types. The schema is built from them once, on import; validating a
+# group definition is then a walk over the definition, with no parsing.
+# The path to a value is a (parent path, key) chain, only made a string on error.
+class _Value(object):
+
+    def __init__(self, types, name):
+        self.types = types
+        self.name = name
+
+    def check(self, value, path, errors):
+        if not isinstance(value, self.types) or isinstance(value, bool) != (bool in self.types):
+            errors.append("{0}: expected {1}, got {2!r}".format(_path(path), self.name, value))
+
+
+class _Enum(object):
+
+    def __init__(self, *values):
+        self.values = frozenset(values)
+
+    def check(self, value, path, errors):
+        if value not in self.values:
+            errors.append("{0}: {1!r} is not one of {2}".format(
+                _path(path), value, sorted(self.values)))
+
+
+# A mapping with known fields. Other fields are errors, unless it's open.
+class _Map(object):
+
+    def __init__(self, fields, required=(), open=False):
+        self.fields = fields
+        self.required = required
+        self.open = open
+
+    def check(self, value, path, errors):
+        if not isinstance(value, dict):
+            errors.append("{0}: expected a mapping, got {1!r}".format(_path(path), value))
+            return
+        for name in self.required:
+            if name not in value:
+                errors.append("{0}: '{1}' is required".format(_path(path), name))
+        for name, v in value.items():
+            field = self.fields.get(name)
+            if field:
+                field.check(v, (path, name), errors)
+            elif not self.open:
+                errors.append("{0}: unknown field '{1}'".format(_path(path), name))
+
+
+class _List(object):
+
+    def __init__(self, item):
+        self.item = item
+
+    def check(self, value, path, errors):
+        if not isinstance(value, list):
+            errors.append("{0}: expected a list, got {1!r}".format(_path(path), value))
+            return
+        for i, v in enumerate(value):
+            self.item.check(v, (path, i), errors)
+
+
+# 'Lambdas[0].greengrassConfig' from (((None, 'Lambdas'), 0), 'greengrassConfig')
+def _path(path):
+    if path is None:
+        return 'Group definition'
+    parent, key = path
+    if isinstance(key, int):
+        return '{0}[{1}]'.format(_path(parent), key)
+    return '{0}.{1}'.format(_path(parent), key) if parent else key
+
+
+_string = _Value(STRING, 'a string')
+_integer = _Value((int,), 'an integer')
+_boolean = _Value((bool,), 'true or false')
+_anything = _Map({}, open=True)
+
+_thing_fields = {
+    'name': _string,
+    'key_path': _string,
+    'config_path': _string,
+    'SyncShadow': _boolean,
+}
+_device = _Map(_thing_fields, required=['name', 'key_path', 'SyncShadow'])
+# A core also needs the directory to write its config file to
+_core = _Map(_thing_fields, required=['name', 'key_path', 'config_path', 'SyncShadow'])
+
+# See create_function_definition in the boto3 Greengrass docs
+_function_configuration = _Map({
+    'MemorySize': _integer,
+    'Timeout': _integer,
+    'Pinned': _boolean,
+    'EncodingType': _Enum('binary', 'json'),
+    'Executable': _string,
+    'ExecArgs': _string,
+    'Environment': _Map({
+        'AccessSysfs': _boolean,
+        'Variables': _anything,
+        'Execution': _anything,
+        'ResourceAccessPolicies': _List(_Map({
+            'ResourceId': _string,
+            'Permission': _Enum('ro', 'rw'),
+        }, required=['ResourceId'])),
+    }),
+})
+
+SCHEMA = _Map({
+    'Group': _Map({'name': _string}, required=['name']),
+    'Cores': _List(_core),
+    'Devices': _List(_device),
+    'Lambdas': _List(_Map({
+        'name': _string,
+        'handler': _string,
+        'package': _string,
+        'alias': _string,
+        'role': _string,
+        'environment': _anything,
+        'exclude': _List(_string),
+        'compression_level': _Enum(*range(10)),
+        'requirements': _string,
+        'platform': _string,
+        'greengrassConfig': _function_configuration,
+    }, required=['name', 'greengrassConfig'])),
+    'LambdaCode': _Map({'S3Bucket': _string, 'S3Prefix': _string}, required=['S3Bucket']),
+    'SharedPolicies': _boolean,
+    'BulkRegistration': _Map({
+        'S3Bucket': _string,
+        'S3Prefix': _string,
+        'RoleArn': _string,
+    }, required=['S3Bucket', 'RoleArn']),
+    'Subscriptions': _List(_Map({
+        'Source': _string,
+        'Subject': _string,
+        'Target': _string,
+    }, required=['Source', 'Subject', 'Target'])),
+    # Besides the name and id, a resource has its data container
+    'Resources': _List(_Map({'Name': _string, 'Id': _string}, required=['Name', 'Id'], open=True)),
+    'Loggers': _List(_Map({
+        'Component': _Enum('GreengrassSystem', 'Lambda'),
+        'Id': _string,
+        'Level': _Enum('DEBUG', 'INFO', 'WARN', 'ERROR', 'FATAL'),
+        'Space': _integer,
+        'Type': _Enum('FileSystem', 'AWSCloudWatch'),
+    }, required=['Component', 'Id', 'Level', 'Type'])),
+    'Connectors': _List(_Map({
+        'Id': _string,
+        'ConnectorArn': _string,
+        'Parameters': _anything,
+    }, required=['Id', 'ConnectorArn'])),
+    'certs': _Map({'keypath': _string, 'key_type': _Enum('rsa', 'ec')}),
+}, required=['Group'])
+
+
+# Check the group definition against the schema, and what its parts refer to
+# against each other: subscriptions, resource access policies, duplicate names.
+# Needs no AWS. Returns the list of errors, empty if the definition is fine.
+def validate(group):
+    errors = []
+    SCHEMA.check(group, None, errors)
+    if errors:
+        return errors  # Cross-checks would trip over the same problems
+
+    names = {}
+    for section, key in [('Cores', 'name'), ('Devices', 'name'), ('Lambdas', 'name'),
+                         ('Resources', 'Id'), ('Loggers', 'Id'), ('Connectors', 'Id')]:
+        names[section] = _unique(group.get(section) or [], section, key, errors)
+
+    for i, l in enumerate(group.get('Lambdas') or []):
+        if 'handler' in l and 'package' not in l:
+            errors.append("Lambdas[{0}]: lambda with a handler needs a 'package'".format(i))
+        policies = l['greengrassConfig'].get('Environment', {}).get('ResourceAccessPolicies', [])
+        for j, p in enumerate(policies):
+            if p['ResourceId'] not in names['Resources']:
+                errors.append(
+                    "Lambdas[{0}].greengrassConfig.Environment.ResourceAccessPolicies[{1}]: "
+                    "unknown resource '{2}'".format(i, j, p['ResourceId']))
+
+    known = {
+        'Lambda': names['Lambdas'],
+        'Device': names['Devices'],
+        'Connector': names['Connectors'],
+    }
+    for i, s in enumerate(group.get('Subscriptions') or []):
+        for end in ['Source', 'Target']:
+            error = _check_destination(s[end], known)
+            if error:
+                errors.append("Subscriptions[{0}].{1}: {2}".format(i, end, error))
+
+    for i, logger in enumerate(group.get('Loggers') or []):
+        if logger['Type'] == 'AWSCloudWatch' and 'Space' in logger:
+            errors.append("Loggers[{0}]: logs of type AWSCloudWatch cannot have 'Space'".format(i))
+
+    for i, c in enumerate(group.get('Connectors') or []):
+        if not c['ConnectorArn'].startswith('arn:'):
+            errors.append("Connectors[{0}].ConnectorArn: not an ARN: '{1}'".format(
+                i, c['ConnectorArn']))
+
+    return errors
+
+
+# Names of the items of a section; reports the duplicates
+def _unique(items, section, key, errors):
+    names = set()
+    for i, item in enumerate(items):
+        if item[key] in names:
+            errors.append("{0}[{1}]: duplicate {2} '{3}'".format(section, i, key, item[key]))
+        names.add(item[key])
+    return names
+
+
+def _check_destination(d, known):
+    p = [x.strip() for x in d.split('::')]
+    if len(p) == 1 and p[0] in SUBSCRIPTION_SERVICES:
+        return None
+    if len(p) == 2 and p[0] in known:
+        if p[1] not in known[p[0]]:
+            return "unknown {0} '{1}'".format(p[0].lower(), p[1])
+        return None
+    return ("can't parse '{0}'. Allowed values: 'Lambda::', 'Device::', 'Connector::', "
+            "'GGShadowService', or 'cloud'.".format(d))
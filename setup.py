@@ -29,7 +29,10 @@ setup(
     setup_requires=['pytest-runner'],
     tests_require=['pytest', 'mock'],
     entry_points={
-        'console_scripts': ['greengo=greengo.greengo:main'],
+        'console_scripts': [
+            'greengo=greengo.greengo:main',
+            'greengo-fleet=greengo.fleet:main',
+        ],
     },
     zip_safe=False
 )
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch, MagicMock
+
+from greengo import greengo, fleet
+from tests.main_test import SessionFixture
+
+
+class FleetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        os.mkdir('groups')
+        for i in range(5):
+            with open(os.path.join('groups', 'group_{0}.yaml'.format(i)), 'w') as f:
+                f.write("Group:\n  name: Group_{0}\n".format(i))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_find_groups(self):
+        self.assertEqual(len(fleet.find_groups('groups')), 5)
+        self.assertEqual(fleet.find_groups('groups/group_[12].yaml'),
+                         ['groups/group_1.yaml', 'groups/group_2.yaml'])
+
+    def test_fleet(self):
+        def deploy(gg):
+            if gg.name == 'Group_3':
+                raise ValueError("boom")
+            gg.state['Deployment'] = {'Status': {'DeploymentStatus': 'Success'}}
+
+        session = MagicMock(side_effect=SessionFixture)
+        with patch.object(greengo.session, 'Session', session), \
+                patch.object(greengo.GroupCommands, 'deploy', autospec=True, side_effect=deploy), \
+                patch.object(fleet, 'print') as print_, \
+                self.assertRaises(SystemExit):
+            fleet.fleet('groups', 'deploy')
+
+        # Clients are shared by all the groups
+        self.assertEqual(session.call_count, 1)
+        table = print_.call_args[0][0]
+        self.assertIn('5 groups, 4 succeeded, 1 failed', table)
+        self.assertIn('FAILED: boom', table)
+        self.assertTrue(os.path.isdir('Group_0-GG-Config'))
+
+    def test_unknown_command(self):
+        with self.assertRaises(ValueError):
+            fleet.fleet('groups', ['remove'])
+
+
+class TemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        with open('template.yaml', 'w') as f:
+            f.write("Group:\n  name: Factory_{site}_{index}\n"
+                    "Cores:\n  - name: '{site}_core'\n    SyncShadow: {sync}\n"
+                    "Loggers: [{Id: logger_1}]\n")
+        with open('sites.csv', 'w') as f:
+            f.write("site,sync\nberlin,True\nlyon,False\n")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_expand_template(self):
+        instances = fleet.expand_template('template.yaml', 'sites.csv')
+        label, group = next(instances)
+        self.assertEqual(label, 'template.yaml[0]')
+        self.assertEqual(group.render(), {
+            'Group': {'name': 'Factory_berlin_0'},
+            'Cores': [{'name': 'berlin_core', 'SyncShadow': True}],
+            'Loggers': [{'Id': 'logger_1'}]})
+        label, group = next(instances)
+        self.assertEqual(group.render()['Group']['name'], 'Factory_lyon_1')
+
+    def test_expand_template_yaml_params(self):
+        with open('sites.yaml', 'w') as f:
+            f.write("- {site: oslo, sync: True, index: 7}\n")
+        _, group = next(fleet.expand_template('template.yaml', 'sites.yaml'))
+        self.assertEqual(group.render()['Group']['name'], 'Factory_oslo_7')
+
+    def test_fleet_from_template(self):
+        with patch.object(greengo.session, 'Session', SessionFixture), \
+                patch.object(greengo.GroupCommands, 'create', autospec=True), \
+                patch.object(fleet, 'print') as print_:
+            fleet.fleet('template.yaml', 'create', params='sites.csv')
+
+        self.assertIn('2 groups, 2 succeeded, 0 failed', print_.call_args[0][0])
+        self.assertTrue(os.path.isdir('Factory_berlin_0-GG-Config'))
+        self.assertTrue(os.path.isdir('Factory_lyon_1-GG-Config'))
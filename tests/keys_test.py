@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+from greengo import keys
+
+
+class KeysTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_create_csrs(self):
+        path = os.path.join(self.tmp, 'certs')
+        csrs = keys.create_csrs([(path, 'd1'), (path, 'd2')], workers=2)
+
+        self.assertEqual(len(csrs), 2)
+        self.assertNotEqual(csrs[0], csrs[1])
+        for name, csr in zip(['d1', 'd2'], csrs):
+            self.assertTrue(csr.startswith('-----BEGIN CERTIFICATE REQUEST-----'))
+            # The request is for the key written to the key file
+            pub = subprocess.check_output(
+                ['openssl', 'pkey', '-pubout', '-in', keys.private_key_file(path, name)])
+            with open(keys.public_key_file(path, name), 'rb') as f:
+                self.assertEqual(f.read(), pub)
+            subject = subprocess.check_output(
+                ['openssl', 'req', '-noout', '-subject'], input=csr.encode('ascii'))
+            self.assertIn(name, subject.decode('ascii'))
+
+    def test_ec_key(self):
+        csr = keys.create_csr(self.tmp, 'd1', 'ec')
+        text = subprocess.check_output(
+            ['openssl', 'req', '-noout', '-text'], input=csr.encode('ascii'))
+        self.assertIn('prime256v1', text.decode('ascii'))
+
+    def test_private_key_mode(self):
+        path = keys.private_key_file(self.tmp, 'd1')
+        with open(path, 'w') as f:
+            f.write('old key')
+        os.chmod(path, 0o644)
+
+        keys.create_csr(self.tmp, 'd1')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        with open(path) as f:
+            self.assertIn('PRIVATE KEY', f.read())
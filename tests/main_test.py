@@ -1,5 +1,7 @@
 import os
 import json
+import shutil
+import tempfile
 import unittest
 import pytest
 
@@ -31,15 +33,79 @@ class SessionFixture():
         self.mock.describe_endpoint = MagicMock(
             return_value={'endpointAddress': "xxx.iot.moon-darkside.amazonaws.com"})
 
-    def client(self, name):
+    def client(self, name, **kwargs):
         return self.mock
 
 
+def remove_state():
+    # Else the state of the tests is written on exit, for the next run to load
+    greengo._dirty_state_files.clear()
+    for path in [greengo.STATE_FILE, greengo.STATE_FILE + '.journal']:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
 def rinse(d):
     # Overriding greengo.rinse so it won't give `KeyError` for missed `ResponseMetadata`
     return d
 
 
+# Local stand-in of the S3 and IoT calls of a bulk thing registration.
+# Things named 'fail' fail to register.
+class FakeBulkRegistration(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.objects = {}
+        self.reports = {}
+        self.statuses = iter(['InProgress', 'Completed'])
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def start_thing_registration_task(self, templateBody, inputFileBucket, inputFileKey, roleArn):
+        assert 'AWS::IoT::Certificate' in templateBody
+        results, errors = [], []
+        lines = self.objects[(inputFileBucket, inputFileKey)].decode('utf-8').splitlines()
+        for i, line in enumerate(lines):
+            params = json.loads(line)
+            assert params['CSR'].startswith('-----BEGIN CERTIFICATE REQUEST-----')
+            name = params['ThingName']
+            if name == 'fail':
+                errors.append({'offset': i, 'errorMessage': 'InvalidRequestException'})
+                continue
+            results.append({'offset': i, 'response': {
+                'CertificatePem': 'pem-' + name,
+                'ResourceArns': {
+                    'thing': 'arn:aws:iot:moon-darkside:1:thing/' + name,
+                    'certificate': 'arn:aws:iot:moon-darkside:1:cert/' + name + '-cert',
+                }}})
+        # Results split in two files, one per page of the report list
+        self.reports = {
+            'RESULTS': [self._report('r1', results[:1]), self._report('r2', results[1:])],
+            'ERRORS': [self._report('e1', errors)],
+        }
+        return {'taskId': 'task-1'}
+
+    def _report(self, name, lines):
+        path = os.path.join(self.path, name + '.json')
+        with open(path, 'w') as f:
+            f.write('\n'.join(json.dumps(l) for l in lines))
+        return 'file://' + path
+
+    def describe_thing_registration_task(self, taskId):
+        return {'status': next(self.statuses)}
+
+    def list_thing_registration_task_reports(self, taskId, reportType, nextToken='0'):
+        links = self.reports[reportType]
+        page = {'resourceLinks': [links[int(nextToken)]]}
+        if int(nextToken) + 1 < len(links):
+            page['nextToken'] = str(int(nextToken) + 1)
+        return page
+
+
 @patch('greengo.greengo.rinse', rinse)
 class GroupCommandTest(unittest.TestCase):
 
@@ -48,10 +114,321 @@ class GroupCommandTest(unittest.TestCase):
             self.gg = greengo.GroupCommands()
 
     def tearDown(self):
-        try:
-            os.remove(greengo.STATE_FILE)
-        except OSError:
-            pass
+        remove_state()
+
+    def test_create_runs_dependencies_first(self):
+        calls = []
+
+        def record(step):
+            return lambda *args, **kwargs: calls.append(step)
+
+        for step in ['_create_cores', '_create_devices', 'create_resources', 'create_lambdas',
+                     'create_connectors', 'create_subscriptions', 'create_loggers',
+                     'create_group_version']:
+            setattr(self.gg, step, MagicMock(side_effect=record(step)))
+
+        self.gg.create()
+
+        self.assertEqual(len(calls), 8)
+        for dependency in ['create_lambdas', '_create_devices', 'create_connectors']:
+            self.assertLess(calls.index(dependency), calls.index('create_subscriptions'))
+        self.assertLess(calls.index('create_resources'), calls.index('create_lambdas'))
+        self.assertEqual(calls[-1], 'create_group_version')
+
+    def test_resume_skips_done_steps(self):
+        calls = []
+
+        def record(step, error=None):
+            def call(*args, **kwargs):
+                calls.append(step)
+                if error:
+                    raise error
+            return call
+
+        for step in ['_create_cores', '_create_devices', 'create_resources', 'create_lambdas',
+                     'create_connectors', 'create_subscriptions', 'create_loggers',
+                     'create_group_version']:
+            setattr(self.gg, step, MagicMock(side_effect=record(step)))
+        self.gg.create_lambdas.side_effect = record('create_lambdas', ValueError('failed'))
+
+        with self.assertRaises(ValueError):
+            self.gg.create()
+        self.assertEqual(sorted(self.gg.state['Checkpoints']),
+                         ['connectors', 'cores', 'devices', 'group', 'loggers', 'resources'])
+
+        del calls[:]
+        self.gg.create_lambdas.side_effect = record('create_lambdas')
+        self.gg.resume()
+
+        self.assertEqual(calls, ['create_lambdas', 'create_subscriptions', 'create_group_version'])
+        self.assertIn('group_version', self.gg.state['Checkpoints'])
+        self.assertTrue(self.gg.resume())  # Nothing left to do
+        self.assertEqual(len(calls), 3)
+
+    def test_resume_verifies_steps_under_way(self):
+        self.gg.state['Group'] = {'Id': 'g'}
+        self.gg.state['Checkpoints'] = ['group']
+        # The function definition made it, the subscription definition is gone
+        self.gg.state['FunctionDefinition'] = {'Id': 'fd', 'LatestVersion': '1'}
+        self.gg.state['Subscriptions'] = {'Id': 'sd'}
+        self.gg._gg.get_function_definition = MagicMock(
+            return_value={'Id': 'fd', 'LatestVersion': '1', 'LatestVersionArn': 'arn:fd'})
+        self.gg._gg.get_function_definition_version = MagicMock(return_value={'Version': '1'})
+        self.gg._gg.get_subscription_definition = MagicMock(side_effect=ClientError(
+            {'Error': {'Code': 'IdNotFoundException'}}, 'GetSubscriptionDefinition'))
+
+        self.gg._verify_step('lambdas')
+        self.gg._verify_step('subscriptions')
+
+        self.assertEqual(self.gg.state['Checkpoints'], ['group', 'lambdas'])
+        self.assertEqual(self.gg.state['FunctionDefinition']['LatestVersionArn'], 'arn:fd')
+        self.assertEqual(self.gg.state['FunctionDefinition']['LatestVersionDetails'],
+                         {'Version': '1'})
+        self.assertNotIn('Subscriptions', self.gg.state)
+
+    def test_create_cores_fails_step(self):
+        self.gg._iot.create_keys_and_certificate = MagicMock(side_effect=ValueError('x'))
+        self.gg._gg.create_core_definition = MagicMock()
+
+        with self.assertRaises(Exception):
+            self.gg._create_cores()
+        self.assertFalse(self.gg._gg.create_core_definition.called)
+
+    @patch('greengo.greengo._save_keys', MagicMock())
+    def test_create_devices_resumes(self):
+        self.gg.group['Devices'] = [
+            dict(name=n, key_path='./certs', SyncShadow=False) for n in ['d1', 'd2', 'd3']]
+        certificates = []
+
+        def create_keys_and_certificate(setAsActive):
+            certificates.append('arn:cert{0}'.format(len(certificates)))
+            return {'certificateArn': certificates[-1]}
+
+        self.gg._iot.create_keys_and_certificate = MagicMock(
+            side_effect=create_keys_and_certificate)
+        self.gg._iot.create_thing = MagicMock(side_effect=lambda thingName: (
+            {'thingName': thingName, 'thingArn': 'arn:' + thingName}))
+        self.gg._iot.create_policy = MagicMock(side_effect=[
+            {'policyName': 'p1'}, ValueError('crash'), {'policyName': 'p2'}, {'policyName': 'p3'}])
+        self.gg._gg.create_device_definition = MagicMock(
+            return_value={'Arn': 'arn:def', 'Id': 'def', 'LatestVersion': '1'})
+        self.gg._workers = 1
+
+        # A device failing fails the step, with what is made of it in the state
+        with self.assertRaises(Exception):
+            self.gg._create_devices(update_group_version=False)
+        self.assertFalse(self.gg._gg.create_device_definition.called)
+        self.assertEqual(self.gg.state['Devices'][1]['keys'], {'certificateArn': 'arn:cert1'})
+        self.assertNotIn('policy', self.gg.state['Devices'][1])
+
+        # Redone, the step only makes what is missing
+        self.gg._create_devices(update_group_version=False)
+
+        self.assertEqual(len(certificates), 3)
+        self.assertEqual(self.gg._iot.create_thing.call_count, 3)
+        _, kwargs = self.gg._gg.create_device_definition.call_args
+        self.assertEqual(
+            [(d['Id'], d['CertificateArn']) for d in kwargs['InitialVersion']['Devices']],
+            [('d1', 'arn:cert0'), ('d2', 'arn:cert1'), ('d3', 'arn:cert2')])
+
+    @patch('greengo.greengo._save_keys', MagicMock())
+    @patch('greengo.greengo.sleep', MagicMock())
+    def test_create_devices_keeps_order_and_retries(self):
+        names = ['device_{0}'.format(i) for i in range(20)]
+        self.gg.group['Devices'] = [
+            dict(name=n, key_path='./certs', SyncShadow=False) for n in names]
+
+        throttled = ClientError(
+            error_response={'Error': {'Code': 'ThrottlingException'}},
+            operation_name='CreateThing')
+        things = dict((n, [throttled]) for n in names[::3])
+
+        def create_thing(thingName):
+            if things.get(thingName):
+                raise things[thingName].pop()
+            return {'thingName': thingName, 'thingArn': 'arn:' + thingName}
+
+        self.gg._iot.create_thing = MagicMock(side_effect=create_thing)
+        self.gg._iot.create_keys_and_certificate = MagicMock(
+            return_value={'certificateArn': 'arn:cert'})
+        self.gg._gg.create_device_definition = MagicMock(
+            return_value={'Arn': 'arn:def', 'Id': 'def', 'LatestVersion': '1'})
+
+        self.gg._create_devices(update_group_version=False)
+
+        _, kwargs = self.gg._gg.create_device_definition.call_args
+        self.assertEqual([d['Id'] for d in kwargs['InitialVersion']['Devices']], names)
+        self.assertEqual([d['name'] for d in self.gg.state['Devices']], names)
+        self.assertEqual(self.gg._iot.create_thing.call_count, len(names) + len(names[::3]))
+
+    @patch('greengo.greengo._save_keys', MagicMock())
+    def test_shared_policies(self):
+        names = ['d{0}'.format(i) for i in range(5)]
+        self.gg.group['SharedPolicies'] = True
+        self.gg.group['Devices'] = [
+            {'name': n, 'key_path': 'certs', 'SyncShadow': False} for n in names]
+        self.gg._iot.create_keys_and_certificate = MagicMock(side_effect=lambda **kwargs: {
+            'certificateArn': 'arn:cert', 'certificateId': 'cert'})
+        self.gg._iot.create_policy = MagicMock(side_effect=lambda **kwargs: {
+            'policyName': kwargs['policyName'], 'policyArn': 'arn:policy'})
+        self.gg._iot.attach_principal_policy = MagicMock()
+        self.gg._gg.create_device_definition = MagicMock(
+            return_value={'Arn': 'arn:def', 'Id': 'def', 'Name': 'def', 'LatestVersion': '1'})
+
+        self.gg._create_devices(update_group_version=False)
+
+        self.assertEqual(self.gg._iot.create_policy.call_count, 1)
+        self.assertEqual(self.gg._iot.attach_principal_policy.call_count, len(names))
+        policy = self.gg.state['Devices'][0]['policy']
+        self.assertTrue(policy['policyName'].startswith(greengo.SHARED_POLICY_PREFIX))
+        self.assertEqual(set(d['policy']['policyName'] for d in self.gg.state['Devices']),
+                         set([policy['policyName']]))
+
+        # Kept while certificates of other groups are attached to it
+        self.gg._iot.list_principal_things = MagicMock(return_value={'things': []})
+        self.gg._iot.delete_policy = MagicMock()
+        self.gg._iot.list_targets_for_policy = MagicMock(return_value={'targets': ['arn:other']})
+        self.gg._remove_devices()
+        self.assertFalse(self.gg._iot.delete_policy.called)
+
+        self.gg._iot.list_targets_for_policy = MagicMock(return_value={'targets': []})
+        self.gg._remove_devices()
+        self.gg._iot.delete_policy.assert_called_once_with(policyName=policy['policyName'])
+
+    def test_create_devices_local_keys(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.gg.group['certs'] = {'key_type': 'ec'}
+        self.gg.group['Devices'] = [
+            {'name': n, 'key_path': tmp, 'SyncShadow': False} for n in ['d1', 'd2']]
+        self.gg._iot.create_certificate_from_csr = MagicMock(side_effect=lambda **kwargs: {
+            'certificateArn': 'arn:cert', 'certificateId': 'cert',
+            'certificatePem': kwargs['certificateSigningRequest'].replace('REQUEST', 'PEM')})
+        self.gg._iot.create_keys_and_certificate = MagicMock()
+        self.gg._gg.create_device_definition = MagicMock(
+            return_value={'Arn': 'arn:def', 'Id': 'def', 'LatestVersion': '1'})
+
+        self.gg._create_devices(update_group_version=False)
+
+        self.assertFalse(self.gg._iot.create_keys_and_certificate.called)
+        self.assertEqual(self.gg._iot.create_certificate_from_csr.call_count, 2)
+        self.assertNotIn('keyPair', self.gg.state['Devices'][0]['keys'])
+        with open(os.path.join(tmp, 'd1.cert.pem')) as f:
+            self.assertTrue(f.read().startswith('-----BEGIN CERTIFICATE PEM-----'))
+        self.assertEqual(os.stat(os.path.join(tmp, 'd1.private.key')).st_mode & 0o777, 0o600)
+
+    def test_save_keys_private_key_mode(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        greengo._save_keys(tmp, 'd1', {
+            'certificatePem': 'cert',
+            'keyPair': {'PublicKey': 'public', 'PrivateKey': 'private'}})
+
+        path = os.path.join(tmp, 'd1.private.key')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'private')
+
+    @patch('greengo.greengo.sleep', MagicMock())
+    def test_create_devices_bulk(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        names = ['d1', 'd2', 'fail', 'd3']
+        key_path = os.path.join(tmp, 'certs')
+        self.gg.group['Devices'] = [
+            {'name': n, 'key_path': key_path, 'SyncShadow': False} for n in names]
+        self.gg.group['BulkRegistration'] = {'S3Bucket': 'bucket', 'RoleArn': 'arn:role'}
+        bulk = FakeBulkRegistration(tmp)
+        for name in ['start_thing_registration_task', 'describe_thing_registration_task',
+                     'list_thing_registration_task_reports']:
+            setattr(self.gg._iot, name, getattr(bulk, name))
+        self.gg._clients.get('s3').put_object = bulk.put_object
+        self.gg._iot.create_policy = MagicMock(
+            return_value={'policyName': 'p', 'policyArn': 'arn:p'})
+        self.gg._iot.create_thing = MagicMock()
+        self.gg._gg.create_device_definition = MagicMock(
+            return_value={'Arn': 'arn:def', 'Id': 'def', 'Name': 'def', 'LatestVersion': '1'})
+
+        # A device failing to register fails the step, the others are saved
+        with self.assertRaises(Exception):
+            self.gg._create_devices(update_group_version=False)
+        self.assertFalse(self.gg._gg.create_device_definition.called)
+        self.assertEqual([d['name'] for d in self.gg.state['Devices']], ['d1', 'd2', 'd3'])
+
+        # Redone, the step registers none of the devices saved
+        self.gg.group['Devices'] = [d for d in self.gg.group['Devices'] if d['name'] != 'fail']
+        self.gg._iot.start_thing_registration_task = MagicMock()
+        self.gg._create_devices(update_group_version=False)
+
+        self.assertFalse(self.gg._iot.start_thing_registration_task.called)
+        self.assertFalse(self.gg._iot.create_thing.called)
+        self.assertEqual(self.gg._iot.create_policy.call_count, 1)
+        _, kwargs = self.gg._gg.create_device_definition.call_args
+        self.assertEqual([d['Id'] for d in kwargs['InitialVersion']['Devices']],
+                         ['d1', 'd2', 'd3'])
+        self.assertEqual(self.gg.state['Devices'][2]['keys']['certificateId'], 'd3-cert')
+        with open(os.path.join(key_path, 'd2.cert.pem')) as f:
+            self.assertEqual(f.read(), 'pem-d2')
+        self.assertTrue(os.path.exists(os.path.join(key_path, 'd2.private.key')))
+
+        # The devices share the policy, it is deleted once
+        self.gg._iot.list_principal_things = MagicMock(return_value={'things': []})
+        self.gg._iot.delete_policy = MagicMock()
+        self.gg._remove_devices()
+        self.gg._iot.delete_policy.assert_called_once_with(policyName='p')
+
+    @patch('greengo.greengo.sleep')
+    def test_remove_devices_waits_for_detach(self, sleep):
+        self.gg.state = greengo.State(state.copy())
+        self.gg.state['Devices'] = [dict(
+            name=n,
+            thing={'thingName': n},
+            keys={'certificateId': n + '-cert', 'certificateArn': 'arn:' + n},
+            policy={'policyName': n + '-policy'}) for n in ['d1', 'd2', 'd3']]
+        self.gg.state['DeviceDefinition'] = {'Id': 'def', 'Name': 'def'}
+        # Each certificate is still seen attached on the first check
+        attached = set(['arn:d1', 'arn:d2', 'arn:d3'])
+
+        def list_principal_things(principal):
+            if principal in attached:
+                attached.remove(principal)
+                return {'things': ['thing']}
+            return {'things': []}
+
+        self.gg._iot.list_principal_things = MagicMock(side_effect=list_principal_things)
+        self.gg._iot.delete_certificate = MagicMock()
+
+        self.gg._remove_devices()
+
+        self.assertEqual(
+            sorted(c[1]['certificateId'] for c in self.gg._iot.delete_certificate.call_args_list),
+            ['d1-cert', 'd2-cert', 'd3-cert'])
+        self.assertEqual(sleep.call_count, 3)
+        self.assertLess(max(c[0][0] for c in sleep.call_args_list), 1)
+
+    @patch('greengo.greengo.sleep')
+    def test_deploy_waits(self, sleep):
+        self.gg.state = greengo.State(state.copy())
+        self.gg._gg.create_deployment = MagicMock(return_value={'DeploymentId': 'd1'})
+        self.gg._gg.get_deployment_status = MagicMock(side_effect=[
+            {'DeploymentStatus': s}
+            for s in ['Building'] * 2 + ['InProgress'] * 4 + ['Success']])
+
+        self.gg.deploy()
+
+        transitions = self.gg.state['Deployment']['Transitions']
+        self.assertEqual([t['Status'] for t in transitions], ['Building', 'InProgress', 'Success'])
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [0.5, 1, 2, 4, 5, 5])
+        saved = greengo.StateFile(greengo.STATE_FILE).load()
+        self.assertEqual(len(saved['Deployment']['Transitions']), 3)
+
+    def test_deploy_no_wait(self):
+        self.gg.state = greengo.State(state.copy())
+        self.gg._gg.create_deployment = MagicMock(return_value={'DeploymentId': 'd1'})
+        self.gg._gg.get_deployment_status = MagicMock()
+
+        self.assertEqual(self.gg.deploy(no_wait=True), 'd1')
+        self.assertFalse(self.gg._gg.get_deployment_status.called)
 
     def test_create_subscriptions(self):
         self.gg.state = greengo.State(state.copy())
@@ -67,6 +444,29 @@ class GroupCommandTest(unittest.TestCase):
         self.gg.group.pop('Subscriptions')
         self.gg.create_subscriptions()
 
+    def test_subscription_list(self):
+        self.gg.state = greengo.State(state.copy())
+        arns = self.gg._destination_arns()
+        self.gg.group['Subscriptions'] = [
+            {'Source': 'Lambda::' + name, 'Subject': 'x', 'Target': 'cloud'}
+            for name in sorted(arns['Lambda'])] * 1000
+
+        with patch.object(self.gg, '_destination_arns', MagicMock(return_value=arns)) as m:
+            subs = self.gg._subscription_list()
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(len(subs), len(self.gg.group['Subscriptions']))
+        self.assertEqual(subs[0]['Source'], arns['Lambda'][sorted(arns['Lambda'])[0]])
+        self.assertEqual(subs[0]['Target'], 'cloud')
+
+    def test_subscription_list_unknown_name(self):
+        self.gg.state = greengo.State(state.copy())
+        self.gg.group['Subscriptions'] = [
+            {'Source': 'Lambda::Missing', 'Subject': 'x', 'Target': 'cloud'}]
+
+        with self.assertRaises(ValueError) as e:
+            self.gg._subscription_list()
+        self.assertIn("Lambda 'Missing' not found", str(e.exception))
+
     def test_remove_subscriptions(self):
         self.gg._gg.delete_subscription_definition = MagicMock(return_value=state['Subscriptions'])
         self.gg.state = greengo.State(state.copy())
@@ -127,15 +527,96 @@ class LambdaTest(unittest.TestCase):
             self.gg = greengo.GroupCommands()
 
     def tearDown(self):
-        try:
-            os.remove(greengo.STATE_FILE)
-        except OSError:
-            pass
+        remove_state()
 
     def test_create_lambdas_empty(self):
         self.gg.group.pop('Lambdas')
         self.gg.create_lambdas()  # Doesn't blow up
 
+    @patch('greengo.greengo.packaging.code_sha256', MagicMock(return_value='sha'))
+    @patch('greengo.greengo.packaging.build_package', MagicMock(return_value=('x.zip', False)))
+    def test_update_lambda_unchanged(self):
+        self.gg.state = greengo.State(state.copy())
+        self.gg.state['Lambdas'] = [
+            {'FunctionName': 'GreengrassHelloWorld', 'CodeSha256': 'sha'}]
+        self.gg._lambda.update_function_code = MagicMock()
+
+        self.gg.update_lambda('GreengrassHelloWorld')
+        self.assertFalse(self.gg._lambda.update_function_code.called)
+
+    @patch('greengo.greengo.sleep')
+    def test_create_lambdas_waits_for_role(self, sleep):
+        zf = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
+        zf.write(b'zip')
+        zf.close()
+        self.addCleanup(os.remove, zf.name)
+        names = ['lambda_{0}'.format(i) for i in range(5)]
+        self.gg.group['Lambdas'] = [
+            dict(name=n, handler='h', package='p', greengrassConfig={}) for n in names]
+
+        not_ready = ClientError(
+            error_response={'Error': {'Code': 'InvalidParameterValueException', 'Message':
+                                      greengo.ROLE_NOT_READY_ERROR}},
+            operation_name='CreateFunction')
+        attempts = [not_ready, not_ready]
+
+        def create_function(**kwargs):
+            if attempts:
+                raise attempts.pop()
+            return {'FunctionName': kwargs['FunctionName'], 'Version': '1'}
+
+        self.gg._iam.create_role = MagicMock(return_value={'Role': {'Arn': 'arn:role'}})
+        self.gg._lambda.create_function = MagicMock(side_effect=create_function)
+        self.gg._lambda.create_alias = MagicMock(side_effect=lambda **kwargs: {
+            'FunctionVersion': '1', 'AliasArn': 'arn:' + kwargs['FunctionName']})
+        self.gg._gg.create_function_definition = MagicMock(
+            return_value={'Id': 'fd', 'LatestVersion': '1'})
+
+        with patch('greengo.greengo.packaging.build_package',
+                   MagicMock(return_value=(zf.name, True))):
+            self.gg.create_lambdas(update_group_version=False)
+
+        self.assertEqual(self.gg._iam.create_role.call_count, 1)
+        self.assertEqual(self.gg._lambda.create_function.call_count, len(names) + 2)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertTrue(all(c[0][0] <= 1 for c in sleep.call_args_list))
+        _, kwargs = self.gg._gg.create_function_definition.call_args
+        self.assertEqual([f['Id'] for f in kwargs['InitialVersion']['Functions']], names)
+        self.assertEqual([lr['FunctionName'] for lr in self.gg.state['Lambdas']], names)
+
+    def test_resume_reuses_lambdas(self):
+        self.gg.group['Lambdas'] = [
+            dict(name=n, handler='h', package='p', role='arn:role', greengrassConfig={})
+            for n in ['l1', 'l2']]
+        self.gg.state['Lambdas'] = [{'FunctionName': 'l1', 'Version': '1'}]
+        self.gg._lambda.get_function_configuration = MagicMock()
+        self.gg._lambda.get_alias = MagicMock(side_effect=ClientError(
+            {'Error': {'Code': 'ResourceNotFoundException'}}, 'GetAlias'))
+        self.gg._lambda.create_function = MagicMock(
+            return_value={'FunctionName': 'l2', 'Version': '1'})
+        self.gg._lambda.create_alias = MagicMock(side_effect=lambda **kwargs: {
+            'FunctionVersion': '1', 'AliasArn': 'arn:' + kwargs['FunctionName']})
+        self.gg._gg.create_function_definition = MagicMock(
+            return_value={'Id': 'fd', 'LatestVersion': '1'})
+
+        self.gg._verify_lambdas()
+        with patch('greengo.greengo.packaging.build_package',
+                   MagicMock(return_value=('x.zip', True))), \
+                patch.object(self.gg, '_function_code', MagicMock()):
+            self.gg.create_lambdas(update_group_version=False)
+
+        self.assertEqual(self.gg._lambda.create_function.call_count, 1)
+        self.assertEqual(self.gg._lambda.create_function.call_args[1]['FunctionName'], 'l2')
+        # l1 stopped short of its alias
+        self.assertEqual(self.gg._lambda.create_alias.call_count, 2)
+        self.assertEqual([lr['FunctionName'] for lr in self.gg.state['Lambdas']], ['l1', 'l2'])
+
+    @patch('greengo.greengo.upload.upload_package', MagicMock(return_value='greengo/sha.zip'))
+    def test_function_code_in_s3(self):
+        self.gg.group['LambdaCode'] = {'S3Bucket': 'code', 'S3Prefix': 'greengo/'}
+        with self.gg._function_code('x.zip') as code:
+            self.assertEqual(code, {'S3Bucket': 'code', 'S3Key': 'greengo/sha.zip'})
+
     def test_role_exists(self):
         error = ClientError(
             error_response={'Error': {'Code': 'EntityAlreadyExists'}},
@@ -143,3 +624,462 @@ class LambdaTest(unittest.TestCase):
 
         self.gg._iam.create_role = MagicMock(side_effect=error)
         self.gg._default_lambda_role_arn()  # Doesn't blow up
+
+
+@patch('greengo.greengo.rinse', rinse)
+@patch('greengo.greengo.packaging.is_changed', MagicMock(return_value=False))
+class UpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        with patch.object(greengo.session, 'Session', SessionFixture):
+            self.gg = greengo.GroupCommands()
+        with open('tests/test_state.json', 'r') as f:
+            self.gg.state = greengo.State(json.load(f))
+        # Leave the lambda that is in the test state only
+        self.gg.group['Lambdas'] = self.gg.group['Lambdas'][:1]
+        for kind in ['function', 'subscription', 'logger']:
+            setattr(self.gg._gg, 'create_{0}_definition_version'.format(kind),
+                    MagicMock(return_value={'Version': 'v2', 'Arn': 'arn:v2'}))
+
+    def tearDown(self):
+        remove_state()
+
+    def test_plan_no_changes(self):
+        self.assertEqual(self.gg._plan(), [])
+
+    def test_plan_changes(self):
+        self.gg.group['Loggers'][0]['Level'] = 'INFO'
+        self.gg.group['Lambdas'][0]['greengrassConfig']['Timeout'] = 20
+        self.gg.group['Lambdas'].append({'name': 'HWBeta', 'alias': 'dev', 'greengrassConfig': {}})
+        self.gg.group['Subscriptions'].pop()
+        self.gg.group.pop('Resources')
+
+        self.assertEqual(self.gg._plan(), [
+            ('Resources', 'remove', None),
+            ('Lambdas', 'update-config', 'GreengrassHelloWorld'),
+            ('Lambdas', 'add', 'HWBeta'),
+            ('Subscriptions', 'update', None),
+            ('Loggers', 'update', None)])
+
+    def test_update_touches_changed_only(self):
+        self.gg.group['Loggers'][0]['Level'] = 'INFO'
+
+        self.gg.update()
+
+        _, kwargs = self.gg._gg.create_logger_definition_version.call_args
+        self.assertEqual(kwargs['Loggers'][0]['Level'], 'INFO')
+        self.assertEqual(kwargs['LoggerDefinitionId'], state['Loggers']['Id'])
+        self.assertFalse(self.gg._lambda.delete_function.called)
+        self.assertFalse(self.gg._gg.create_function_definition_version.called)
+        self.assertFalse(self.gg._gg.create_subscription_definition_version.called)
+        self.assertTrue(self.gg._gg.create_group_version.called)
+
+    def test_update_lambda_config(self):
+        self.gg.group['Lambdas'][0]['greengrassConfig']['Timeout'] = 20
+
+        self.gg.update()
+
+        _, kwargs = self.gg._gg.create_function_definition_version.call_args
+        self.assertEqual(kwargs['Functions'][0]['FunctionConfiguration']['Timeout'], 20)
+        self.assertEqual(kwargs['Functions'][0]['FunctionArn'],
+                         state['FunctionDefinition']['LatestVersionDetails']['Definition'][
+                             'Functions'][0]['FunctionArn'])
+        self.assertFalse(self.gg._lambda.create_function.called)
+
+    def test_update_lambda_alias(self):
+        self.gg.group['Lambdas'][0]['alias'] = 'prod'
+        arn = 'arn:aws:lambda:us-west-2:000000000000:function:GreengrassHelloWorld:prod'
+        self.gg._lambda.create_alias = MagicMock(
+            return_value={'FunctionVersion': '21', 'AliasArn': arn})
+        self.gg._lambda.delete_alias = MagicMock()
+        self.gg._gg.get_function_definition_version = MagicMock(return_value={
+            'Definition': {'Functions': [dict(
+                state['FunctionDefinition']['LatestVersionDetails']['Definition'][
+                    'Functions'][0], FunctionArn=arn)]}})
+
+        self.assertEqual(self.gg._plan(), [
+            ('Lambdas', 'replace', 'GreengrassHelloWorld'),
+            ('Subscriptions', 'update', None)])
+        self.gg.update()
+
+        self.assertFalse(self.gg._lambda.delete_function.called)
+        self.assertFalse(self.gg._lambda.create_function.called)
+        self.assertEqual(self.gg._lambda.create_alias.call_args[1]['FunctionVersion'], '21')
+        self.gg._lambda.delete_alias.assert_called_once_with(
+            FunctionName='GreengrassHelloWorld', Name='dev')
+        _, kwargs = self.gg._gg.create_function_definition_version.call_args
+        self.assertEqual(kwargs['Functions'][0]['FunctionArn'], arn)
+        _, kwargs = self.gg._gg.create_subscription_definition_version.call_args
+        self.assertEqual([(s['Source'], s['Target']) for s in kwargs['Subscriptions']],
+                         [(arn, 'cloud'), ('cloud', arn)])
+
+    @patch('greengo.greengo.packaging.build_package', MagicMock(return_value=('x.zip', True)))
+    def test_update_lambdas(self):
+        self.gg._function_code = MagicMock()
+        self.gg._lambda.update_function_code = MagicMock(return_value={'Version': '7'})
+        self.gg._lambda.update_alias = MagicMock(
+            return_value={'FunctionVersion': '7', 'AliasArn': 'arn:alias'})
+
+        self.gg.update_lambdas()
+
+        _, kwargs = self.gg._lambda.update_alias.call_args
+        self.assertEqual(kwargs['FunctionVersion'], '7')
+        self.assertEqual(self.gg.state['Lambdas'][0]['Version'], '7')
+        self.assertEqual(self.gg._gg.create_function_definition_version.call_count, 1)
+        self.assertEqual(self.gg._gg.create_group_version.call_count, 1)
+
+    @patch('greengo.greengo.packaging.build_package', MagicMock(return_value=('x.zip', False)))
+    @patch('greengo.greengo.packaging.code_sha256', MagicMock(return_value='sha'))
+    def test_update_lambdas_unchanged(self):
+        self.gg.state['Lambdas'][0]['CodeSha256'] = 'sha'
+        self.gg._lambda.update_function_code = MagicMock()
+
+        self.gg.update_lambdas()
+
+        self.assertFalse(self.gg._lambda.update_function_code.called)
+        self.assertFalse(self.gg._gg.create_group_version.called)
+
+
+@patch('greengo.greengo.rinse', rinse)
+class StatusTest(unittest.TestCase):
+
+    def setUp(self):
+        with patch.object(greengo.session, 'Session', SessionFixture):
+            self.gg = greengo.GroupCommands()
+        names = ['device_{0}'.format(i) for i in range(1000)]
+        self.gg.state = greengo.State({
+            'Group': {'Id': 'g', 'Version': {'Version': 'v1'}},
+            'CoreDefinition': {'Id': 'cd', 'LatestVersion': '1'},
+            'Devices': [{
+                'name': n,
+                'thing': {'thingName': n},
+                'keys': {'certificateId': n + '-cert'},
+                'policy': {'policyName': 'shared-policy'}} for n in names],
+            'DeviceDefinition': {'Id': 'dd', 'LatestVersion': '1'},
+            'Lambdas': [{'FunctionName': 'l1'}],
+        })
+        iot = self.gg._iot
+        iot.list_things = self.pages('things', 'nextToken', 'nextToken', 250,
+                                     [{'thingName': n} for n in names])
+        iot.list_certificates = self.pages('certificates', 'marker', 'nextMarker', 250, [
+            {'certificateId': n + '-cert', 'status': 'ACTIVE'} for n in names])
+        iot.list_policies = self.pages('policies', 'marker', 'nextMarker', 250,
+                                       [{'policyName': 'shared-policy'}])
+        gg = self.gg._gg
+        gg.list_groups = self.pages('Groups', 'NextToken', 'NextToken', 100,
+                                    [{'Id': 'g', 'LatestVersion': 'v1'}])
+        gg.list_core_definitions = self.pages('Definitions', 'NextToken', 'NextToken', 100,
+                                              [{'Id': 'cd', 'LatestVersion': '1'}])
+        gg.list_device_definitions = self.pages('Definitions', 'NextToken', 'NextToken', 100,
+                                                [{'Id': 'dd', 'LatestVersion': '1'}])
+        self.gg._lambda.list_functions = self.pages('Functions', 'Marker', 'NextMarker', 50,
+                                                    [{'FunctionName': 'l1'}])
+
+    def tearDown(self):
+        remove_state()
+
+    # A list call returning the items by pages of size, checking the page size asked
+    def pages(self, items_key, token_arg, token_key, size, items):
+        def call(**kwargs):
+            self.assertEqual(int(list(v for k, v in kwargs.items() if k != token_arg)[0]), size)
+            start = int(kwargs.get(token_arg, 0))
+            page = {items_key: items[start:start + size]}
+            if start + size < len(items):
+                page[token_key] = str(start + size)
+            return page
+        return MagicMock(side_effect=call)
+
+    def test_no_drift(self):
+        self.assertTrue(self.gg.status(drift=True))
+        self.assertEqual(self.gg._iot.list_things.call_count, 4)
+        self.assertEqual(self.gg._iot.list_policies.call_count, 1)
+
+    def test_drift(self):
+        self.gg.state['Devices'][10]['thing']['thingName'] = 'gone'
+        self.gg.state['Devices'][20]['keys']['certificateId'] = 'gone-cert'
+        self.gg.state['DeviceDefinition']['LatestVersion'] = '0'
+        self.gg.state['Lambdas'].append({'FunctionName': 'l2'})
+        certificates = self.gg._iot.list_certificates.side_effect
+
+        def list_certificates(**kwargs):
+            page = certificates(**kwargs)
+            for c in page['certificates']:
+                if c['certificateId'] == 'device_30-cert':
+                    c['status'] = 'REVOKED'
+            return page
+        self.gg._iot.list_certificates = MagicMock(side_effect=list_certificates)
+
+        self.assertFalse(self.gg.status(drift=True))
+        self.assertEqual(set(self.gg._drift()), set([
+            ('DeviceDefinition', 'version changed', 'dd'),
+            ('Thing', 'missing', 'gone'),
+            ('Certificate', 'missing', 'gone-cert'),
+            ('Certificate', 'REVOKED', 'device_30-cert'),
+            ('Lambda', 'missing', 'l2'),
+        ]))
+
+    def test_status_without_drift_check(self):
+        self.assertIsNone(self.gg.status())
+        self.assertFalse(self.gg._iot.list_things.called)
+
+
+class RunDagTest(unittest.TestCase):
+
+    def test_order(self):
+        calls = []
+        greengo._run_dag([
+            ('c', lambda: calls.append('c'), ['a', 'b']),
+            ('a', lambda: calls.append('a'), []),
+            ('b', lambda: calls.append('b'), ['a']),
+        ])
+        self.assertEqual(calls, ['a', 'b', 'c'])
+
+    def test_failure_stops_dependants(self):
+        calls = []
+
+        def fail():
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            greengo._run_dag([
+                ('a', fail, []),
+                ('b', lambda: calls.append('b'), ['a']),
+            ])
+        self.assertEqual(calls, [])
+
+    def test_circular_dependency(self):
+        with self.assertRaises(ValueError):
+            greengo._run_dag([('a', lambda: None, ['b']), ('b', lambda: None, ['a'])])
+
+
+class WaitForTest(unittest.TestCase):
+
+    @patch('greengo.greengo.sleep')
+    def test_backoff(self, sleep):
+        checks = iter([False, False, False, False, True])
+        self.assertTrue(greengo._wait_for(lambda: next(checks), delay=0.1, max_delay=0.3))
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [0.1, 0.2, 0.3, 0.3])
+
+    @patch('greengo.greengo.sleep', MagicMock())
+    def test_timeout(self):
+        self.assertFalse(greengo._wait_for(lambda: False, timeout=0))
+
+
+class ClientsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_lazy_clients(self):
+        aws_session = MagicMock(region_name='moon-darkside')
+        clients = greengo.Clients(aws_session, max_pool_connections=32)
+        self.assertFalse(aws_session.client.called)
+
+        self.assertIs(clients.get('iot'), clients.get('iot'))
+        self.assertEqual(aws_session.client.call_count, 1)
+        _, kwargs = aws_session.client.call_args
+        self.assertEqual(kwargs['config'].max_pool_connections, 32)
+
+    def test_iot_endpoint_cache(self):
+        aws_session = MagicMock(region_name='moon-darkside')
+        aws_session.client.return_value.describe_endpoint.return_value = {
+            'endpointAddress': 'xxx.iot.moon-darkside.amazonaws.com'}
+
+        endpoint = greengo.Clients(aws_session).iot_endpoint(cache_dir=self.tmp)
+        self.assertEqual(endpoint, 'xxx.iot.moon-darkside.amazonaws.com')
+        self.assertEqual(
+            greengo.Clients(aws_session).iot_endpoint(cache_dir=self.tmp), endpoint)
+        self.assertEqual(aws_session.client.return_value.describe_endpoint.call_count, 1)
+
+    @patch('greengo.greengo.sleep')
+    def test_call_backs_off_on_throttling(self, sleep):
+        aws_session = MagicMock(region_name='moon-darkside')
+        stats = greengo.ApiStats()
+        clients = greengo.Clients(aws_session, stats=stats)
+        throttled = ClientError(
+            error_response={'Error': {'Code': 'ThrottlingException'}},
+            operation_name='CreateThing')
+        aws_session.client.return_value.create_thing = MagicMock(
+            side_effect=[throttled, throttled, {'thingName': 't'}])
+
+        self.assertEqual(clients.get('iot').create_thing(thingName='t'), {'thingName': 't'})
+
+        self.assertEqual(stats.get('iot.create_thing'),
+                         dict(calls=3, throttled=2, failed=2, seconds=stats.get(
+                             'iot.create_thing')['seconds']))
+        self.assertEqual(clients._rate_limits['iot.create_thing'].rate, 3.5)
+        self.assertIn('iot.create_thing', stats.summary())
+
+    @patch('greengo.greengo.sleep')
+    def test_call_retries_network_errors(self, sleep):
+        from botocore.exceptions import EndpointConnectionError, ReadTimeoutError
+        aws_session = MagicMock(region_name='moon-darkside')
+        stats = greengo.ApiStats()
+        clients = greengo.Clients(aws_session, stats=stats)
+        iot = aws_session.client.return_value
+        timeout = ReadTimeoutError(endpoint_url='https://iot')
+        unsent = EndpointConnectionError(endpoint_url='https://iot')
+
+        iot.describe_thing = MagicMock(side_effect=[timeout, unsent, {'thingName': 't'}])
+        self.assertEqual(clients.get('iot').describe_thing(thingName='t'), {'thingName': 't'})
+        self.assertEqual(stats.get('iot.describe_thing')['failed'], 2)
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [1, 2])
+
+        # A call making something is retried only if the request was not sent
+        iot.create_thing = MagicMock(side_effect=[unsent, {'thingName': 't'}])
+        self.assertEqual(clients.get('iot').create_thing(thingName='t'), {'thingName': 't'})
+        iot.create_thing = MagicMock(side_effect=[timeout, {'thingName': 't'}])
+        with self.assertRaises(ReadTimeoutError):
+            clients.get('iot').create_thing(thingName='t')
+        self.assertEqual(iot.create_thing.call_count, 1)
+
+        iot.describe_thing = MagicMock(side_effect=timeout)
+        with self.assertRaises(ReadTimeoutError):
+            clients.get('iot').describe_thing(thingName='t')
+        self.assertEqual(iot.describe_thing.call_count, greengo.API_RETRIES)
+
+    @patch('greengo.greengo.sleep', MagicMock())
+    def test_throttled_call_retried_once(self):
+        import boto3
+        from botocore.awsrequest import AWSResponse
+
+        class Raw(object):
+            def __init__(self, body):
+                self.body = body
+
+            def stream(self, **kwargs):
+                yield self.body
+
+        responses = [
+            AWSResponse('https://iot', 400, {'x-amzn-ErrorType': 'ThrottlingException'},
+                        Raw(b'{"message": "Rate exceeded"}')),
+            AWSResponse('https://iot', 200, {}, Raw(b'{"thingName": "t"}')),
+        ]
+        sent = []
+
+        def send(request, **kwargs):
+            sent.append(request)
+            return responses[len(sent) - 1]
+
+        aws_session = boto3.session.Session(
+            aws_access_key_id='x', aws_secret_access_key='x', region_name='us-west-2')
+        stats = greengo.ApiStats()
+        iot = greengo.Clients(aws_session, stats=stats).get('iot')
+        iot.meta.events.register('before-send.iot.DescribeThing', send)
+
+        self.assertEqual(iot.describe_thing(thingName='t')['thingName'], 't')
+        # botocore didn't retry on its own: the wrapper saw the throttled call
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(stats.get('iot.describe_thing')['calls'], 2)
+        self.assertEqual(stats.get('iot.describe_thing')['throttled'], 1)
+
+    def test_call_raises_other_errors(self):
+        aws_session = MagicMock(region_name='moon-darkside')
+        clients = greengo.Clients(aws_session, stats=greengo.ApiStats())
+        aws_session.client.return_value.delete_thing = MagicMock(side_effect=ClientError(
+            error_response={'Error': {'Code': 'ResourceNotFoundException'}},
+            operation_name='DeleteThing'))
+
+        with self.assertRaises(ClientError):
+            clients.get('iot').delete_thing(thingName='t')
+        self.assertEqual(aws_session.client.return_value.delete_thing.call_count, 1)
+
+    @patch('greengo.greengo.sleep', MagicMock())
+    def test_call_retries_creates_when_throttled_only(self):
+        aws_session = MagicMock(region_name='moon-darkside')
+        clients = greengo.Clients(aws_session, stats=greengo.ApiStats())
+        timeout = ClientError(
+            error_response={'Error': {'Code': 'InternalFailureException'}},
+            operation_name='CreateKeysAndCertificate')
+        iot = aws_session.client.return_value
+        iot.create_keys_and_certificate = MagicMock(side_effect=[timeout, {}])
+        iot.describe_thing = MagicMock(side_effect=[timeout, {'thingName': 't'}])
+
+        # The certificate may have been created all the same
+        with self.assertRaises(ClientError):
+            clients.get('iot').create_keys_and_certificate(setAsActive=True)
+        self.assertEqual(iot.create_keys_and_certificate.call_count, 1)
+
+        self.assertEqual(clients.get('iot').describe_thing(thingName='t'), {'thingName': 't'})
+        self.assertEqual(iot.describe_thing.call_count, 2)
+
+
+class RateLimitTest(unittest.TestCase):
+
+    @patch('greengo.greengo.time', MagicMock(return_value=100.0))
+    @patch('greengo.greengo.sleep')
+    def test_waits_when_out_of_tokens(self, sleep):
+        limit = greengo._RateLimit(2)
+        for _ in range(4):
+            limit.acquire()
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [0.5, 1.0])
+
+
+class StateFileTest(unittest.TestCase):
+
+    def tearDown(self):
+        remove_state()
+
+    def test_journal(self):
+        sf = greengo.StateFile(greengo.STATE_FILE)
+        s = sf.load()
+        s['Group'] = {'Id': 'g1'}
+        sf.save(s, ['Group'])
+        s['Cores'] = [{'name': 'core'}]
+        sf.save(s, ['Cores'])
+        s.pop('Group')
+        sf.save(s, ['Group'])
+        sf.save(s, [])  # Nothing changed, nothing written
+
+        self.assertFalse(os.path.exists(greengo.STATE_FILE))
+        with open(sf.journal_path) as f:
+            self.assertEqual(len(f.readlines()), 3)
+        self.assertEqual(greengo.StateFile(greengo.STATE_FILE).load(),
+                         {'Cores': [{'name': 'core'}]})
+        # Loading compacts the journal into the snapshot
+        self.assertFalse(os.path.exists(sf.journal_path))
+        with open(greengo.STATE_FILE) as f:
+            self.assertEqual(json.load(f), {'Cores': [{'name': 'core'}]})
+
+    def test_sync_once_per_step(self):
+        sf = greengo.StateFile(greengo.STATE_FILE)
+        s = greengo.State()
+        with patch('greengo.greengo.os.fsync') as fsync:
+            for i in range(3):
+                s['Group'] = {'Id': 'g{0}'.format(i)}
+                sf.save(s, ['Group'])
+            self.assertFalse(fsync.called)
+            sf.sync()
+            sf.sync()  # Nothing new to flush
+        self.assertEqual(fsync.call_count, 1)
+        with open(sf.journal_path) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+    def test_incomplete_record(self):
+        sf = greengo.StateFile(greengo.STATE_FILE)
+        sf.save({'Group': {'Id': 'g1'}})
+        with open(sf.journal_path, 'a') as f:
+            f.write('{"key": "Cores", "val')
+
+        self.assertEqual(greengo.StateFile(greengo.STATE_FILE).load(), {'Group': {'Id': 'g1'}})
+
+    def test_compact_on_journal_size(self):
+        sf = greengo.StateFile(greengo.STATE_FILE)
+        with patch('greengo.greengo.JOURNAL_MAX_RECORDS', 2):
+            sf.save({'Group': {'Id': 'g1'}})
+            self.assertFalse(os.path.exists(greengo.STATE_FILE))
+            sf.save({'Group': {'Id': 'g2'}})
+        self.assertFalse(os.path.exists(sf.journal_path))
+        with open(greengo.STATE_FILE) as f:
+            self.assertEqual(json.load(f), {'Group': {'Id': 'g2'}})
+
+    def test_remove(self):
+        sf = greengo.StateFile(greengo.STATE_FILE)
+        sf.save({'Group': {'Id': 'g1'}})
+        sf.compact()
+        sf.save({'Group': {'Id': 'g2'}})
+        sf.save({})
+        self.assertFalse(sf.exists())
@@ -0,0 +1,242 @@
+import os
+import shutil
+import subprocess
+import zlib
+import zipfile
+import tempfile
+import threading
+import unittest
+
+from mock import patch
+
+from greengo import packaging
+
+
+class BuildPackageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp, 'src')
+        self.target = os.path.join(self.tmp, 'target')
+        os.makedirs(os.path.join(self.source, 'lib'))
+        os.makedirs(self.target)
+        self.write('function.py', 'def handler(event, context):\n    pass\n')
+        self.write('lib/util.py', 'x = 1\n' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        with open(os.path.join(self.source, name), 'w') as f:
+            f.write(content)
+
+    def read_zip(self, path):
+        with zipfile.ZipFile(path) as z:
+            self.assertIsNone(z.testzip())
+            return dict((n, z.read(n).decode('utf-8')) for n in z.namelist())
+
+    def test_unchanged_package_is_not_rezipped(self):
+        zf, changed = packaging.build_package('fn', self.source, self.target)
+        self.assertTrue(changed)
+        sha = packaging.code_sha256(zf)
+
+        zf, changed = packaging.build_package('fn', self.source, self.target)
+        self.assertFalse(changed)
+        self.assertEqual(packaging.code_sha256(zf), sha)
+
+    def test_only_changed_files_are_compressed(self):
+        packaging.build_package('fn', self.source, self.target)
+        self.write('function.py', 'def handler(event, context):\n    return 42\n')
+        self.write('new.py', 'y = 2\n')
+
+        with patch.object(packaging, '_write_entry',
+                          side_effect=packaging._write_entry) as write:
+            zf, changed = packaging.build_package('fn', self.source, self.target)
+
+        self.assertTrue(changed)
+        self.assertEqual(sorted(c[0][2] for c in write.call_args_list),
+                         ['function.py', 'new.py'])
+        self.assertEqual(self.read_zip(zf), {
+            'function.py': 'def handler(event, context):\n    return 42\n',
+            'lib/util.py': 'x = 1\n' * 1000,
+            'new.py': 'y = 2\n'})
+
+    def test_copied_entry(self):
+        packaging.build_package('fn', self.source, self.target, level=9)
+        self.write('function.py', 'def handler(event, context):\n    return 42\n')
+
+        with patch.object(packaging, '_copy_entry', side_effect=packaging._copy_entry) as copy:
+            zf, _ = packaging.build_package('fn', self.source, self.target, level=9)
+
+        self.assertEqual([c[0][1].filename for c in copy.call_args_list], ['lib/util.py'])
+        with zipfile.ZipFile(zf) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(z.read('lib/util.py').decode('utf-8'), 'x = 1\n' * 1000)
+
+    def test_compressed_again_without_raw_copy(self):
+        packaging.build_package('fn', self.source, self.target)
+        self.write('function.py', 'def handler(event, context):\n    return 42\n')
+
+        with patch.object(packaging, 'RAW_COPY_VERSIONS', ((2, 0), (2, 0))), \
+                patch.object(packaging, '_copy_entry') as copy:
+            zf, _ = packaging.build_package('fn', self.source, self.target)
+
+        self.assertFalse(copy.called)
+        self.assertEqual(self.read_zip(zf)['lib/util.py'], 'x = 1\n' * 1000)
+
+    def test_excluded_files(self):
+        os.makedirs(os.path.join(self.source, '__pycache__'))
+        os.makedirs(os.path.join(self.source, 'tests'))
+        self.write('__pycache__/function.cpython-37.pyc', 'x')
+        self.write('lib/util.pyc', 'x')
+        self.write('tests/test_function.py', 'x')
+
+        zf, _ = packaging.build_package('fn', self.source, self.target)
+        self.assertEqual(sorted(self.read_zip(zf)), ['function.py', 'lib/util.py'])
+        self.assertFalse(packaging.is_changed('fn', self.source, self.target))
+
+        zf, _ = packaging.build_package('fn', self.source, self.target, exclude=['lib/*.py'])
+        self.assertEqual(sorted(self.read_zip(zf)), [
+            '__pycache__/function.cpython-37.pyc', 'function.py',
+            'lib/util.pyc', 'tests/test_function.py'])
+
+    def test_reproducible(self):
+        zf, _ = packaging.build_package('fn', self.source, self.target)
+        sha = packaging.code_sha256(zf)
+
+        os.utime(os.path.join(self.source, 'function.py'), (1000000000, 1000000000))
+        other = os.path.join(self.tmp, 'other')
+        os.makedirs(other)
+        self.assertEqual(packaging.code_sha256(
+            packaging.build_package('fn', self.source, other)[0]), sha)
+
+    def test_compression_level(self):
+        zf, _ = packaging.build_package('fn', self.source, self.target, level=0)
+        with zipfile.ZipFile(zf) as z:
+            self.assertEqual(z.getinfo('lib/util.py').compress_type, zipfile.ZIP_STORED)
+        small, _ = packaging.build_package('fn', self.source, self.target, level=9)
+        with zipfile.ZipFile(small) as z:
+            self.assertEqual(z.getinfo('lib/util.py').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(self.read_zip(small)['lib/util.py'], 'x = 1\n' * 1000)
+
+    @patch('zipfile.ZipFile.writestr', side_effect=AssertionError('read in full'))
+    def test_large_entry_streamed_at_level(self, writestr):
+        data = ''.join('{0} {1}\n'.format(i, i * 7919 % 10007) for i in range(300000))
+        self.assertGreater(len(data), 2 * packaging.CHUNK_SIZE)
+        self.write('lib/data.txt', data)
+
+        zf, _ = packaging.build_package('fn', self.source, self.target, level=1)
+
+        compressor = zlib.compressobj(1, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data.encode('utf-8')) + compressor.flush()
+        with zipfile.ZipFile(zf) as z:
+            self.assertEqual(z.getinfo('lib/data.txt').compress_size, len(deflated))
+        self.assertEqual(self.read_zip(zf)['lib/data.txt'], data)
+        self.assertFalse(writestr.called)
+
+    def test_open_package(self):
+        zf, _ = packaging.build_package('fn', self.source, self.target)
+        with open(zf, 'rb') as f:
+            data = f.read()
+        with packaging.open_package(zf) as mapped:
+            self.assertEqual(mapped[:], data)
+
+    def test_remove_package(self):
+        packaging.build_package('fn', self.source, self.target)
+        packaging.remove_package('fn', self.target)
+        self.assertEqual(os.listdir(self.target), [])
+
+
+class DependenciesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmp, 'cache')
+        self.requirements = os.path.join(self.tmp, 'requirements.txt')
+        with open(self.requirements, 'w') as f:
+            f.write('greengrasssdk==1.4.0\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    # Stands for pip: installs a module into the --target directory
+    def pip(self, args):
+        target = args[args.index('--target') + 1]
+        os.makedirs(os.path.join(target, 'greengrasssdk'))
+        with open(os.path.join(target, 'greengrasssdk', '__init__.py'), 'w') as f:
+            f.write('sdk = True\n')
+
+    def test_built_once(self):
+        with patch('greengo.packaging.subprocess.check_call', side_effect=self.pip) as pip:
+            deps = packaging.build_dependencies(self.requirements, self.cache)
+            self.assertEqual(packaging.build_dependencies(self.requirements, self.cache), deps)
+        self.assertEqual(pip.call_count, 1)
+        self.assertEqual(os.listdir(self.cache), [os.path.basename(deps)])
+
+        with open(self.requirements, 'a') as f:
+            f.write('requests\n')
+        self.assertNotEqual(packaging.dependencies_dir(self.requirements, self.cache), deps)
+
+    def test_installed_for_the_runtime(self):
+        with patch('greengo.packaging.subprocess.check_call', side_effect=self.pip) as pip:
+            deps = packaging.build_dependencies(self.requirements, self.cache)
+        args = pip.call_args[0][0]
+        for option, value in [('--python-version', '2.7'), ('--implementation', 'cp'),
+                              ('--platform', packaging.PLATFORM)]:
+            self.assertEqual(args[args.index(option) + 1], value)
+        self.assertIn('--only-binary=:all:', args)
+
+        self.assertNotEqual(packaging.dependencies_dir(
+            self.requirements, self.cache, platform='linux_armv7l'), deps)
+
+    def test_different_requirements_build_at_once(self):
+        other = os.path.join(self.tmp, 'other.txt')
+        with open(other, 'w') as f:
+            f.write('requests\n')
+        installing, started = threading.Event(), threading.Event()
+        overlapped = []
+
+        def pip(args):
+            if args[args.index('--requirement') + 1] == other:
+                started.set()
+            else:
+                installing.set()
+                overlapped.append(started.wait(5))
+            self.pip(args)
+
+        with patch('greengo.packaging.subprocess.check_call', side_effect=pip):
+            first = threading.Thread(
+                target=packaging.build_dependencies, args=(self.requirements, self.cache))
+            first.start()
+            installing.wait(5)
+            packaging.build_dependencies(other, self.cache)
+            first.join()
+        self.assertEqual(overlapped, [True])
+
+    def test_failed_build_leaves_nothing(self):
+        with patch('greengo.packaging.subprocess.check_call',
+                   side_effect=subprocess.CalledProcessError(1, 'pip')):
+            with self.assertRaises(subprocess.CalledProcessError):
+                packaging.build_dependencies(self.requirements, self.cache)
+        self.assertEqual(os.listdir(self.cache), [])
+
+    def test_package_with_dependencies(self):
+        source = os.path.join(self.tmp, 'src')
+        os.makedirs(source)
+        with open(os.path.join(source, 'function.py'), 'w') as f:
+            f.write('import greengrasssdk\n')
+
+        with patch('greengo.packaging.subprocess.check_call', side_effect=self.pip):
+            deps = packaging.build_dependencies(self.requirements, self.cache)
+        zf, _ = packaging.build_package('fn', source, self.tmp, dependencies_dir=deps)
+        with zipfile.ZipFile(zf) as z:
+            self.assertEqual(sorted(z.namelist()), ['function.py', 'greengrasssdk/__init__.py'])
+        self.assertFalse(packaging.is_changed('fn', source, self.tmp, dependencies_dir=deps))
+
+        # Only the user code is compressed again
+        with open(os.path.join(source, 'function.py'), 'w') as f:
+            f.write('import greengrasssdk  # changed\n')
+        with patch.object(packaging, '_write_entry',
+                          side_effect=packaging._write_entry) as write:
+            packaging.build_package('fn', source, self.tmp, dependencies_dir=deps)
+        self.assertEqual([c[0][2] for c in write.call_args_list], ['function.py'])
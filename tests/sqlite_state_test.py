@@ -0,0 +1,148 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mock import patch
+
+from greengo import greengo
+from greengo.sqlite_state import StateDB
+from tests.main_test import SessionFixture
+
+
+class StateDBTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'state.db')
+        with open('tests/test_state.json', 'r') as f:
+            self.state = greengo.State(json.load(f))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_save_load(self):
+        db = StateDB(self.path, 'GreengoGroup')
+        self.assertFalse(db.exists())
+        self.assertEqual(db.load(), {})
+
+        db.save(self.state)
+        self.assertEqual(StateDB(self.path, 'GreengoGroup').load(), self.state)
+        self.assertEqual(StateDB(self.path, 'OtherGroup').load(), {})
+
+        self.state.pop('Loggers')
+        self.state['Group']['Version'] = 'v2'
+        db.save(self.state)
+        loaded = StateDB(self.path, 'GreengoGroup').load()
+        self.assertNotIn('Loggers', loaded)
+        self.assertEqual(loaded['Group']['Version'], 'v2')
+
+    def test_things_index(self):
+        db = StateDB(self.path, 'GreengoGroup')
+        db.save(self.state)
+        StateDB(self.path, 'OtherGroup').save({'Group': {'Id': 'g2'}})
+
+        core = self.state['Cores'][0]
+        self.assertEqual(db.groups(), ['GreengoGroup', 'OtherGroup'])
+        self.assertEqual(
+            db.find_thing('GreengoGroup_core_1'),
+            [('GreengoGroup', 'Cores', 'GreengoGroup_core_1', core['keys']['certificateId'])])
+        self.assertEqual(len(db.find_certificate(core['keys']['certificateId'])), 1)
+
+        self.state.pop('Cores')
+        db.save(self.state)
+        self.assertEqual(db.find_thing('GreengoGroup_core_1'), [])
+
+    def test_commit_out_of_state_lock(self):
+        db = StateDB(self.path, 'GreengoGroup')
+        committed = []
+
+        def lock_free():
+            committed.append(greengo._state_lock.acquire(False))
+            greengo._state_lock.release()
+
+        class Connection(object):
+            def __init__(self, db):
+                self.db = db
+
+            def __getattr__(self, name):
+                return getattr(self.db, name)
+
+            def __enter__(self):
+                return self.db.__enter__()
+
+            def __exit__(self, *args):
+                # Another group can take the lock while this one commits
+                other = threading.Thread(target=lock_free)
+                other.start()
+                other.join()
+                return self.db.__exit__(*args)
+
+        db._db = Connection(db._db)
+        db.save(self.state)
+        self.assertEqual(committed, [True])
+
+    def test_stale_snapshot_not_written(self):
+        db = StateDB(self.path, 'GreengoGroup')
+        db.save(self.state)
+        self.state['Group']['Version'] = 'v1'
+        stale = db._snapshot(self.state, ['Group'])
+        self.state['Group']['Version'] = 'v2'
+        db.save(self.state, ['Group'])
+
+        db._write(*stale)  # Written after the later snapshot
+        self.assertEqual(StateDB(self.path, 'GreengoGroup').load()['Group']['Version'], 'v2')
+
+    def test_remove(self):
+        db = StateDB(self.path, 'GreengoGroup')
+        db.save(self.state)
+        db.save({})
+        self.assertFalse(db.exists())
+        self.assertEqual(db.find_thing('GreengoGroup_core_1'), [])
+
+    def test_closed_on_exit(self):
+        db = StateDB(self.path, 'GreengoGroup')
+        self.assertIn(db, greengo._open_state_stores)
+
+        greengo._close_state_stores()
+        self.assertNotIn(db, greengo._open_state_stores)
+        with self.assertRaises(Exception):
+            db.exists()
+
+
+class MigrateStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        shutil.copy('tests/test_state.json', self.tmp)
+        os.chdir(self.tmp)
+        with open('greengo.yaml', 'w') as f:
+            f.write("Group:\n  name: GreengoGroup\n")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def group_commands(self, backend):
+        with patch.object(greengo.session, 'Session', SessionFixture):
+            return greengo.GroupCommands(state_backend=backend)
+
+    def test_migrate(self):
+        with open('test_state.json') as f:
+            state = json.load(f)
+        greengo.StateFile(greengo.STATE_FILE).save(state)
+
+        self.assertIsNone(self.group_commands('json').migrate_state('sqlite'))
+        self.assertFalse(os.path.exists(greengo.STATE_FILE))
+        self.assertEqual(self.group_commands('sqlite').state, state)
+
+        self.assertIsNone(self.group_commands('sqlite').migrate_state('json'))
+        self.assertEqual(self.group_commands('json').state, state)
+        self.assertEqual(self.group_commands('sqlite').state, {})
+
+    def test_migrate_nothing(self):
+        self.assertFalse(self.group_commands('json').migrate_state('sqlite'))
+        self.assertFalse(self.group_commands('json').migrate_state('xml'))
@@ -0,0 +1,20 @@
+import sys
+import json
+import subprocess
+import unittest
+
+HEAVY_MODULES = ['boto3', 'botocore', 'yaml', 'fire']
+
+# Import greengo in a fresh interpreter, report the heavy modules loaded
+SCRIPT = '''
+import sys, json
+import greengo.greengo, greengo.fleet
+print(json.dumps([m for m in {0!r} if m in sys.modules]))
+'''.format(HEAVY_MODULES)
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_no_heavy_imports(self):
+        out = subprocess.check_output([sys.executable, '-c', SCRIPT])
+        self.assertEqual(json.loads(out.decode('utf-8')), [])
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from botocore.exceptions import ClientError
+
+from greengo import upload
+
+
+# In-memory stand-in for the S3 calls of upload_package
+class FakeS3(object):
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls.append(name)
+
+    def head_object(self, Bucket, Key):
+        self._call('head_object')
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {'ContentLength': len(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body):
+        self._call('put_object')
+        self.objects[(Bucket, Key)] = Body.read()
+
+    def create_multipart_upload(self, Bucket, Key):
+        self._call('create_multipart_upload')
+        upload_id = 'upload-{0}'.format(len(self.uploads))
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._call('upload_part')
+        with self._lock:
+            self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': 'etag-{0}'.format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._call('complete_multipart_upload')
+        parts = self.uploads.pop(UploadId)
+        numbers = [p['PartNumber'] for p in MultipartUpload['Parts']]
+        assert numbers == sorted(parts), numbers
+        self.objects[(Bucket, Key)] = b''.join(parts[n] for n in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._call('abort_multipart_upload')
+        self.uploads.pop(UploadId)
+
+
+class UploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.s3 = FakeS3()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def package(self, data):
+        path = os.path.join(self.tmp, 'package.zip')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_small_package(self):
+        path = self.package(b'zip')
+        key = upload.upload_package(self.s3, path, 'bucket', 'greengo/')
+        self.assertTrue(key.startswith('greengo/'))
+        self.assertEqual(self.s3.objects[('bucket', key)], b'zip')
+        self.assertNotIn('create_multipart_upload', self.s3.calls)
+
+    def test_multipart(self):
+        data = os.urandom(1000)
+        path = self.package(data)
+        key = upload.upload_package(self.s3, path, 'bucket', part_size=128, workers=4)
+        self.assertEqual(self.s3.objects[('bucket', key)], data)
+        self.assertEqual(self.s3.calls.count('upload_part'), 8)
+
+    def test_uploaded_once(self):
+        path = self.package(b'zip')
+        key = upload.upload_package(self.s3, path, 'bucket')
+        self.assertEqual(upload.upload_package(self.s3, path, 'bucket'), key)
+        self.assertEqual(self.s3.calls.count('put_object'), 1)
+
+        other = self.package(b'other zip')
+        self.assertNotEqual(upload.upload_package(self.s3, other, 'bucket'), key)
+
+    def test_abort_failed_upload(self):
+        path = self.package(os.urandom(1000))
+
+        def upload_part(**kwargs):
+            raise ClientError({'Error': {'Code': 'InternalError'}}, 'UploadPart')
+        self.s3.upload_part = upload_part
+
+        with self.assertRaises(ClientError):
+            upload.upload_package(self.s3, path, 'bucket', part_size=128)
+        self.assertIn('abort_multipart_upload', self.s3.calls)
+        self.assertEqual(self.s3.objects, {})
@@ -0,0 +1,68 @@
+import copy
+import unittest
+
+import yaml
+
+from greengo.validate import validate
+
+with open('greengo.yaml', 'r') as f:
+    GROUP = yaml.safe_load(f)
+
+
+class ValidateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.group = copy.deepcopy(GROUP)
+
+    def test_valid(self):
+        self.assertEqual(validate(self.group), [])
+
+    def test_schema(self):
+        self.group['Lambdas'][0]['greengrassConfig']['Pinned'] = 'yes'
+        self.group['Lambdas'][0]['hander'] = 'function.handler'
+        self.group['Loggers'][0]['Level'] = 'VERBOSE'
+        del self.group['Subscriptions'][0]['Subject']
+
+        self.assertEqual(set(validate(self.group)), set([
+            "Lambdas[0]: unknown field 'hander'",
+            "Lambdas[0].greengrassConfig.Pinned: expected true or false, got 'yes'",
+            "Loggers[0].Level: 'VERBOSE' is not one of "
+            "['DEBUG', 'ERROR', 'FATAL', 'INFO', 'WARN']",
+            "Subscriptions[0]: 'Subject' is required",
+        ]))
+
+    def test_things(self):
+        del self.group['Cores'][0]['config_path']
+        del self.group['Cores'][0]['SyncShadow']
+        del self.group['Devices'][0]['SyncShadow']
+        self.group['Devices'][0]['config_path'] = './config'  # Optional for devices
+
+        self.assertEqual(set(validate(self.group)), set([
+            "Cores[0]: 'config_path' is required",
+            "Cores[0]: 'SyncShadow' is required",
+            "Devices[0]: 'SyncShadow' is required",
+        ]))
+
+    def test_references(self):
+        self.group['Subscriptions'][0]['Source'] = 'Lambda::Missing'
+        self.group['Subscriptions'][1]['Target'] = 'Device :: ml_take2_thing_1'
+        self.group['Subscriptions'].append(
+            {'Source': 'Connector::c1', 'Subject': 'x', 'Target': 'Lambda'})
+        self.group['Lambdas'][0]['greengrassConfig']['Environment']['ResourceAccessPolicies'] = [
+            {'ResourceId': 'resource_1_path_to_input'}, {'ResourceId': 'nope'}]
+        self.group['Loggers'].append(dict(self.group['Loggers'][0]))
+
+        errors = validate(self.group)
+        self.assertEqual(len(errors), 5, errors)
+        self.assertIn("Subscriptions[0].Source: unknown lambda 'Missing'", errors)
+        self.assertIn("Subscriptions[2].Source: unknown connector 'c1'", errors)
+        self.assertTrue(errors[-1].startswith("Subscriptions[2].Target: can't parse 'Lambda'"))
+        self.assertIn("Loggers[1]: duplicate Id 'logger_1'", errors)
+        self.assertIn("Lambdas[0].greengrassConfig.Environment.ResourceAccessPolicies[1]: "
+                      "unknown resource 'nope'", errors)
+
+    def test_many_subscriptions(self):
+        self.group['Subscriptions'] = [dict(s) for s in self.group['Subscriptions'] * 5000]
+        self.group['Subscriptions'][-1]['Target'] = 'Lambda::Missing'
+        self.assertEqual(validate(self.group), [
+            "Subscriptions[9999].Target: unknown lambda 'Missing'"])